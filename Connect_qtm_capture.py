@@ -1,7 +1,10 @@
 import asyncio
 import qtm_rt
 
+from qtm_settings import QtmSettings
+
 qtm_connection = None  # Stocke la connexion à QTM
+qtm_settings = QtmSettings()  # Paramètres QTM en cache (envoi des seules différences)
 
 
 async def connect_to_qtm():
@@ -53,30 +56,26 @@ async def create_new_capture():
     return capture
 
 
-async def set_capture_parameters():
-    """ Configure les paramètres de la nouvelle capture via un XML """
+async def set_capture_parameters(capture_time=20.0, frequency=120):
+    """ Configure les paramètres de la nouvelle capture (seuls les paramètres modifiés sont envoyés) """
     global qtm_connection
 
     if qtm_connection is None:
         print("⚠️ Impossible de configurer la capture : connexion QTM absente.")
         return
 
-    # Exemple de configuration en XML (à adapter selon tes besoins)
-    xml_configuration = """<?xml version="1.0" encoding="UTF-8"?>
-    <QTM_Settings>
-        <General>
-            <Capture_Time>20</Capture_Time>  <!-- Durée de la capture en secondes -->
-            <Frequency>120</Frequency>  <!-- Fréquence d'acquisition -->
-        </General>s
-    </QTM_Settings>"""
-
-    print("📡 Envoi des paramètres de capture à QTM...")
-    response = await qtm_connection.send_xml(xml_configuration)
+    try:
+        changes = await qtm_settings.apply(qtm_connection, {
+            "General": {"Capture_Time": capture_time, "Frequency": frequency},
+        })
+    except (ValueError, qtm_rt.QRTCommandException) as e:
+        print(f"🔴 Échec de l'application des paramètres : {e}")
+        return
 
-    if response:
+    if changes:
         print("🟢 Paramètres de capture appliqués avec succès.")
     else:
-        print("🔴 Échec de l'application des paramètres.")
+        print("🟢 Paramètres de capture déjà à jour.")
 
 
 async def start_streaming():
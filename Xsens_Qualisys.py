@@ -1,10 +1,20 @@
+import argparse
 import asyncio
 import time
-import threading
 import qtm_rt
 import sys
 import keyboard
 from xdpchandler import XdpcHandler
+from dot_connect import connect_devices
+from dot_registry import SensorRegistry, targeted_scan, timed_scan, select_by_addresses
+from sync_supervisor import SyncSupervisor
+from dot_commands import get_fan_out
+import instrumentation
+from session_loop import SessionLoop
+from qtm_trigger import QtmEventTrigger
+from qtm_connection import QtmConnectionManager, DEFAULT_HOST, DEFAULT_PORT
+from dot_export import export_recordings
+from command_queue import CommandQueue, attach_terminal, start_socket_server
 
 """ Script qui permet de : 
 - Scanner les capteurs Movella DOT
@@ -17,6 +27,10 @@ from xdpchandler import XdpcHandler
 # Initialisation globale des variables
 xdpc_handler = None
 connected_devices = []
+connect_times = {}  # Temps de connexion par adresse Bluetooth
+qtm_manager = None  # Connexion QTM supervisée (reconnexion automatique)
+xsens_recording = False
+event_trigger = None  # Démarrage/arrêt des DOTs sur les événements QTM (mode déclenché)
 
 
 def initialize_sdk(verbose=True):
@@ -38,15 +52,23 @@ def initialize_sdk(verbose=True):
     return xdpc_handler
 
 
-def scan_for_dots(scan_duration=60, verbose=True):
+def scan_for_dots(scan_duration=60, verbose=True, expected_addresses=None):
+    """
+    Scanne les capteurs pendant scan_duration secondes. Avec expected_addresses (profil enregistré),
+    le scan s'arrête dès que tous les capteurs attendus sont détectés.
+    """
     global xdpc_handler
 
     if verbose:
         print(
             f"Lancement du scan des capteurs pour {scan_duration} secondes...")
 
-    xdpc_handler.scanForDots()
-    detected_dots = xdpc_handler.detectedDots()
+    with instrumentation.span("dot.scan"):
+        if expected_addresses:
+            detected_dots, _ = targeted_scan(xdpc_handler, expected_addresses,
+                                             timeout=scan_duration, verbose=verbose)
+        else:
+            detected_dots = timed_scan(xdpc_handler, scan_duration, verbose=verbose)
 
     if not detected_dots:
         if verbose:
@@ -62,43 +84,46 @@ def scan_for_dots(scan_duration=60, verbose=True):
     return detected_dots
 
 
-def connect_dots(detected_dots, verbose=True):
-    global xdpc_handler, connected_devices
-
-    if verbose:
-        print("Sélectionnez les capteurs à connecter :")
-
-    for i, device in enumerate(detected_dots):
-        print(f"{i + 1}. Adresse Bluetooth : {device.bluetoothAddress()}")
+def connect_dots(detected_dots, verbose=True, parallel=True, max_workers=4, max_retries=2,
+                 addresses=None):
+    """
+    Connecte les capteurs sélectionnés.
+    En mode parallèle, les ports sont ouverts par un pool de threads borné
+    et les capteurs en échec sont retentés sans bloquer les autres.
+    addresses : adresses d'un profil enregistré (connexion sans saisie), None pour choisir au clavier.
+    """
+    global xdpc_handler, connected_devices, connect_times
 
-    selected_indices = input(
-        "Entrez les indices des capteurs à connecter (séparés par des virgules) : ")
-    selected_indices = [
-        int(i.strip()) - 1 for i in selected_indices.split(",") if i.strip().isdigit()]
+    if addresses is not None:
+        device_infos = select_by_addresses(detected_dots, addresses)
+        if verbose:
+            print(f"Connexion au profil enregistré ({len(device_infos)}/{len(addresses)} capteurs détectés).")
+            if len(device_infos) < len(addresses):
+                print("💡 Capteur hors service : --forget ADRESSE le retire du profil, "
+                      "--reset-profile refait la sélection au clavier.")
+    else:
+        if verbose:
+            print("Sélectionnez les capteurs à connecter :")
 
-    connected_devices = []
+        for i, device in enumerate(detected_dots):
+            print(f"{i + 1}. Adresse Bluetooth : {device.bluetoothAddress()}")
 
-    for index in selected_indices:
-        if 0 <= index < len(detected_dots):
-            device_info = detected_dots[index]
-            if verbose:
-                print(
-                    f"Connexion au capteur : {device_info.bluetoothAddress()}...")
+        selected_indices = input(
+            "Entrez les indices des capteurs à connecter (séparés par des virgules) : ")
+        selected_indices = [
+            int(i.strip()) - 1 for i in selected_indices.split(",") if i.strip().isdigit()]
 
-            if not xdpc_handler.manager().openPort(device_info):
-                if verbose:
-                    print(
-                        f"Échec de la connexion au capteur : {device_info.bluetoothAddress()}.")
+        device_infos = []
+        for index in selected_indices:
+            if 0 <= index < len(detected_dots):
+                device_infos.append(detected_dots[index])
             else:
-                device = xdpc_handler.manager().device(device_info.deviceId())
-                if device:
-                    if verbose:
-                        print(
-                            f"Connecté au capteur : {device.deviceTagName()} ({device.bluetoothAddress()}).")
-                    connected_devices.append(device)
-        else:
-            if verbose:
-                print(f"Index invalide : {index + 1}. Capteur ignoré.")
+                if verbose:
+                    print(f"Index invalide : {index + 1}. Capteur ignoré.")
+
+    connected_devices, connect_times = connect_devices(
+        xdpc_handler, device_infos, parallel=parallel, max_workers=max_workers,
+        max_retries=max_retries, verbose=verbose)
 
     if verbose:
         print(f"{len(connected_devices)} capteur(s) connecté(s) avec succès.")
@@ -106,7 +131,11 @@ def connect_dots(detected_dots, verbose=True):
     return connected_devices
 
 
-def synchronize_devices(verbose=True, max_retries=3):
+def synchronize_devices(verbose=True, max_retries=10):
+    """
+    Synchronise les capteurs connectés (maître choisi selon la qualité de liaison).
+    Un capteur qui bloque la synchronisation est reconnecté ou retiré, et les autres sont resynchronisés.
+    """
     global xdpc_handler, connected_devices
 
     if len(connected_devices) < 2:
@@ -114,192 +143,266 @@ def synchronize_devices(verbose=True, max_retries=3):
             print("La synchronisation nécessite au moins deux capteurs connectés.")
         return False
 
-    xdpc_handler.manager().stopSync()
-    root_device = connected_devices[0]
-    root_address = root_device.bluetoothAddress()
+    supervisor = SyncSupervisor(xdpc_handler, connected_devices, connect_times,
+                                max_attempts=max_retries, verbose=verbose)
+    success = supervisor.run()
+    connected_devices = supervisor.devices  # Sans les capteurs retirés
 
     if verbose:
-        print(f"Capteur maître pour la synchronisation : {root_address}")
+        supervisor.report()
 
-    success = False
-    for attempt in range(max_retries):
-        if verbose:
-            print(
-                f"Tentative de synchronisation ({attempt + 1}/{max_retries})...")
-
-        if xdpc_handler.manager().startSync(root_address):
-            success = True
-            if verbose:
-                print("Synchronisation réussie !")
-            break
-        else:
-            if verbose:
-                print(
-                    f"Échec de la synchronisation. Raison : {xdpc_handler.manager().lastResultText()}")
+    return success
 
-    if not success and verbose:
-        print("Échec de la synchronisation après plusieurs tentatives.")
 
-    return success
+async def get_qtm_connection(timeout=5.0):
+    """
+    Connexion QTM prête (attend la reconnexion en cours si besoin), None si QTM est indisponible.
+    """
+    if qtm_manager is None:
+        return None
+    try:
+        return await qtm_manager.wait_ready(timeout)
+    except asyncio.TimeoutError:
+        return None
 
 
 async def start_qtm_capture():
     """
     Démarre la capture QTM si la connexion est active.
     """
-    global qtm_connection
+    connection = await get_qtm_connection()
 
-    if qtm_connection is not None:
+    if connection is not None:
         print("🟢 Démarrage de la capture dans QTM...")
-        await qtm_connection.start(rtfromfile=False)  # Démarrer la capture
+        instrumentation.mark("qtm.start")
+        with instrumentation.span("qtm.start"):
+            await connection.start(rtfromfile=False)  # Démarrer la capture
     else:
         print("🔴 Impossible de démarrer QTM : connexion non établie.")
 
 
-async def start_synchronized_recording(duration=5000, verbose=True):
+async def start_synchronized_recording(duration=None, verbose=True):
     """
     Démarre l'enregistrement des capteurs Movella DOT.
-    Si au moins un capteur démarre, on envoie une commande à QTM pour commencer la capture.
+    En mode déclenché, on démarre QTM et ce sont les événements QTM qui démarrent les DOTs.
+    Sinon, si au moins un capteur démarre, on envoie une commande à QTM pour commencer la capture.
+    duration (ms) : enregistrement minuté, None pour un arrêt sur commande ou en fin de capture QTM.
     """
     global connected_devices, xsens_recording
 
+    if event_trigger is not None:
+        event_trigger.expect_start()
+        await start_qtm_capture()
+        result = await event_trigger.wait_started(timeout=10)
+        xsens_recording = bool(result.acks)
+        return result
+
     if verbose:
         print("▶️ Démarrage de l'enregistrement des capteurs Movella DOT...")
 
-    started = False  # Vérifier si au moins un capteur a réussi à enregistrer
-
-    for device in connected_devices:
-        if not device.startTimedRecording(duration):
-            print(
-                f"❌ Échec de l'enregistrement pour {device.bluetoothAddress()}. Raison : {device.lastResultText()}")
-        else:
-            print(
-                f"✅ Enregistrement démarré pour {device.bluetoothAddress()}.")
-            started = True
+    # Envoi simultané à tous les capteurs, affichage uniquement après les acquittements
+    if duration is None:
+        result = await get_fan_out(connected_devices).run_async("startRecording")
+    else:
+        result = await get_fan_out(connected_devices).run_async("startTimedRecording", duration)
+    if verbose:
+        result.report()
+    started = bool(result.acks)  # Vérifier si au moins un capteur a réussi à enregistrer
 
     # Si au moins un capteur enregistre et que QTM est bien connecté, on démarre QTM
-    if started and not xsens_recording and qtm_connection is not None:
+    if started and not xsens_recording and qtm_manager is not None:
         xsens_recording = True
         await start_qtm_capture()  # Lancer la capture QTM
 
+    return result
+
 
 async def stop_synchronized_recording(verbose=True):
     """
     Arrête l'enregistrement des capteurs Movella DOT.
+    En mode déclenché, on arrête QTM et l'événement de fin de capture arrête les DOTs.
     """
     global connected_devices, xsens_recording
 
+    if event_trigger is not None:
+        if event_trigger.recording:
+            await stop_qtm_capture()
+            await event_trigger.wait_stopped(timeout=10)
+        xsens_recording = False
+        return event_trigger.stop_result
+
     if verbose:
         print("⏹️ Arrêt de l'enregistrement des capteurs Movella DOT...")
 
-    for device in connected_devices:
-        try:
-            device.stopRecording()
-            print(f"✅ Enregistrement arrêté pour {device.bluetoothAddress()}.")
-        except Exception as e:
-            print(
-                f"❌ Erreur lors de l'arrêt de l'enregistrement pour {device.bluetoothAddress()}: {e}")
+    result = await get_fan_out(connected_devices).run_async("stopRecording")
+    if verbose:
+        result.report()
 
     xsens_recording = False  # Réinitialiser le statut d'enregistrement
+    return result
+
+
+async def export_xsens_recordings(output_dir="exports", verbose=True):
+    """
+    Exporte le dernier enregistrement de chaque capteur Movella DOT (un worker par capteur).
+    """
+    global xdpc_handler, connected_devices
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, export_recordings, xdpc_handler,
+                               connected_devices, output_dir, "last", verbose)
 
 
 async def stop_qtm_capture():
     """
     Arrête la capture QTM proprement si la connexion est active.
     """
-    global qtm_connection
+    connection = await get_qtm_connection()
 
-    if qtm_connection is not None:
+    if connection is not None:
         print("🛑 Arrêt de la capture QTM...")
-        await qtm_connection.stop()
+        instrumentation.mark("qtm.stop")
+        with instrumentation.span("qtm.stop"):
+            await connection.stop()
     else:
         print("🔴 Impossible d'arrêter QTM : connexion non établie.")
 
 
-async def on_event(event):
+def on_event(event):
     """
-    Écoute les événements de QTM en continu.
+    Callback synchrone de qtm_rt, appelé dans la boucle de session à la réception de l'événement.
+    Le déclencheur passe en premier ; aucune tâche n'est créée pour les événements.
     """
-    print(f"📡 Événement reçu depuis QTM : {event}")
+    if event_trigger is not None:
+        event_trigger.on_event(event)
 
     if event == qtm_rt.QRTEvent.EventCaptureStarted:
+        instrumentation.since("qtm.start", "qtm.event.capture_started")
+    elif event == qtm_rt.QRTEvent.EventCaptureStopped:
+        instrumentation.since("qtm.stop", "qtm.event.capture_stopped")
+    print(f"📡 Événement reçu depuis QTM : {event}")
+
+    if event in (qtm_rt.QRTEvent.EventCaptureStarted, qtm_rt.QRTEvent.EventRTfromFileStarted):
         print("🟢 QTM a confirmé que la capture a bien démarré.")
 
-    elif event == qtm_rt.QRTEvent.EventCaptureStopped:
+    elif event in (qtm_rt.QRTEvent.EventCaptureStopped, qtm_rt.QRTEvent.EventRTfromFileStopped):
         print("🛑 QTM a arrêté la capture.")
 
     else:
         print(f"ℹ️ Événement inconnu : {event}")
 
 
-async def connect_to_qtm():
+async def enable_event_trigger(verbose=True):
+    """
+    Arme le démarrage des DOTs sur les événements QTM (capture lancée depuis QTM ou avec 'l').
+    """
+    global event_trigger
+    event_trigger = QtmEventTrigger(connected_devices, verbose=verbose).arm()
+    if verbose:
+        print(f"🎯 Démarrage armé sur les événements QTM ({len(connected_devices)} capteur(s)).")
+    return event_trigger
+
+
+async def connect_to_qtm(host=DEFAULT_HOST, port=DEFAULT_PORT, password=None, timeout=10.0):
     """
     Se connecte à QTM et écoute les événements.
+    Doit tourner dans la boucle de session, qui possède ensuite la connexion :
+    elle est surveillée et rétablie en tâche de fond (avec nouvelle prise de contrôle si password).
     """
-    global qtm_connection
-    try:
-        print("🔗 Connexion à QTM...")
-        qtm_connection = await qtm_rt.connect(
-            "127.0.0.1",
-            on_event=lambda event: asyncio.create_task(on_event(event))
-        )
-        if qtm_connection is None:
-            print("🔴 Échec de la connexion à QTM.")
-            return
-
-        print("✅ Connexion à QTM établie. En attente des événements...")
-        while True:
-            await asyncio.sleep(0.1)
-    except Exception as e:
-        print(f"❌ Erreur lors de la connexion à QTM : {e}")
-
-
-def stop_execution():
+    global qtm_manager
+    print(f"🔗 Connexion à QTM ({host}:{port})...")
+    qtm_manager = QtmConnectionManager(host, port, password=password, on_event=on_event).start()
+    if await get_qtm_connection(timeout) is None:
+        print("🔴 QTM indisponible pour l'instant, nouvelles tentatives en tâche de fond.")
+        return False
+
+    print("✅ En attente des événements QTM...")
+    return True
+
+
+async def disconnect_from_qtm():
+    if qtm_manager is not None:
+        await qtm_manager.stop()
+        print("✅ Déconnecté de QTM.")
+
+
+async def stop_execution():
     """
     Fonction pour arrêter le programme proprement.
     """
     print("❌ Arrêt du programme...")
-    asyncio.run(stop_synchronized_recording(verbose=True))  # Arrêter les Xsens
-    asyncio.run(stop_qtm_capture())  # Arrêter QTM
-    sys.exit(0)  # Quitter le script proprement
+    if event_trigger is not None:
+        await stop_synchronized_recording(verbose=True)  # Arrêter QTM, puis les Xsens sur l'événement
+        event_trigger.print_latency_report()
+        event_trigger.shutdown()
+        return
+    await stop_synchronized_recording(verbose=True)  # Arrêter les Xsens
+    await stop_qtm_capture()  # Arrêter QTM
 
 
-def user_input_listener():
+async def user_input_listener(command_port=5555):
     """
-    Écoute les touches 'l' (lancer enregistrement), 's' (stopper enregistrement), et 'q' (quitter).
+    Écoute les commandes 'l' (lancer enregistrement), 's' (stopper enregistrement), et 'q' (quitter).
+    Les commandes arrivent du clavier, de stdin ou d'une socket locale, sans scrutation.
     """
     print("🔹 Appuyez sur 'l' pour démarrer l'enregistrement des Xsens et QTM")
     print("🔹 Appuyez sur 's' pour arrêter l'enregistrement des Xsens")
+    print("🔹 Appuyez sur 'e' pour exporter les enregistrements des Xsens")
     print("🔹 Appuyez sur 'q' pour quitter le programme")
 
-    while True:
-        try:
-            if keyboard.is_pressed("l"):
-                print("⌛ Démarrage enregistrement...")
-                asyncio.run(start_synchronized_recording(
-                    duration=5000, verbose=True))
-            elif keyboard.is_pressed("s"):
-                print("🛑 Arrêt enregistrement...")
-                asyncio.run(stop_synchronized_recording(verbose=True))
-            elif keyboard.is_pressed("q"):
-                print("❌ Arrêt du programme...")
-                stop_execution()
-            time.sleep(0.2)  # Petit délai pour éviter trop de déclenchements
-        except:
-            pass
+    queue = CommandQueue()
+    hooks = attach_terminal(queue, ("l", "s", "e", "q"))
+    server = await start_socket_server(queue, port=command_port)
+
+    handlers = {
+        "l": lambda: start_synchronized_recording(verbose=True),
+        "s": lambda: stop_synchronized_recording(verbose=True),
+        "e": lambda: export_xsens_recordings(verbose=True),
+        "q": stop_execution,
+    }
+    try:
+        await queue.dispatch(handlers, stop_commands=("q",))
+    finally:
+        server.close()
+        for hook in hooks:
+            keyboard.unhook(hook)
+        queue.print_latency_report()
 
 
 if __name__ == "__main__":
     verbose = True
+    instrumentation.enable(True)  # Latences par étape, exportées en fin de session
+    parser = argparse.ArgumentParser(description="Enregistrement Movella DOT déclenché par QTM")
+    parser.add_argument("--profile", default="default",
+                        help="Profil de capteurs enregistré (sélection au clavier à la première session)")
+    parser.add_argument("--reset-profile", action="store_true",
+                        help="Oublier le profil et choisir les capteurs au clavier")
+    parser.add_argument("--forget", action="append", default=[], metavar="ADRESSE",
+                        help="Retirer un capteur du profil (option répétable)")
+    args = parser.parse_args()
+    profile = args.profile
+    registry = SensorRegistry()
+    for address in args.forget:
+        if not registry.forget(address, profile=profile):
+            print(f"⚠️ {address} absent du profil {profile}.")
+    if args.reset_profile:
+        registry.reset_profile(profile)
+    expected_addresses = registry.profile(profile)
+
     initialize_sdk(verbose=verbose)
-    detected_dots = scan_for_dots(scan_duration=1000, verbose=verbose)
-    connect_dots(detected_dots, verbose=verbose)
+    detected_dots = scan_for_dots(scan_duration=60, verbose=verbose,
+                                  expected_addresses=expected_addresses)
+    connect_dots(detected_dots, verbose=verbose, addresses=expected_addresses)
+    registry.remember(connected_devices, profile=profile)
     synchronize_devices(verbose=verbose)
 
-    # Lancer l'écoute de QTM en parallèle
-    qtm_thread = threading.Thread(
-        target=asyncio.run, args=(connect_to_qtm(),), daemon=True)
-    qtm_thread.start()
+    # Une seule boucle pour toute la session : connexion QTM, commandes et événements
+    session = SessionLoop().start()
+    if session.call(connect_to_qtm()):
+        session.call(enable_event_trigger(verbose=verbose))
 
-    # Lancer l'écoute des entrées utilisateur
-    user_input_listener()
+    # Lancer l'écoute des entrées utilisateur dans la boucle de session
+    session.call(user_input_listener())
+    session.call(disconnect_from_qtm())
+    session.stop()
+    instrumentation.dump(time.strftime("timings_%Y%m%d_%H%M%S.json"), n_devices=len(connected_devices))
+    sys.exit(0)  # Quitter le script proprement
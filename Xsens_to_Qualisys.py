@@ -1,13 +1,43 @@
+import argparse
 import asyncio
+import os
+import time
 import qtm_rt
 import sys
 import keyboard
 from xdpchandler import XdpcHandler
+from dot_connect import connect_devices
+from dot_registry import SensorRegistry, targeted_scan, timed_scan, select_by_addresses
+from sync_supervisor import SyncSupervisor
+from dot_commands import get_fan_out
+import instrumentation
+from dot_stream import DotStreamer
+from qtm_stream import start_frame_stream, stop_frame_stream
+from qtm_connection import QtmConnectionManager, DEFAULT_HOST, DEFAULT_PORT
+from clock_alignment import align_streams
+from health_monitor import HealthMonitor
+from heading_fusion import HeadingFusion, FUSION_DTYPE, fusion_stream_name
+from gap_filling import GapFiller, GAP_DTYPE, dense_stream_name, write_dense
+from publish_server import FramePublisher
+from session_file import SessionWriter
+from dot_export import export_recordings
+from command_queue import CommandQueue, attach_terminal, start_socket_server
 
 # Initialisation des variables
 xdpc_handler = None
 connected_devices = []
-qtm_connection = None  # Stocke la connexion à QTM
+connect_times = {}  # Temps de connexion par adresse Bluetooth
+qtm_manager = None  # Connexion QTM supervisée (reconnexion et reprise de contrôle automatiques)
+dot_streamer = None  # Streaming temps réel des capteurs
+qtm_frames = None  # Trames QTM reçues en streaming
+qtm_settings = None  # Paramètres QTM lus au démarrage du streaming
+start_markers = {}  # Horodatages perf_counter_ns des acquittements de démarrage
+sync_root = None  # Adresse du capteur maître de la synchronisation
+session_writer = None  # Fichier de session (mode streaming)
+heading_fusion = None  # Correction de cap IMU par les corps rigides QTM (mode streaming)
+health_monitor = None  # Batterie, liaison et paquets perdus des capteurs
+gap_filler = None  # Détection et comblement des trous du streaming DOT (mode streaming)
+publisher = None  # Diffusion en direct des trames DOT + QTM aux abonnés locaux
 
 
 def initialize_sdk():
@@ -22,15 +52,23 @@ def initialize_sdk():
     print("🟢 SDK initialisé avec succès.")
 
 
-def scan_for_dots(scan_duration=60, verbose=True):
+def scan_for_dots(scan_duration=60, verbose=True, expected_addresses=None):
+    """
+    Scanne les capteurs pendant scan_duration secondes. Avec expected_addresses (profil enregistré),
+    le scan s'arrête dès que tous les capteurs attendus sont détectés.
+    """
     global xdpc_handler
 
     if verbose:
         print(
             f"Lancement du scan des capteurs pour {scan_duration} secondes...")
 
-    xdpc_handler.scanForDots()
-    detected_dots = xdpc_handler.detectedDots()
+    with instrumentation.span("dot.scan"):
+        if expected_addresses:
+            detected_dots, _ = targeted_scan(xdpc_handler, expected_addresses,
+                                             timeout=scan_duration, verbose=verbose)
+        else:
+            detected_dots = timed_scan(xdpc_handler, scan_duration, verbose=verbose)
 
     if not detected_dots:
         if verbose:
@@ -46,43 +84,46 @@ def scan_for_dots(scan_duration=60, verbose=True):
     return detected_dots
 
 
-def connect_dots(detected_dots, verbose=True):
-    global xdpc_handler, connected_devices
-
-    if verbose:
-        print("Sélectionnez les capteurs à connecter :")
-
-    for i, device in enumerate(detected_dots):
-        print(f"{i + 1}. Adresse Bluetooth : {device.bluetoothAddress()}")
+def connect_dots(detected_dots, verbose=True, parallel=True, max_workers=4, max_retries=2,
+                 addresses=None):
+    """
+    Connecte les capteurs sélectionnés.
+    En mode parallèle, les ports sont ouverts par un pool de threads borné
+    et les capteurs en échec sont retentés sans bloquer les autres.
+    addresses : adresses d'un profil enregistré (connexion sans saisie), None pour choisir au clavier.
+    """
+    global xdpc_handler, connected_devices, connect_times
 
-    selected_indices = input(
-        "Entrez les indices des capteurs à connecter (séparés par des virgules) : ")
-    selected_indices = [
-        int(i.strip()) - 1 for i in selected_indices.split(",") if i.strip().isdigit()]
+    if addresses is not None:
+        device_infos = select_by_addresses(detected_dots, addresses)
+        if verbose:
+            print(f"Connexion au profil enregistré ({len(device_infos)}/{len(addresses)} capteurs détectés).")
+            if len(device_infos) < len(addresses):
+                print("💡 Capteur hors service : --forget ADRESSE le retire du profil, "
+                      "--reset-profile refait la sélection au clavier.")
+    else:
+        if verbose:
+            print("Sélectionnez les capteurs à connecter :")
 
-    connected_devices = []
+        for i, device in enumerate(detected_dots):
+            print(f"{i + 1}. Adresse Bluetooth : {device.bluetoothAddress()}")
 
-    for index in selected_indices:
-        if 0 <= index < len(detected_dots):
-            device_info = detected_dots[index]
-            if verbose:
-                print(
-                    f"Connexion au capteur : {device_info.bluetoothAddress()}...")
+        selected_indices = input(
+            "Entrez les indices des capteurs à connecter (séparés par des virgules) : ")
+        selected_indices = [
+            int(i.strip()) - 1 for i in selected_indices.split(",") if i.strip().isdigit()]
 
-            if not xdpc_handler.manager().openPort(device_info):
-                if verbose:
-                    print(
-                        f"Échec de la connexion au capteur : {device_info.bluetoothAddress()}.")
+        device_infos = []
+        for index in selected_indices:
+            if 0 <= index < len(detected_dots):
+                device_infos.append(detected_dots[index])
             else:
-                device = xdpc_handler.manager().device(device_info.deviceId())
-                if device:
-                    if verbose:
-                        print(
-                            f"Connecté au capteur : {device.deviceTagName()} ({device.bluetoothAddress()}).")
-                    connected_devices.append(device)
-        else:
-            if verbose:
-                print(f"Index invalide : {index + 1}. Capteur ignoré.")
+                if verbose:
+                    print(f"Index invalide : {index + 1}. Capteur ignoré.")
+
+    connected_devices, connect_times = connect_devices(
+        xdpc_handler, device_infos, parallel=parallel, max_workers=max_workers,
+        max_retries=max_retries, verbose=verbose)
 
     if verbose:
         print(f"{len(connected_devices)} capteur(s) connecté(s) avec succès.")
@@ -90,150 +131,348 @@ def connect_dots(detected_dots, verbose=True):
     return connected_devices
 
 
-def synchronize_devices(verbose=True, max_retries=3):
-    global xdpc_handler, connected_devices
+def synchronize_devices(verbose=True, max_retries=10):
+    """
+    Synchronise les capteurs connectés (maître choisi selon la qualité de liaison).
+    Un capteur qui bloque la synchronisation est reconnecté ou retiré, et les autres sont resynchronisés.
+    """
+    global xdpc_handler, connected_devices, sync_root
 
     if len(connected_devices) < 2:
         if verbose:
             print("La synchronisation nécessite au moins deux capteurs connectés.")
         return False
 
-    xdpc_handler.manager().stopSync()
-    root_device = connected_devices[0]
-    root_address = root_device.bluetoothAddress()
+    supervisor = SyncSupervisor(xdpc_handler, connected_devices, connect_times,
+                                max_attempts=max_retries, verbose=verbose)
+    success = supervisor.run()
+    connected_devices = supervisor.devices  # Sans les capteurs retirés
+    sync_root = supervisor.root
 
     if verbose:
-        print(f"Capteur maître pour la synchronisation : {root_address}")
-
-    success = False
-    for attempt in range(max_retries):
-        if verbose:
-            print(
-                f"Tentative de synchronisation ({attempt + 1}/{max_retries})...")
-
-        if xdpc_handler.manager().startSync(root_address):
-            success = True
-            if verbose:
-                print("Synchronisation réussie !")
-            break
-        else:
-            if verbose:
-                print(
-                    f"Échec de la synchronisation. Raison : {xdpc_handler.manager().lastResultText()}")
-
-    if not success and verbose:
-        print("Échec de la synchronisation après plusieurs tentatives.")
+        supervisor.report()
 
     return success
 
 
-async def connect_to_qtm():
-    """Connexion à QTM"""
-    global qtm_connection
-    print("🔗 Connexion à QTM...")
-    qtm_connection = await qtm_rt.connect("127.0.0.1")
-    if qtm_connection is None:
-        print("🔴 Échec de la connexion à QTM.")
+async def get_qtm_connection(timeout=5.0):
+    """
+    Connexion QTM prête (attend la reconnexion en cours si besoin), None si QTM est indisponible.
+    """
+    if qtm_manager is None:
+        return None
+    try:
+        return await qtm_manager.wait_ready(timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def connect_to_qtm(host=DEFAULT_HOST, port=DEFAULT_PORT, password=None, timeout=10.0):
+    """Connexion à QTM, surveillée et rétablie en tâche de fond (avec reprise de contrôle si password)"""
+    global qtm_manager
+    print(f"🔗 Connexion à QTM ({host}:{port})...")
+    qtm_manager = QtmConnectionManager(host, port, password=password).start()
+    if await get_qtm_connection(timeout) is None:
+        print("🔴 QTM indisponible pour l'instant, nouvelles tentatives en tâche de fond.")
         return False
     print("🟢 Connecté à QTM.")
     return True
 
 
 async def take_control(password="Kiks"):
-    """Prendre le contrôle de QTM"""
-    global qtm_connection
-    if qtm_connection is None:
+    """Prendre le contrôle de QTM (repris automatiquement après chaque reconnexion)"""
+    connection = await get_qtm_connection()
+    if connection is None:
         print("⚠️ Impossible de prendre le contrôle : connexion QTM absente.")
         return False
 
-    success = await qtm_connection.take_control(password)
-    if success:
-        print("🟢 Contrôle pris sur QTM.")
-        return True
-    else:
+    qtm_manager.password = password
+    try:
+        with instrumentation.span("qtm.take_control"):
+            await connection.take_control(password)
+    except qtm_rt.QRTCommandException:
         print("🔴 Échec de la prise de contrôle.")
         return False
+    print("🟢 Contrôle pris sur QTM.")
+    return True
 
 
-async def start_streaming():
-    """Démarrer le streaming de QTM"""
-    global qtm_connection
-    if qtm_connection is None:
+async def start_streaming(frames=True, duration=600, rtfromfile=False):
+    """Démarrer le streaming de QTM (frames=True : abonnement aux trames 3D/6DOF/timecode)
+    rtfromfile=True : QTM rejoue en temps réel la mesure chargée au lieu de capturer"""
+    global qtm_frames, qtm_settings
+    connection = await get_qtm_connection()
+    if connection is None:
         print("⚠️ Impossible de démarrer le streaming : connexion QTM absente.")
         return False
     print("📡 Démarrage du streaming...")
-    await qtm_connection.start(rtfromfile=False)
+    with instrumentation.span("qtm.start"):
+        await connection.start(rtfromfile=rtfromfile)
+    start_markers["qtm_ack_ns"] = time.perf_counter_ns()  # Repère pour l'alignement d'horloge
+    if frames:
+        qtm_frames, qtm_settings = await start_frame_stream(connection, duration)
     print("🟢 Streaming en cours...")
 
 
 async def stop_streaming():
     """Arrêter le streaming de QTM"""
-    global qtm_connection
-    if qtm_connection is None:
+    connection = await get_qtm_connection()
+    if connection is None:
         print("⚠️ Impossible d'arrêter le streaming : connexion QTM absente.")
         return False
     print("🛑 Arrêt du streaming...")
-    await qtm_connection.stop()
+    if qtm_frames is not None:
+        await stop_frame_stream(connection, qtm_frames)
+    with instrumentation.span("qtm.stop"):
+        await connection.stop()
     print("🔴 Streaming arrêté.")
 
 
 def start_xsens_recording():
     """Démarrer l'enregistrement des capteurs Movella DOT"""
     print("▶️ Démarrage de l'enregistrement des IMUs...")
-    for device in connected_devices:
-        device.startRecording()
+    result = get_fan_out(connected_devices).run("startRecording")
+    result.report()
     print("🟢 Enregistrement en cours...")
+    return result
 
 
 def stop_xsens_recording():
     """Arrêter l'enregistrement des capteurs Movella DOT"""
     print("🛑 Arrêt de l'enregistrement des IMUs...")
-    for device in connected_devices:
-        device.stopRecording()
+    result = get_fan_out(connected_devices).run("stopRecording")
+    result.report()
     print("🔴 Enregistrement arrêté.")
-
-
-async def main():
-    """Fonction principale"""
-    global qtm_connection
+    return result
+
+
+def start_xsens_streaming(output_rate=60):
+    """Démarrer le streaming temps réel des capteurs Movella DOT vers les tampons circulaires"""
+    global dot_streamer
+    print("▶️ Démarrage du streaming des IMUs...")
+    dot_streamer = DotStreamer(connected_devices)
+    dot_streamer.attach(xdpc_handler)
+    if health_monitor is not None:
+        health_monitor.track(dot_streamer)
+    result = dot_streamer.start(output_rate)
+    print("🟢 Streaming des IMUs en cours...")
+    return result
+
+
+def stop_xsens_streaming():
+    """Arrêter le streaming temps réel des capteurs Movella DOT (les tampons restent lisibles)"""
+    print("🛑 Arrêt du streaming des IMUs...")
+    result = dot_streamer.stop()
+    dot_streamer.detach()
+    print("🔴 Streaming des IMUs arrêté.")
+    return result
+
+
+def open_session(output_dir, output_rate=60, name=None, devices=None):
+    """Créer le fichier de session (métadonnées, schéma par capteur et pour QTM)
+    name : nom du dossier de session (par défaut session_<date>_<heure>)
+    devices : adresse -> nom des capteurs (par défaut les capteurs connectés)
+    Les flux dense_<adresse> reçoivent les échantillons DOT sans trous (comblés ou marqués manquants)"""
+    global session_writer, gap_filler
+    if devices is None:
+        devices = {device.bluetoothAddress(): device.deviceTagName() for device in connected_devices}
+    path = os.path.join(output_dir, name or time.strftime("session_%Y%m%d_%H%M%S"))
+    session_writer = SessionWriter(path, {
+        "sync_root": sync_root,
+        "devices": devices,
+        "dot_output_rate": output_rate,
+        "qtm_capture": qtm_settings,
+    })
+    for address, tag in devices.items():
+        session_writer.add_dot_device(address, tag, output_rate)
+    if qtm_frames is not None:
+        session_writer.add_qtm(qtm_settings["marker_labels"], qtm_settings["body_names"],
+                               qtm_settings["frequency"])
+    gap_filler = GapFiller(list(devices), output_rate)
+    for address in gap_filler.addresses:
+        session_writer.add_stream(dense_stream_name(address), GAP_DTYPE, kind="dense", address=address,
+                                  output_rate=output_rate)
+    print(f"💾 Session enregistrée dans {path}")
+    return session_writer
+
+
+def start_health_monitor(poll_interval=30.0):
+    """Lancer la surveillance des capteurs en tâche de fond (à appeler depuis la boucle asyncio)"""
+    global health_monitor
+    health_monitor = HealthMonitor(connected_devices, poll_interval=poll_interval).attach(xdpc_handler)
+    asyncio.get_running_loop().create_task(health_monitor.run())
+    return health_monitor
+
+
+async def start_publisher(port=5556, rate=60.0):
+    """Diffuser en direct les trames DOT + QTM courantes aux abonnés TCP locaux (boucle asyncio de la session)"""
+    global publisher
+    publisher = await FramePublisher(lambda: (dot_streamer, qtm_frames, qtm_settings),
+                                     port=port, rate=rate).start()
+    return publisher
+
+
+def start_fusion(body_map, mounts=None, time_constant=2.0):
+    """Activer la correction de cap des IMUs par les corps rigides QTM (flux fused_<adresse> de la session)"""
+    global heading_fusion
+    heading_fusion = HeadingFusion(body_map, qtm_settings["body_names"], mounts=mounts,
+                                   time_constant=time_constant, start_markers=start_markers)
+    for address in heading_fusion.addresses:
+        session_writer.add_stream(fusion_stream_name(address), FUSION_DTYPE, kind="fusion",
+                                  address=address, body=body_map[address])
+    print(f"🧭 Correction de cap active pour {len(heading_fusion.addresses)} capteur(s).")
+    return heading_fusion
+
+
+def _drain_once(final=False):
+    with instrumentation.span("session.drain"):
+        lost = session_writer.drain(dot_streamer, qtm_frames)
+    with instrumentation.span("session.gaps"):
+        write_dense(session_writer, gap_filler, dot_streamer, final=final)
+    if heading_fusion is not None:
+        with instrumentation.span("session.fusion"):
+            for address, records in heading_fusion.update(dot_streamer, qtm_frames).items():
+                session_writer.append(fusion_stream_name(address), records)
+    return lost
+
+
+async def drain_session(stop_event, period=0.5):
+    """Écrire périodiquement les nouveaux échantillons des tampons dans le fichier de session"""
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        lost = await loop.run_in_executor(None, _drain_once)
+        if lost:
+            print(f"⚠️ {lost} échantillon(s) DOT écrasé(s) avant écriture sur disque.")
+        try:
+            await asyncio.wait_for(stop_event.wait(), period)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main(command_port=5555, live=False, body_map=None, output_dir=".", export=True,
+               timings=True, profile="default", qtm_host=DEFAULT_HOST, qtm_port=DEFAULT_PORT,
+               qtm_password="Kiks", publish_port=5556):
+    """Fonction principale (live=True : streaming temps réel des IMUs au lieu de l'enregistrement embarqué)
+    body_map : adresse Bluetooth -> corps rigide QTM, pour la correction de cap en direct (live)
+               et l'alignement d'horloge en fin de session
+    export : export des enregistrements embarqués dans output_dir après l'arrêt
+    timings : latences par étape (p50/p95/p99) exportées en JSON dans output_dir en fin de session
+    profile : profil de capteurs enregistré (scan ciblé et connexion sans saisie), None pour choisir au clavier
+    qtm_host, qtm_port, qtm_password : connexion QTM (contrôle repris automatiquement après une reconnexion)
+    publish_port : port de diffusion des trames fusionnées en mode streaming (None pour désactiver)"""
+    global connected_devices
+    instrumentation.enable(timings)
 
     # Initialisation et connexion aux capteurs
+    registry = SensorRegistry()
+    expected_addresses = registry.profile(profile) if profile else None
     initialize_sdk()
-    detected_dots = scan_for_dots()
-    connected_devices = connect_dots(detected_dots)
+    detected_dots = scan_for_dots(expected_addresses=expected_addresses)
+    connected_devices = connect_dots(detected_dots, addresses=expected_addresses)
+    registry.remember(connected_devices, profile=profile)
     synchronize_devices(connected_devices)
 
     # Connexion à QTM et prise de contrôle
-    await connect_to_qtm()
-    await take_control()
-
-    # Boucle principale d'attente des commandes
-    while True:
-        print("🔹 Appuyez sur 'r' pour démarrer l'enregistrement.")
-        print("🔹 Appuyez sur 's' pour arrêter l'enregistrement.")
-
-        key = keyboard.read_event().name  # Attente d'une touche
-        if key == "r":
-
-            start_xsens_recording()  # Lance les IMUs
+    await connect_to_qtm(qtm_host, qtm_port, password=qtm_password)
+    start_health_monitor()
+    if live and publish_port is not None:
+        await start_publisher(publish_port)
+
+    # Boucle principale d'attente des commandes (clavier, stdin ou socket locale)
+    print("🔹 Appuyez sur 'r' pour démarrer l'enregistrement.")
+    print("🔹 Appuyez sur 's' pour arrêter l'enregistrement.")
+
+    async def start_all():
+        await health_monitor.preflight()  # Avertissements batterie / liaison avant le démarrage
+        loop = asyncio.get_running_loop()
+        async with health_monitor.lock:  # Pas d'interrogation des capteurs pendant le démarrage
+            # Commandes DOT bloquantes hors de la boucle (qui porte la connexion QTM)
+            if live:
+                result = await loop.run_in_executor(None, start_xsens_streaming)  # Lance le streaming des IMUs
+            else:
+                result = await loop.run_in_executor(None, start_xsens_recording)  # Lance les IMUs
+            start_markers["dot_ack_ns"] = result.first_ack_ns
             await start_streaming()  # Lance le streaming
-            print("✅ Enregistrement et streaming démarrés.")
-
-        elif key == "s":
-            stop_xsens_recording()  # Arrête les IMUs
+            if live:
+                open_session(output_dir)
+                if body_map and qtm_frames is not None:
+                    start_fusion(body_map)
+                drain_tasks.append(asyncio.create_task(drain_session(drain_stop)))
+        print("✅ Enregistrement et streaming démarrés.")
+
+    async def stop_all():
+        loop = asyncio.get_running_loop()
+        async with health_monitor.lock:  # Ni pendant l'arrêt
+            if live:
+                await loop.run_in_executor(None, stop_xsens_streaming)  # Arrête le streaming des IMUs
+            else:
+                await loop.run_in_executor(None, stop_xsens_recording)  # Arrête les IMUs
             await stop_streaming()  # Arrête le streaming
-            print("✅ Enregistrement et streaming arrêtés.")
-            break
+            drain_stop.set()
+            await asyncio.gather(*drain_tasks)  # Attendre la fin de l'écriture en cours
+        print("✅ Enregistrement et streaming arrêtés.")
+
+    drain_tasks = []
+    drain_stop = asyncio.Event()
+    queue = CommandQueue()
+    hooks = attach_terminal(queue, ("r", "s"))
+    server = await start_socket_server(queue, port=command_port)
+    await queue.dispatch({"r": start_all, "s": stop_all}, stop_commands=("s",))
+    server.close()
+    for hook in hooks:
+        keyboard.unhook(hook)
+    queue.print_latency_report()
+
+    # Export des enregistrements embarqués (un worker par capteur)
+    if export and not live:
+        await asyncio.get_running_loop().run_in_executor(
+            None, export_recordings, xdpc_handler, connected_devices, output_dir)
+
+    if live and session_writer is not None:
+        # Derniers échantillons, puis alignement d'horloge DOT -> QTM dans les métadonnées
+        try:
+            _drain_once(final=True)
+            gap_filler.report()
+            if heading_fusion is not None:
+                heading_fusion.report()
+            if body_map and qtm_frames is not None and start_markers.get("dot_ack_ns"):
+                alignment = align_streams(dot_streamer, qtm_frames, body_map,
+                                          qtm_settings["body_names"], start_markers)
+                session_writer.set_metadata(
+                    alignment={address: result.to_dict() for address, result in alignment.items()})
+        finally:
+            session_writer.close()
 
     # Fermeture propre de tout les programmes (Dé-synchronisation, déconnexion, etc.)
-    qtm_connection.disconnect()
+    health_monitor.stop()
+    health_monitor.report()
+    if publisher is not None:
+        await publisher.stop()
+        publisher.report()
+    await qtm_manager.stop()
     print("✅ Déconnecté de QTM.")
     xdpc_handler.manager().stopSync()
     print("✅ Synchronisation des capteurs arrêtée.")
     xdpc_handler.cleanup()
     print("✅ SDK Movella DOT fermé.")
+    if timings:
+        instrumentation.dump(os.path.join(output_dir, time.strftime("timings_%Y%m%d_%H%M%S.json")),
+                             live=live, n_devices=len(connected_devices))
     sys.exit(0)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Enregistrement synchronisé Movella DOT / QTM")
+    parser.add_argument("--profile", default="default", help="Profil de capteurs enregistré")
+    parser.add_argument("--reset-profile", action="store_true",
+                        help="Oublier le profil et choisir les capteurs au clavier")
+    parser.add_argument("--forget", action="append", default=[], metavar="ADRESSE",
+                        help="Retirer un capteur du profil (option répétable)")
+    args = parser.parse_args()
+    registry = SensorRegistry()
+    for address in args.forget:
+        if not registry.forget(address, profile=args.profile):
+            print(f"⚠️ {address} absent du profil {args.profile}.")
+    if args.reset_profile:
+        registry.reset_profile(args.profile)
+    asyncio.run(main(profile=args.profile))
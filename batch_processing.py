@@ -0,0 +1,236 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from clock_alignment import align_session
+from exported_trial import DOT_EXPORT_PATTERN, ExportedTrialReader, exported_trial_files
+from resampling import resample_session
+from session_file import METADATA_FILE, SessionReader
+
+""" Post-traitement par lots des sessions archivées :
+- Recherche des dossiers de session (session.json) et des essais embarqués exportés
+  (CSV DOT de dot_export et exports TSV de QTM) sous un ou plusieurs répertoires
+- Un processus par cœur. Chaque worker projette les flux de sa session en mémoire (np.memmap) ;
+  les exports texte d'un essai embarqué sont convertis une fois en .npy (cache par empreinte
+  du contenu) puis projetés de la même façon
+- Alignement d'horloge recalculé (si les corps rigides sont connus), rééchantillonnage
+  sur une grille commune et fusion DOT + QTM
+- Un fichier merged.npz par essai, accompagné de merged.json (empreinte, paramètres, alignement)
+- Cache par empreinte du contenu (fichiers de la session et paramètres) : les essais
+  inchangés ne sont pas retraités
+Le fichier .qtm d'un essai embarqué n'est pas lisible hors de QTM : ses trajectoires 3D et
+corps rigides 6D doivent être exportés en TSV depuis QTM dans le dossier de l'essai.
+"""
+
+PIPELINE_VERSION = 1  # À incrémenter quand le traitement change (invalide tout le cache)
+MERGED_FILE = "merged.npz"
+MERGED_INFO = "merged.json"
+NPY_CACHE = ".npy_cache"  # Conversions .npy des essais exportés, dans le dossier de résultats
+
+
+def find_sessions(roots):
+    """
+    Dossiers de session (contenant session.json) ou d'essai exporté (CSV DOT de dot_export)
+    sous les répertoires donnés, triés.
+    """
+    sessions = []
+    for root in roots:
+        for directory, _, files in os.walk(root):
+            if METADATA_FILE in files or any(DOT_EXPORT_PATTERN.match(name) for name in files):
+                sessions.append(directory)
+    return sorted(sessions)
+
+
+def open_session(path, cache_dir=None):
+    """
+    SessionReader d'une session, ExportedTrialReader d'un essai exporté.
+    cache_dir : dossier des conversions .npy de l'essai exporté (None : lecture en mémoire)
+    """
+    if os.path.exists(os.path.join(path, METADATA_FILE)):
+        return SessionReader(path)
+    return ExportedTrialReader(path, cache_dir=cache_dir)
+
+
+def _npy_cache(path, output):
+    """
+    Dossier de conversion .npy d'un essai exporté, nommé d'après l'empreinte de son contenu
+    (sans les paramètres) ; les conversions d'un contenu précédent sont supprimées.
+    """
+    key = content_hash(path, {})
+    root = os.path.join(output, NPY_CACHE)
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            if name != key:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return os.path.join(root, key)
+
+
+def content_hash(path, params):
+    """
+    Empreinte du contenu d'une session (session.json et fichiers des flux) ou d'un essai
+    exporté (CSV et TSV), et des paramètres. Les fichiers sont projetés en mémoire et hachés sans copie.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps({"version": PIPELINE_VERSION, **params}, sort_keys=True).encode())
+    if os.path.exists(os.path.join(path, METADATA_FILE)):
+        with open(os.path.join(path, METADATA_FILE), "rb") as f:
+            metadata = f.read()
+        digest.update(metadata)
+        names = sorted(info["file"] for info in json.loads(metadata)["streams"].values())
+    else:
+        names = exported_trial_files(path)
+        digest.update(json.dumps(names).encode())
+    for name in names:
+        file_path = os.path.join(path, name)
+        if not os.path.exists(file_path) or not os.path.getsize(file_path):
+            continue
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            digest.update(m)
+    return digest.hexdigest()
+
+
+def _cached_hash(output):
+    try:
+        with open(os.path.join(output, MERGED_INFO), encoding="utf-8") as f:
+            return json.load(f).get("hash")
+    except (OSError, ValueError):
+        return None
+
+
+def _body_map(reader, body_map):
+    """
+    Corps rigides des capteurs : fournis, sinon ceux des flux de correction de cap de la session.
+    """
+    if body_map:
+        return body_map
+    return {info["address"]: info["body"] for info in reader.streams.values()
+            if info.get("kind") == "fusion" and "body" in info}
+
+
+def process_session(path, output, rate=100.0, max_gap_s=0.1, body_map=None, force=False):
+    """
+    Traite une session (exécuté dans un worker). Renvoie (chemin, état, durée en s).
+    état : "skipped" (empreinte inchangée), "done" ou "error: ..."
+    """
+    t0 = time.perf_counter()
+    params = {"rate": rate, "max_gap_s": max_gap_s, "body_map": body_map or {}}
+    digest = content_hash(path, params)
+    if not force and _cached_hash(output) == digest:
+        return path, "skipped", time.perf_counter() - t0
+
+    cache_dir = None
+    if not os.path.exists(os.path.join(path, METADATA_FILE)):
+        cache_dir = _npy_cache(path, output)
+    reader = open_session(path, cache_dir)
+    bodies = _body_map(reader, body_map)
+    if bodies and "qtm" in reader.streams:
+        alignment = align_session(reader, bodies, verbose=False)
+        reader.metadata.setdefault("alignment", {}).update(
+            {address: result.to_dict() for address, result in alignment.items()})
+    t, streams = resample_session(reader, rate=rate, max_gap_s=max_gap_s)
+
+    arrays = {"t": t}
+    for source, values in streams.items():
+        for key, value in values.items():
+            if key != "addresses":
+                arrays[f"{source}_{key}"] = value
+
+    os.makedirs(output, exist_ok=True)
+    tmp = os.path.join(output, MERGED_FILE + ".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, os.path.join(output, MERGED_FILE))
+    info = {
+        "hash": digest,
+        "source": os.path.abspath(path),
+        "params": params,
+        "version": PIPELINE_VERSION,
+        "addresses": streams.get("dot", {}).get("addresses", []),
+        "alignment": reader.metadata.get("alignment", {}),
+        "samples": len(t),
+        "processed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    # merged.json en dernier : un essai interrompu sera retraité
+    with open(os.path.join(output, MERGED_INFO + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    os.replace(os.path.join(output, MERGED_INFO + ".tmp"), os.path.join(output, MERGED_INFO))
+    return path, "done", time.perf_counter() - t0
+
+
+def _safe_process(path, output, rate, max_gap_s, body_map, force):
+    try:
+        return process_session(path, output, rate, max_gap_s, body_map, force)
+    except Exception as e:
+        return path, f"error: {type(e).__name__}: {e}", 0.0
+
+
+def process_archive(roots, output_dir=None, rate=100.0, max_gap_s=0.1, body_map=None,
+                    workers=None, force=False, verbose=True):
+    """
+    Traite toutes les sessions trouvées sous roots avec un pool de processus.
+    output_dir : dossier des résultats (arborescence des sessions reproduite),
+                 None pour écrire merged.npz dans chaque dossier de session.
+    Renvoie {chemin de session: (état, durée en s)}.
+    """
+    roots = [roots] if isinstance(roots, str) else list(roots)
+    sessions = find_sessions(roots)
+    if not sessions:
+        if verbose:
+            print("⚠️ Aucune session trouvée.")
+        return {}
+
+    def output_for(path):
+        if output_dir is None:
+            return path
+        path = os.path.abspath(path)
+        root = next(root for root in roots
+                    if os.path.commonpath([path, os.path.abspath(root)]) == os.path.abspath(root))
+        return os.path.join(output_dir, os.path.basename(os.path.abspath(root)),
+                            os.path.relpath(path, root))
+
+    workers = workers or os.cpu_count()
+    t0 = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(sessions))) as pool:
+        futures = [pool.submit(_safe_process, path, output_for(path), rate, max_gap_s, body_map, force)
+                   for path in sessions]
+        for future in as_completed(futures):
+            path, status, elapsed = future.result()
+            results[path] = (status, elapsed)
+            if verbose and status != "skipped":
+                icon = "✅" if status == "done" else "❌"
+                print(f"{icon} {path} : {status} ({elapsed:.2f} s)")
+
+    if verbose:
+        counts = {}
+        for status, _ in results.values():
+            key = status if status in ("done", "skipped") else "error"
+            counts[key] = counts.get(key, 0) + 1
+        print(f"📦 {len(sessions)} session(s) en {time.perf_counter() - t0:.1f} s "
+              f"avec {min(workers, len(sessions))} processus : {counts.get('done', 0)} traitée(s), "
+              f"{counts.get('skipped', 0)} inchangée(s), {counts.get('error', 0)} en erreur")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post-traitement par lots des sessions archivées")
+    parser.add_argument("roots", nargs="+", help="Répertoires contenant des sessions")
+    parser.add_argument("--output", default=None, help="Dossier des résultats (défaut : dans chaque session)")
+    parser.add_argument("--rate", type=float, default=100.0, help="Fréquence de la grille commune (Hz)")
+    parser.add_argument("--max-gap", type=float, default=0.1, help="Trou maximal interpolé (s)")
+    parser.add_argument("--body-map", default=None, help="Fichier JSON adresse -> corps rigide QTM")
+    parser.add_argument("--workers", type=int, default=None, help="Nombre de processus (défaut : cœurs)")
+    parser.add_argument("--force", action="store_true", help="Retraiter même les sessions inchangées")
+    args = parser.parse_args()
+    body_map = None
+    if args.body_map:
+        with open(args.body_map, encoding="utf-8") as f:
+            body_map = json.load(f)
+    process_archive(args.roots, args.output, args.rate, args.max_gap, body_map, args.workers, args.force)
@@ -0,0 +1,273 @@
+import argparse
+import builtins
+import contextlib
+import importlib
+import io
+import json
+import statistics
+import time
+
+import simulators
+from dot_shards import ShardedAcquisition
+from session_loop import SessionLoop
+
+""" Banc de mesure sans matériel (capteurs DOT et QTM simulés) :
+- Parcours complet de Xsens_Qualisys.py (enregistrement embarqué) et de Xsens_to_Qualisys.py (streaming)
+- Temps de connexion, latence déclenchement -> démarrage (DOT et QTM), décalage entre capteurs,
+  latence événement QTM -> premier acquittement DOT en mode déclenché
+- Débit soutenu (échantillons/s) et pertes, de 1 à 32 capteurs simulés
+- Acquisition répartie (un processus par adaptateur simulé) : débit et écart entre shards
+Le faux serveur QTM écoute par défaut sur le port RT de QTM (22223), --qtm-port pour en choisir un autre.
+"""
+
+
+@contextlib.contextmanager
+def _answer(text):
+    """
+    Répond automatiquement à input() (sélection des capteurs dans connect_dots).
+    """
+    previous = builtins.input
+    builtins.input = lambda prompt="": text
+    try:
+        yield
+    finally:
+        builtins.input = previous
+
+
+def _quiet(verbose):
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def _connect(flow, n_sensors):
+    """
+    Scan puis connexion de tous les capteurs simulés. Renvoie (durée totale, temps par capteur).
+    """
+    flow.initialize_sdk()
+    detected = flow.scan_for_dots(scan_duration=simulators.FakeXdpcHandler.config.scan_time + 0.05,
+                                  verbose=False)
+    t0 = time.perf_counter()
+    with _answer(",".join(str(i + 1) for i in range(n_sensors))):
+        flow.connect_dots(detected, verbose=False)
+    return time.perf_counter() - t0, dict(flow.connect_times)
+
+
+def _qtm_command_ns(server, command, after_ns):
+    """
+    Instant de réception d'une commande par le faux serveur QTM (perf_counter_ns).
+    """
+    for text, received_ns in server.command_log:
+        if received_ns >= after_ns and text.lower().startswith(command):
+            return received_ns
+    return None
+
+
+def bench_recording(n_sensors, server):
+    """
+    Parcours de Xsens_Qualisys.py : connexion, synchronisation, QTM, démarrage des DOTs
+    sur l'événement de capture QTM puis arrêt sur l'événement de fin de capture.
+    """
+    flow = importlib.reload(importlib.import_module("Xsens_Qualisys"))
+    connect_s, connect_times = _connect(flow, n_sensors)
+    flow.synchronize_devices(verbose=False)
+
+    session = SessionLoop("bench-session").start()
+    try:
+        session.call(flow.connect_to_qtm(port=server.port))
+        trigger = session.call(flow.enable_event_trigger(verbose=False))
+        trigger_ns = time.perf_counter_ns()
+        result = session.call(flow.start_synchronized_recording(verbose=False))
+        qtm_start_ns = _qtm_command_ns(server, "start", trigger_ns)
+        session.call(flow.stop_synchronized_recording(verbose=False))
+    finally:
+        if flow.qtm_manager is not None:
+            session.call(flow.qtm_manager.stop())
+        if flow.event_trigger is not None:
+            flow.event_trigger.shutdown()
+        session.stop()
+        flow.xdpc_handler.cleanup()
+
+    return {
+        "connect_s": connect_s,
+        "connect_device_s": statistics.median(connect_times.values()),
+        "dot_start_ms": (result.first_ack_ns - trigger_ns) / 1e6 if result.acks else None,
+        "skew_ms": result.skew_ns / 1e6 if result.acks else None,
+        "qtm_start_ms": (qtm_start_ns - trigger_ns) / 1e6 if qtm_start_ns else None,
+        "event_to_ack_ms": trigger.latencies_ns[-1] / 1e6 if trigger.latencies_ns else None,
+        "failures": len(result.failures),
+    }
+
+
+def bench_streaming(n_sensors, server, stream_seconds=3.0, output_rate=60):
+    """
+    Parcours de Xsens_to_Qualisys.py en streaming : débit soutenu des IMUs et des trames QTM.
+    """
+    flow = importlib.reload(importlib.import_module("Xsens_to_Qualisys"))
+    connect_s, connect_times = _connect(flow, n_sensors)
+    flow.synchronize_devices(verbose=False)
+
+    session = SessionLoop("bench-session").start()
+    try:
+        session.call(flow.connect_to_qtm(port=server.port, password="bench"))
+        trigger_ns = time.perf_counter_ns()
+        result = flow.start_xsens_streaming(output_rate)
+        session.call(flow.start_streaming(duration=stream_seconds + 5))
+        qtm_start_ns = _qtm_command_ns(server, "start", trigger_ns)
+
+        # Débit mesuré après la mise en route (compteurs absolus des tampons)
+        time.sleep(0.5)
+        buffers = flow.dot_streamer.buffers.values()
+        dot_before = sum(buffer.count for buffer in buffers)
+        qtm_before = flow.qtm_frames.count
+        t0 = time.perf_counter()
+        time.sleep(stream_seconds)
+        elapsed = time.perf_counter() - t0
+        dot_samples = sum(buffer.count for buffer in buffers) - dot_before
+        qtm_samples = flow.qtm_frames.count - qtm_before
+
+        flow.stop_xsens_streaming()
+        session.call(flow.stop_streaming())
+    finally:
+        if flow.qtm_manager is not None:
+            session.call(flow.qtm_manager.stop())
+        session.stop()
+        flow.xdpc_handler.cleanup()
+
+    devices = flow.xdpc_handler.connectedDots()
+    sent = sum(device.sent_packets for device in devices)
+    received = sum(buffer.count for buffer in flow.dot_streamer.buffers.values())
+    return {
+        "connect_s": connect_s,
+        "connect_device_s": statistics.median(connect_times.values()),
+        "dot_start_ms": (result.first_ack_ns - trigger_ns) / 1e6 if result.acks else None,
+        "skew_ms": result.skew_ns / 1e6 if result.acks else None,
+        "qtm_start_ms": (qtm_start_ns - trigger_ns) / 1e6 if qtm_start_ns else None,
+        "dot_samples_per_s": dot_samples / elapsed,
+        "expected_samples_per_s": n_sensors * output_rate,
+        "qtm_frames_per_s": qtm_samples / elapsed,
+        "dropped_in_callbacks": sent - received,
+        "qtm_frames_dropped": flow.qtm_frames.dropped,
+    }
+
+
+def _simulate_adapter(index, config, sizes):
+    """
+    Initialisation d'un shard : adaptateur simulé ne voyant que ses propres capteurs.
+    """
+    config.first_index = sum(sizes[:index])
+    config.n_sensors = sizes[index]
+    simulators.install(config)
+
+
+def bench_sharded(n_sensors, config, n_shards=2, stream_seconds=3.0, output_rate=60):
+    """
+    Acquisition répartie (dot_shards) : connexion, synchronisation et streaming par shard.
+    """
+    n_shards = max(1, min(n_shards, n_sensors))
+    sizes = [n_sensors // n_shards + (k < n_sensors % n_shards) for k in range(n_shards)]
+    acquisition = ShardedAcquisition([[] for _ in sizes], initializer=_simulate_adapter,
+                                     initargs=(config, sizes), verbose=False)
+    try:
+        acquisition.start()
+        t0 = time.perf_counter()
+        acquisition.connect()
+        connect_s = time.perf_counter() - t0
+        acquisition.synchronize()
+        trigger_ns = time.perf_counter_ns()
+        result = acquisition.start_streaming(output_rate)
+
+        time.sleep(0.5)
+        buffers = acquisition.buffers.values()
+        dot_before = sum(buffer.count for buffer in buffers)
+        t0 = time.perf_counter()
+        time.sleep(stream_seconds)
+        elapsed = time.perf_counter() - t0
+        dot_samples = sum(buffer.count for buffer in buffers) - dot_before
+        acquisition.stop_streaming()
+    finally:
+        acquisition.close()
+
+    return {
+        "connect_s": connect_s,
+        "dot_start_ms": (result.first_ack_ns - trigger_ns) / 1e6 if result.acks else None,
+        "skew_ms": result.skew_ns / 1e6 if result.acks else None,
+        "shard_skew_ms": result.shard_skew_ns / 1e6,
+        "qtm_start_ms": None,
+        "dot_samples_per_s": dot_samples / elapsed,
+        "expected_samples_per_s": n_sensors * output_rate,
+    }
+
+
+def _format(value, pattern):
+    return "-" if value is None else pattern.format(value)
+
+
+def print_report(results):
+    print(f"{'parcours':<10} {'capteurs':>8} {'connexion':>10} {'DOT start':>10} {'décalage':>9} "
+          f"{'QTM start':>10} {'éch./s':>14}")
+    for row in results:
+        rate = "-"
+        if "dot_samples_per_s" in row:
+            rate = f"{row['dot_samples_per_s']:.0f}/{row['expected_samples_per_s']}"
+        print(f"{row['flow']:<10} {row['n_sensors']:>8} {_format(row['connect_s'], '{:.2f} s'):>10} "
+              f"{_format(row['dot_start_ms'], '{:.1f} ms'):>10} {_format(row['skew_ms'], '{:.1f} ms'):>9} "
+              f"{_format(row['qtm_start_ms'], '{:.1f} ms'):>10} {rate:>14}")
+
+
+def run(sensor_counts=(1, 2, 4, 8, 16, 32), flows=("recording", "streaming"), config=None,
+        stream_seconds=3.0, qtm_port=22223, verbose=False, n_shards=2):
+    """
+    Lance les parcours demandés pour chaque nombre de capteurs et renvoie les mesures.
+    """
+    config = config or simulators.SimulationConfig()
+    simulators.install(config)
+
+    server_loop = SessionLoop("fake-qtm").start()
+    server = server_loop.call(simulators.FakeQtmServer(port=qtm_port).start())
+    results = []
+    try:
+        for n in sensor_counts:
+            config.n_sensors = n
+            for flow in flows:
+                print(f"⏱️ Parcours {flow} avec {n} capteur(s) simulé(s)...")
+                with _quiet(verbose):
+                    if flow == "recording":
+                        row = bench_recording(n, server)
+                    elif flow == "sharded":
+                        row = bench_sharded(n, config, n_shards, stream_seconds, config.output_rate)
+                    else:
+                        row = bench_streaming(n, server, stream_seconds, config.output_rate)
+                row.update(flow=flow, n_sensors=n)
+                results.append(row)
+    finally:
+        server_loop.call(server.stop())
+        server_loop.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Banc de mesure avec capteurs DOT et QTM simulés")
+    parser.add_argument("--sensors", default="1,2,4,8,16,32")
+    parser.add_argument("--flows", default="recording,streaming",
+                        help="Parcours parmi recording, streaming et sharded")
+    parser.add_argument("--shards", type=int, default=2, help="Nombre de shards (parcours sharded)")
+    parser.add_argument("--ble-latency-ms", type=float, default=15.0)
+    parser.add_argument("--ble-jitter-ms", type=float, default=5.0)
+    parser.add_argument("--connect-time", type=float, default=0.3)
+    parser.add_argument("--packet-loss", type=float, default=0.0)
+    parser.add_argument("--output-rate", type=int, default=60)
+    parser.add_argument("--stream-seconds", type=float, default=3.0)
+    parser.add_argument("--qtm-port", type=int, default=22223)
+    parser.add_argument("--json", default=None, help="Fichier JSON des résultats")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    config = simulators.SimulationConfig(
+        ble_latency=args.ble_latency_ms / 1e3, ble_jitter=args.ble_jitter_ms / 1e3,
+        connect_time=args.connect_time, packet_loss=args.packet_loss,
+        output_rate=args.output_rate, seed=0)
+    results = run([int(n) for n in args.sensors.split(",")], args.flows.split(","), config,
+                  args.stream_seconds, args.qtm_port, args.verbose, args.shards)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,323 @@
+import json
+
+import numpy as np
+
+""" Alignement d'horloge entre QTM et les capteurs Movella DOT :
+- Vitesse angulaire calculée de façon vectorisée (matrices 6DOF QTM et quaternions DOT)
+- Intercorrélation par FFT pour estimer le décalage global
+- Intercorrélation par fenêtres (calcul groupé) pour estimer la dérive
+- Décalage a priori à partir des horodatages des commandes de démarrage
+Convention : t_qtm = t_dot + offset_s + drift * (t_dot - t_ref_s), temps en secondes.
+"""
+
+STF_WRAP = 2 ** 32  # sampleTimeFine est un compteur µs sur 32 bits
+
+
+class AlignmentResult:
+    """
+    Paramètres d'alignement DOT -> QTM.
+    """
+
+    def __init__(self, offset_s, drift, t_ref_s, correlation, n_windows, prior_offset_s=None):
+        self.offset_s = offset_s
+        self.drift = drift
+        self.t_ref_s = t_ref_s
+        self.correlation = correlation
+        self.n_windows = n_windows
+        self.prior_offset_s = prior_offset_s
+
+    @property
+    def drift_ppm(self):
+        return self.drift * 1e6
+
+    def dot_to_qtm_time(self, t_dot_s):
+        """
+        Convertit des temps DOT (s) en temps QTM (s).
+        """
+        t_dot_s = np.asarray(t_dot_s, dtype=np.float64)
+        return t_dot_s + self.offset_s + self.drift * (t_dot_s - self.t_ref_s)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values["offset_s"], values["drift_ppm"] / 1e6, values["t_ref_s"],
+                   values["correlation"], values["n_windows"], values.get("prior_offset_s"))
+
+    def to_dict(self):
+        return {
+            "offset_s": self.offset_s,
+            "drift_ppm": self.drift_ppm,
+            "t_ref_s": self.t_ref_s,
+            "correlation": self.correlation,
+            "n_windows": self.n_windows,
+            "prior_offset_s": self.prior_offset_s,
+        }
+
+    def __repr__(self):
+        return (f"AlignmentResult(offset={self.offset_s * 1e3:.2f} ms, "
+                f"drift={self.drift_ppm:.1f} ppm, corr={self.correlation:.2f})")
+
+
+def unwrap_sample_time_fine(sample_time_fine):
+    """
+    Déroule le compteur sampleTimeFine (µs, 32 bits) et renvoie un temps en secondes.
+    """
+    stf = np.asarray(sample_time_fine, dtype=np.int64)
+    steps = np.diff(stf)
+    steps[steps < 0] += STF_WRAP
+    unwrapped = np.empty_like(stf)
+    unwrapped[:1] = stf[:1]
+    np.cumsum(steps, out=unwrapped[1:])
+    unwrapped[1:] += stf[0]
+    return unwrapped / 1e6
+
+
+def angular_speed_from_quaternions(quaternion, t_s):
+    """
+    Vitesse angulaire (rad/s) entre quaternions successifs (n, 4), aux instants médians.
+    """
+    q = np.asarray(quaternion, dtype=np.float64)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    dot = np.abs(np.einsum("ij,ij->i", q[1:], q[:-1]))
+    angle = 2.0 * np.arccos(np.clip(dot, 0.0, 1.0))
+    dt = np.diff(t_s)
+    return 0.5 * (t_s[1:] + t_s[:-1]), angle / np.where(dt > 0, dt, np.nan)
+
+
+def angular_speed_from_rotations(rotation, t_s):
+    """
+    Vitesse angulaire (rad/s) entre matrices de rotation successives (n, 9), aux instants médians.
+    trace(R_k^T R_k+1) = somme(R_k * R_k+1) : l'ordre ligne/colonne n'a pas d'importance.
+    """
+    r = np.asarray(rotation, dtype=np.float64)
+    trace = np.einsum("ij,ij->i", r[1:], r[:-1])
+    angle = np.arccos(np.clip((trace - 1.0) / 2.0, -1.0, 1.0))
+    dt = np.diff(t_s)
+    return 0.5 * (t_s[1:] + t_s[:-1]), angle / np.where(dt > 0, dt, np.nan)
+
+
+def _uniform(t_s, values, rate):
+    """
+    Rééchantillonne un signal sur une grille uniforme (valeurs non finies ignorées).
+    Grille vide s'il reste moins de deux valeurs finies.
+    """
+    valid = np.isfinite(values) & np.isfinite(t_s)
+    t_valid = t_s[valid]
+    if len(t_valid) < 2:
+        return np.empty(0), np.empty(0)
+    grid = np.arange(t_valid[0], t_valid[-1], 1.0 / rate)
+    return grid, np.interp(grid, t_valid, values[valid])
+
+
+def _normalize(x):
+    x = x - x.mean(axis=-1, keepdims=True)
+    std = x.std(axis=-1, keepdims=True)
+    return x / np.where(std > 0, std, 1.0)
+
+
+def _xcorr(a, b, lags):
+    """
+    Corrélation de Pearson entre a[L:L+N] et b (normalisé, longueur N) pour chaque décalage L.
+    Le produit croisé est calculé par FFT, l'écart-type local de a par sommes cumulées.
+    Fonctionne par lot sur le dernier axe.
+    """
+    n = b.shape[-1]
+    lags = np.asarray(lags)
+    nfft = 1 << int(np.ceil(np.log2(a.shape[-1] + n)))
+    spectrum = np.fft.rfft(a, nfft) * np.conj(np.fft.rfft(b, nfft))
+    cross = np.fft.irfft(spectrum, nfft)[..., lags % nfft]
+
+    # Sans normalisation locale, le maximum est biaisé vers les zones de forte amplitude de a
+    pad = np.zeros(a.shape[:-1] + (n,))
+    padded = np.concatenate([pad, a, pad], axis=-1)
+    zero = np.zeros(a.shape[:-1] + (1,))
+    sum1 = np.concatenate([zero, np.cumsum(padded, axis=-1)], axis=-1)
+    sum2 = np.concatenate([zero, np.cumsum(padded * padded, axis=-1)], axis=-1)
+    start = np.clip(lags + n, 0, padded.shape[-1] - n)
+    mean = (sum1[..., start + n] - sum1[..., start]) / n
+    var = (sum2[..., start + n] - sum2[..., start]) / n - mean * mean
+    return cross / (n * np.sqrt(np.maximum(var, 1e-12)))
+
+
+def _refine_peak(corr, index):
+    """
+    Interpolation parabolique autour du maximum pour une précision sous-échantillon.
+    """
+    if 0 < index < len(corr) - 1:
+        y0, y1, y2 = corr[index - 1], corr[index], corr[index + 1]
+        denominator = y0 - 2.0 * y1 + y2
+        if denominator != 0:
+            return index + 0.5 * (y0 - y2) / denominator
+    return float(index)
+
+
+def command_marker_prior(dot_ack_ns, qtm_ack_ns, dot_t0_s, qtm_t0_s):
+    """
+    Décalage a priori à partir des commandes de démarrage : le premier échantillon DOT
+    est daté de l'acquittement DOT, la première trame QTM de l'acquittement QTM
+    (horloge perf_counter_ns de l'ordinateur).
+    """
+    return qtm_t0_s - dot_t0_s + (dot_ack_ns - qtm_ack_ns) / 1e9
+
+
+def estimate_alignment(qtm_t_s, qtm_rotation, dot_t_s, dot_quaternion, rate=50.0,
+                       prior_offset_s=None, max_lag_s=2.0, window_s=30.0,
+                       window_search_s=0.1, min_correlation=0.3):
+    """
+    Estime le décalage et la dérive entre le temps DOT et le temps QTM à partir de la
+    vitesse angulaire d'un corps rigide QTM et du capteur DOT fixé dessus.
+
+    qtm_t_s, qtm_rotation : temps QTM (s) et rotations 6DOF (n, 9)
+    dot_t_s, dot_quaternion : temps DOT (s, sampleTimeFine déroulé) et quaternions (m, 4)
+    prior_offset_s : décalage a priori (command_marker_prior), None pour une recherche libre
+    Renvoie None si l'un des signaux a moins de deux échantillons valides (corps jamais suivi
+    ou entièrement occulté).
+    """
+    tq, speed_q = angular_speed_from_rotations(qtm_rotation, np.asarray(qtm_t_s, np.float64))
+    td, speed_d = angular_speed_from_quaternions(dot_quaternion, np.asarray(dot_t_s, np.float64))
+    grid_q, a = _uniform(tq, speed_q, rate)
+    grid_d, b = _uniform(td, speed_d, rate)
+    if len(a) < 2 or len(b) < 2:
+        return None
+    a = _normalize(a)
+    b = _normalize(b)
+
+    # Décalage global : a[n + L] ~ b[n]  =>  offset = t_q0 - t_d0 + L / rate
+    base = grid_q[0] - grid_d[0]
+    center = 0 if prior_offset_s is None else int(round((prior_offset_s - base) * rate))
+    max_lag = int(round(max_lag_s * rate))
+    if prior_offset_s is None:
+        # Recouvrement d'au moins la moitié du signal DOT
+        lags = np.arange(-(len(b) // 2), len(a) - len(b) // 2)
+    else:
+        lags = np.arange(center - max_lag, center + max_lag + 1)
+    corr = _xcorr(a, b, lags)
+    peak = int(np.argmax(corr))
+    lag = lags[0] + _refine_peak(corr, peak)
+    offset_s = base + lag / rate
+    correlation = float(corr[peak])
+
+    # Dérive : décalage local par fenêtres, toutes corrélées en un seul calcul FFT groupé
+    w = int(round(window_s * rate))
+    m = int(round(window_search_s * rate))
+    starts = np.arange(0, len(b) - w + 1, w)
+    drift = 0.0
+    n_windows = 0
+    if len(starts) >= 2:
+        coarse = int(round(lag))
+        index = (starts + coarse - m)[:, None] + np.arange(w + 2 * m)[None, :]
+        inside = (index >= 0) & (index < len(a))
+        a_windows = np.where(inside, a[np.clip(index, 0, len(a) - 1)], 0.0)
+        b_windows = _normalize(b[starts[:, None] + np.arange(w)[None, :]])
+        local = _xcorr(a_windows, b_windows, np.arange(2 * m + 1))
+
+        peaks = np.argmax(local, axis=1)
+        peak_values = local[np.arange(len(starts)), peaks]
+        keep = (peak_values >= min_correlation) & inside.all(axis=1)
+        if keep.sum() >= 2:
+            refined = np.array([_refine_peak(local[k], peaks[k]) for k in np.flatnonzero(keep)])
+            window_offsets = base + (coarse - m + refined) / rate
+            window_times = grid_d[0] + (starts[keep] + w / 2) / rate
+            slope, intercept = np.polyfit(window_times - grid_d[0], window_offsets, 1,
+                                          w=peak_values[keep])
+            drift = float(slope)
+            offset_s = float(intercept)
+            n_windows = int(keep.sum())
+
+    return AlignmentResult(float(offset_s), drift, float(grid_d[0]), correlation,
+                           n_windows, prior_offset_s)
+
+
+def save_alignment(results, path):
+    """
+    Écrit les paramètres d'alignement (dict nom -> AlignmentResult) dans un fichier JSON.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({name: result.to_dict() for name, result in results.items()}, f, indent=2)
+
+
+def align_streams(dot_streamer, qtm_frames, body_map, body_names, start_markers=None,
+                  verbose=True):
+    """
+    Aligne chaque capteur DOT du streaming temps réel sur le corps rigide QTM associé.
+
+    body_map : adresse Bluetooth -> nom du corps rigide QTM
+    start_markers : {"dot_ack_ns": ..., "qtm_ack_ns": ...} issus du chemin de démarrage
+    """
+    frames = qtm_frames.frames()
+    qtm_t_s = frames["timestamp"] / 1e6
+    results = {}
+
+    for address, body_name in body_map.items():
+        buffer = dot_streamer.buffers.get(address)
+        if buffer is None or body_name not in body_names:
+            if verbose:
+                print(f"⚠️ Alignement impossible pour {address} ({body_name}).")
+            continue
+
+        blocks, _, _ = buffer.read_since(0)
+        if not blocks or not len(qtm_t_s):
+            if verbose:
+                print(f"⚠️ Alignement impossible pour {address} ({body_name}) : aucun échantillon.")
+            continue
+        quaternion = np.concatenate([block["quaternion"] for block in blocks])
+        dot_t_s = unwrap_sample_time_fine(
+            np.concatenate([block["sample_time_fine"] for block in blocks]))
+        rotation = frames["body_rotation"][:, body_names.index(body_name)]
+
+        prior = None
+        if start_markers and len(dot_t_s) and len(qtm_t_s):
+            prior = command_marker_prior(start_markers["dot_ack_ns"], start_markers["qtm_ack_ns"],
+                                         dot_t_s[0], qtm_t_s[0])
+
+        result = estimate_alignment(qtm_t_s, rotation, dot_t_s, quaternion, prior_offset_s=prior)
+        if result is None:
+            if verbose:
+                print(f"⚠️ Alignement impossible pour {address} ({body_name}) : "
+                      "pas assez d'échantillons valides.")
+            continue
+        results[address] = result
+        if verbose:
+            print(f"🕒 Alignement {address} -> {body_name} : {results[address]}")
+
+    return results
+
+
+def align_session(reader, body_map, verbose=True):
+    """
+    Aligne les capteurs DOT d'une session enregistrée (SessionReader) sur les corps rigides QTM.
+    Le décalage a priori est repris de l'alignement déjà présent dans la session.
+    """
+    body_names = reader.metadata.get("qtm_capture", {}).get("body_names")
+    if body_names is None:
+        # Sessions sans qtm_capture (rejeu, import) : noms des corps du flux QTM
+        body_names = reader.streams.get("qtm", {}).get("body_names", [])
+    previous = reader.metadata.get("alignment", {})
+    qtm = reader.qtm()
+    qtm_t_s = qtm["timestamp"] / 1e6
+    results = {}
+
+    for address, body_name in body_map.items():
+        if address not in reader.dot_addresses() or body_name not in body_names or not len(qtm):
+            if verbose:
+                print(f"⚠️ Alignement impossible pour {address} ({body_name}).")
+            continue
+        data = reader.dot(address)
+        if not len(data):
+            if verbose:
+                print(f"⚠️ Alignement impossible pour {address} ({body_name}) : aucun échantillon.")
+            continue
+        dot_t_s = unwrap_sample_time_fine(data["sample_time_fine"])
+        rotation = qtm["body_rotation"][:, body_names.index(body_name)]
+        prior = previous.get(address, {}).get("prior_offset_s")
+        result = estimate_alignment(qtm_t_s, rotation, dot_t_s, data["quaternion"],
+                                    prior_offset_s=prior)
+        if result is None:
+            if verbose:
+                print(f"⚠️ Alignement impossible pour {address} ({body_name}) : "
+                      "pas assez d'échantillons valides.")
+            continue
+        results[address] = result
+        if verbose:
+            print(f"🕒 Alignement {address} -> {body_name} : {results[address]}")
+
+    return results
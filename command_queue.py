@@ -0,0 +1,152 @@
+import asyncio
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import keyboard
+
+""" File de commandes asyncio pilotée par événements :
+- Déclencheurs : touches du clavier, lignes sur stdin, socket TCP locale
+- Un terminal n'est écouté que par un seul déclencheur (hook clavier, sinon stdin) : une touche
+  suivie d'Entrée ne lance pas la commande deux fois
+- Aucun délai de scrutation : chaque déclencheur est poussé immédiatement dans la file
+- Mesure de la latence entre le déclencheur et l'exécution de la commande
+"""
+
+Command = namedtuple("Command", "name source trigger_ns")
+
+
+class CommandQueue:
+    """
+    File de commandes thread-safe consommée par la boucle asyncio.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self.latencies_ns = []  # (commande, source, latence en ns)
+
+    def put(self, name, source="api", trigger_ns=None):
+        """
+        Ajoute une commande depuis n'importe quel thread.
+        """
+        if trigger_ns is None:
+            trigger_ns = time.perf_counter_ns()
+        command = Command(name, source, trigger_ns)
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, command)
+
+    async def get(self):
+        return await self._queue.get()
+
+    async def dispatch(self, handlers, stop_commands=("q",), verbose=True):
+        """
+        Exécute les commandes reçues jusqu'à une commande d'arrêt.
+        Les handlers sont des fonctions sans argument renvoyant une coroutine.
+        """
+        while True:
+            command = await self._queue.get()
+            latency = time.perf_counter_ns() - command.trigger_ns
+            self.latencies_ns.append((command.name, command.source, latency))
+
+            handler = handlers.get(command.name)
+            if handler is None:
+                if verbose:
+                    print(f"ℹ️ Commande inconnue : {command.name} ({command.source})")
+                continue
+
+            if verbose:
+                print(
+                    f"⌛ Commande '{command.name}' ({command.source}), latence déclencheur : {latency / 1e3:.0f} µs")
+            try:
+                await handler()
+            except Exception as e:
+                print(f"❌ Erreur lors de la commande '{command.name}' : {e}")
+
+            if command.name in stop_commands:
+                return command
+
+    def print_latency_report(self):
+        """
+        Affiche la latence déclencheur -> commande de chaque commande reçue.
+        """
+        if not self.latencies_ns:
+            return
+        print("Latence déclencheur -> commande :")
+        for name, source, latency in self.latencies_ns:
+            print(f"  {name} ({source}) : {latency / 1e3:.0f} µs")
+
+
+def attach_keyboard(queue, keys):
+    """
+    Pousse une commande à chaque appui sur une des touches (sans répétition automatique).
+    Renvoie la liste des hooks pour keyboard.unhook.
+    """
+    pressed = set()
+
+    def on_key(event, key):
+        if event.event_type == keyboard.KEY_DOWN:
+            if key not in pressed:
+                pressed.add(key)
+                queue.put(key, "clavier")
+        else:
+            pressed.discard(key)
+
+    return [keyboard.hook_key(key, lambda event, key=key: on_key(event, key))
+            for key in keys]
+
+
+def attach_stdin(queue):
+    """
+    Pousse chaque ligne lue sur stdin comme une commande (thread bloquant sur readline).
+    """
+    def reader():
+        for line in sys.stdin:
+            trigger_ns = time.perf_counter_ns()
+            name = line.strip()
+            if name:
+                queue.put(name, "stdin", trigger_ns)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    return thread
+
+
+def attach_terminal(queue, keys):
+    """
+    Écoute le terminal une seule fois : hook clavier sur les touches, ou lignes de stdin si le
+    hook est indisponible (droits, pas de clavier) ou si stdin n'est pas un terminal (redirection,
+    tube), auquel cas les deux déclencheurs sont actifs. Renvoie les hooks pour keyboard.unhook.
+    """
+    try:
+        hooks = attach_keyboard(queue, keys)
+    except Exception as e:  # ImportError (droits), OSError ou AssertionError (aucun clavier)
+        print(f"⚠️ Clavier indisponible ({type(e).__name__}: {e}) : commandes lues sur stdin.")
+        hooks = []
+    if not hooks or not sys.stdin.isatty():
+        attach_stdin(queue)
+    return hooks
+
+
+async def start_socket_server(queue, host="127.0.0.1", port=5555):
+    """
+    Serveur TCP local : chaque ligne reçue est une commande, répond 'ok'.
+    """
+    async def handle_client(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                trigger_ns = time.perf_counter_ns()
+                name = line.decode(errors="ignore").strip()
+                if name:
+                    queue.put(name, "socket", trigger_ns)
+                    writer.write(b"ok\n")
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_client, host, port)
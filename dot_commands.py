@@ -0,0 +1,212 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+
+""" Envoi simultané des commandes aux capteurs Movella DOT :
+- Un thread persistant par capteur, armé à l'avance sur une barrière
+- Aucun affichage dans la section critique (envoi -> acquittement)
+- Horodatage perf_counter_ns de chaque acquittement et calcul de l'écart entre capteurs
+- Un capteur qui n'acquitte pas est compté en échec (« timeout ») ; son thread reste occupé
+  et il est écarté des commandes suivantes tant que l'appel précédent n'est pas revenu
+"""
+
+COMMAND_TIMEOUT = 10.0  # Attente maximale des acquittements de run() / run_async() (s)
+
+
+class FanOutResult:
+    """
+    Résultat d'une commande envoyée à tous les capteurs.
+    """
+
+    def __init__(self, command, fire_ns, records):
+        self.command = command
+        self.fire_ns = fire_ns
+        # adresse -> (t_envoi_ns, t_acquittement_ns, succès, raison)
+        self.records = records
+
+    @property
+    def acks(self):
+        """Horodatages d'acquittement des capteurs ayant réussi (adresse -> ns)."""
+        return {address: ack for address, (_, ack, ok, _) in self.records.items() if ok}
+
+    @property
+    def failures(self):
+        """Raisons d'échec par adresse."""
+        return {address: reason for address, (_, _, ok, reason) in self.records.items() if not ok}
+
+    @property
+    def skew_ns(self):
+        """Écart entre le premier et le dernier acquittement réussi."""
+        acks = self.acks.values()
+        return max(acks) - min(acks) if acks else 0
+
+    @property
+    def first_ack_ns(self):
+        acks = self.acks.values()
+        return min(acks) if acks else None
+
+    def report(self):
+        """
+        Affiche le résultat par capteur puis l'écart mesuré entre capteurs.
+        """
+        for address, (send, ack, ok, reason) in self.records.items():
+            delay_ms = (ack - self.fire_ns) / 1e6
+            if ok:
+                print(f"✅ {self.command} acquitté par {address} (+{delay_ms:.1f} ms).")
+            else:
+                print(f"❌ Échec de {self.command} pour {address}. Raison : {reason}")
+        print(
+            f"⏱️ Écart entre capteurs ({len(self.acks)}/{len(self.records)}) : {self.skew_ns / 1e6:.1f} ms")
+
+
+class ArmedCommand:
+    """
+    Commande armée : les workers attendent sur la barrière jusqu'à fire().
+    """
+
+    def __init__(self, command, barrier, futures, skipped=None):
+        self.command = command
+        self.fire_ns = None
+        self._barrier = barrier
+        self._futures = futures  # adresse -> future du worker
+        self._skipped = skipped or {}  # adresse -> raison (capteurs non armés)
+
+    def fire(self):
+        """
+        Libère tous les workers en même temps. Ne bloque pas sur les acquittements.
+        Si un worker n'a pas rejoint la barrière à temps, elle est rompue et les capteurs
+        concernés apparaissent en échec dans result().
+        """
+        self.fire_ns = time.perf_counter_ns()
+        try:
+            self._barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        return self
+
+    def cancel(self):
+        """
+        Désarme la commande sans l'envoyer (libère les workers en attente).
+        """
+        self._barrier.abort()
+
+    def result(self, timeout=None):
+        """
+        Attend les acquittements (au plus timeout secondes) et renvoie un FanOutResult.
+        Les capteurs qui n'ont pas acquitté à temps sont en échec avec la raison « timeout ».
+        """
+        concurrent.futures.wait(self._futures.values(), timeout)
+        now = time.perf_counter_ns()
+        fire_ns = self.fire_ns if self.fire_ns is not None else now
+        records = {}
+        for address, future in self._futures.items():
+            if not future.done():
+                records[address] = (fire_ns, now, False, "timeout")
+                continue
+            try:
+                _, send, ack, ok, reason = future.result()
+            except threading.BrokenBarrierError:
+                send, ack, ok, reason = fire_ns, now, False, "commande non armée (barrière rompue)"
+            except Exception as e:
+                send, ack, ok, reason = fire_ns, now, False, str(e)
+            records[address] = (send, ack, ok, reason)
+        for address, reason in self._skipped.items():
+            records[address] = (fire_ns, fire_ns, False, reason)
+        result = FanOutResult(self.command, fire_ns, records)
+        instrumentation.record_fan_out(result)
+        return result
+
+    async def result_async(self, timeout=None):
+        """
+        Version asyncio de result() : attend les acquittements sans bloquer la boucle.
+        """
+        if self._futures:
+            await asyncio.wait([asyncio.wrap_future(future) for future in self._futures.values()],
+                               timeout=timeout)
+        return self.result(0)
+
+
+class DeviceFanOut:
+    """
+    Pool de threads persistant (un thread par capteur) pour envoyer une commande
+    à tous les capteurs avec un écart minimal.
+    """
+
+    def __init__(self, devices, arm_timeout=5.0):
+        self.devices = list(devices)
+        self.addresses = [device.bluetoothAddress() for device in self.devices]
+        self.arm_timeout = arm_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(self.devices)),
+                                        thread_name_prefix="dot-fanout")
+        self._pending = {}  # adresse -> dernier future soumis
+
+    @staticmethod
+    def _worker(barrier, device, address, command, args):
+        method = getattr(device, command)
+        barrier.wait()
+        # Section critique : aucun affichage ni allocation superflue
+        send = time.perf_counter_ns()
+        try:
+            ok = method(*args) is not False
+            reason = None
+        except Exception as e:
+            ok = False
+            reason = str(e)
+        ack = time.perf_counter_ns()
+        if not ok and reason is None:
+            reason = device.lastResultText()
+        return address, send, ack, ok, reason
+
+    def arm(self, command, *args):
+        """
+        Prépare une commande sur tous les capteurs sans l'envoyer.
+        Un capteur dont la commande précédente n'est pas revenue occupe encore son thread :
+        il n'est pas armé (échec immédiat) pour que la barrière puisse se remplir.
+        """
+        ready, skipped = [], {}
+        for device, address in zip(self.devices, self.addresses):
+            previous = self._pending.get(address)
+            if previous is not None and not previous.done():
+                skipped[address] = "commande précédente toujours en cours"
+            else:
+                ready.append((device, address))
+        barrier = threading.Barrier(len(ready) + 1, timeout=self.arm_timeout)
+        futures = {}
+        for device, address in ready:
+            futures[address] = self._pool.submit(self._worker, barrier, device, address, command, args)
+        self._pending.update(futures)
+        return ArmedCommand(command, barrier, futures, skipped)
+
+    def run(self, command, *args, timeout=COMMAND_TIMEOUT):
+        """
+        Envoie une commande à tous les capteurs et attend les acquittements (au plus timeout s).
+        """
+        return self.arm(command, *args).fire().result(timeout)
+
+    async def run_async(self, command, *args, timeout=COMMAND_TIMEOUT):
+        """
+        Envoie une commande à tous les capteurs depuis la boucle asyncio.
+        """
+        return await self.arm(command, *args).fire().result_async(timeout)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+_fan_out = None
+
+
+def get_fan_out(devices):
+    """
+    Renvoie le DeviceFanOut associé à la liste de capteurs (recréé si elle a changé).
+    """
+    global _fan_out
+    if _fan_out is None or _fan_out.devices != list(devices):
+        if _fan_out is not None:
+            _fan_out.shutdown()
+        _fan_out = DeviceFanOut(devices)
+    return _fan_out
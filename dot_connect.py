@@ -0,0 +1,109 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import instrumentation
+
+""" Connexion des capteurs Movella DOT :
+- Ouverture des ports via un pool de threads borné (plusieurs capteurs en parallèle)
+- Nouvelle tentative pour les capteurs en échec sans bloquer les autres
+- Mesure du temps de connexion de chaque capteur
+"""
+
+
+def _open_port(xdpc_handler, device_info, attempt, retry_delay):
+    """
+    Ouvre le port d'un capteur et renvoie (device, durée en secondes).
+    """
+    if attempt > 0:
+        time.sleep(retry_delay)
+
+    t0 = time.perf_counter()
+    with instrumentation.span("dot.open_port"):
+        opened = xdpc_handler.manager().openPort(device_info)
+    if not opened:
+        return None, time.perf_counter() - t0
+
+    device = xdpc_handler.manager().device(device_info.deviceId())
+    return device, time.perf_counter() - t0
+
+
+def connect_devices(xdpc_handler, device_infos, parallel=True, max_workers=4,
+                    max_retries=2, retry_delay=0.5, verbose=True):
+    """
+    Connecte les capteurs demandés et renvoie (capteurs connectés, temps de connexion).
+
+    Les temps de connexion sont indexés par adresse Bluetooth et correspondent
+    à la tentative réussie (ou à la dernière tentative en cas d'échec).
+    En mode séquentiel (parallel=False), un seul worker est utilisé.
+    """
+    workers = max(1, min(max_workers, len(device_infos))) if parallel else 1
+    connected = {}
+    connect_times = {}
+    attempts = {}
+
+    if not device_infos:
+        return [], connect_times
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for device_info in device_infos:
+            address = device_info.bluetoothAddress()
+            attempts[address] = 0
+            if verbose:
+                print(f"Connexion au capteur : {address}...")
+            future = pool.submit(_open_port, xdpc_handler,
+                                 device_info, 0, retry_delay)
+            pending[future] = device_info
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                device_info = pending.pop(future)
+                address = device_info.bluetoothAddress()
+
+                try:
+                    device, elapsed = future.result()
+                except Exception as e:
+                    device, elapsed = None, 0.0
+                    if verbose:
+                        print(f"Erreur lors de la connexion au capteur {address} : {e}")
+
+                connect_times[address] = elapsed
+
+                if device:
+                    connected[address] = device
+                    if verbose:
+                        print(
+                            f"Connecté au capteur : {device.deviceTagName()} ({address}) en {elapsed:.2f} s.")
+                    continue
+
+                attempts[address] += 1
+                if attempts[address] <= max_retries:
+                    if verbose:
+                        print(
+                            f"Échec de la connexion au capteur : {address}. Nouvelle tentative ({attempts[address]}/{max_retries})...")
+                    retry = pool.submit(_open_port, xdpc_handler, device_info,
+                                        attempts[address], retry_delay)
+                    pending[retry] = device_info
+                elif verbose:
+                    print(f"Échec de la connexion au capteur : {address}.")
+
+    # On conserve l'ordre de sélection de l'utilisateur
+    connected_devices = [connected[info.bluetoothAddress()]
+                         for info in device_infos
+                         if info.bluetoothAddress() in connected]
+
+    if verbose:
+        print_connect_report(connect_times, connected)
+
+    return connected_devices, connect_times
+
+
+def print_connect_report(connect_times, connected=None):
+    """
+    Affiche le temps de connexion de chaque capteur, du plus lent au plus rapide.
+    """
+    print("Temps de connexion par capteur :")
+    for address, elapsed in sorted(connect_times.items(), key=lambda item: -item[1]):
+        status = "OK" if connected is None or address in connected else "ÉCHEC"
+        print(f"  {address} : {elapsed:.2f} s ({status})")
@@ -0,0 +1,289 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import movelladot_pc_sdk
+
+""" Export des enregistrements embarqués des capteurs Movella DOT :
+- Un worker par capteur connecté (exports en parallèle)
+- Écriture sur disque par blocs (CSV), sans accumuler l'enregistrement en mémoire
+- Débit par capteur et reprise après une perte de liaison
+"""
+
+EXPORT_COLUMNS = ["SampleTimeFine", "Quat_W", "Quat_X", "Quat_Y", "Quat_Z",
+                  "FreeAcc_X", "FreeAcc_Y", "FreeAcc_Z"]
+EXPORT_FORMAT = ["%d"] + ["%.6f"] * 7
+
+
+class ChunkedCsvWriter:
+    """
+    Écrit les lignes exportées par blocs préalloués et tient à jour un fichier de progression
+    (lignes et taille du CSV sur disque) utilisé pour la reprise.
+    La progression n'est écrite qu'une fois le bloc synchronisé sur disque ; à la reprise,
+    le CSV est tronqué à la taille enregistrée (lignes écrites après la dernière progression).
+    append (thread du callback SDK) et flush (worker d'export) sont protégés par un verrou.
+    """
+
+    def __init__(self, path, chunk_size=4096):
+        self.path = path
+        self.progress_path = path + ".progress"
+        self.chunk = np.zeros((chunk_size, len(EXPORT_COLUMNS)), dtype=np.float64)
+        self.n = 0
+        self.lock = threading.RLock()
+        self.progress = read_progress(path)
+        self.rows = self.progress["rows"]
+        self.offset = self.progress.get("offset")
+
+        new_file = (self.rows == 0 or self.offset is None or not os.path.exists(path)
+                    or os.path.getsize(path) < self.offset)
+        if new_file:
+            self.rows = 0
+            self._file = open(path, "wb")
+            self._file.write((",".join(EXPORT_COLUMNS) + "\n").encode("ascii"))
+        else:
+            os.truncate(path, self.offset)
+            self._file = open(path, "ab")
+
+    def append(self, sample_time_fine, q, a):
+        with self.lock:
+            row = self.chunk[self.n]
+            row[0] = sample_time_fine
+            row[1] = q[0]
+            row[2] = q[1]
+            row[3] = q[2]
+            row[4] = q[3]
+            row[5] = a[0]
+            row[6] = a[1]
+            row[7] = a[2]
+            self.n += 1
+            if self.n == len(self.chunk):
+                self.flush()
+
+    def flush(self, done=False):
+        with self.lock:
+            if self.n:
+                np.savetxt(self._file, self.chunk[:self.n], fmt=EXPORT_FORMAT, delimiter=",")
+                self.rows += self.n
+                self.n = 0
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.offset = self._file.tell()
+            write_progress(self.path, self.rows, done, self.offset)
+
+    def close(self, done=False):
+        self.flush(done)
+        self._file.close()
+
+
+def read_progress(path):
+    try:
+        with open(path + ".progress", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"rows": 0, "done": False}
+
+
+def write_progress(path, rows, done, offset=None):
+    tmp = path + ".progress.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"rows": rows, "done": done, "offset": offset}, f)
+    os.replace(tmp, path + ".progress")
+
+
+class _DeviceExport:
+    """
+    État de l'export en cours pour un capteur.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.skip = writer.rows  # Lignes déjà sur disque, ignorées à la reprise
+        self.received = 0
+        self.last_packet = time.monotonic()
+        self.done = threading.Event()
+
+
+class RecordingExporter:
+    """
+    Exporte en parallèle les enregistrements embarqués de tous les capteurs connectés.
+    """
+
+    def __init__(self, xdpc_handler, devices, output_dir, chunk_size=4096,
+                 stall_timeout=10.0, max_resumes=3, verbose=True):
+        self.xdpc_handler = xdpc_handler
+        self.devices = list(devices)
+        self._source = devices  # Liste de l'appelant, mise à jour après une reconnexion
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.stall_timeout = stall_timeout
+        self.max_resumes = max_resumes
+        self.verbose = verbose
+        self.throughput = {}  # adresse -> (lignes, secondes)
+        self._exports = {}
+        self._reconnected = {}  # adresse -> capteur rouvert par _reconnect
+        self._previous_callbacks = None
+
+    def attach(self):
+        """
+        Branche les callbacks d'export de XdpcHandler sur l'exporteur.
+        """
+        handler = self.xdpc_handler
+        self._previous_callbacks = (handler.onRecordedDataAvailable, handler.onRecordedDataDone)
+        handler.onRecordedDataAvailable = self.on_recorded_data_available
+        handler.onRecordedDataDone = self.on_recorded_data_done
+
+    def detach(self):
+        if self._previous_callbacks is not None:
+            (self.xdpc_handler.onRecordedDataAvailable,
+             self.xdpc_handler.onRecordedDataDone) = self._previous_callbacks
+            self._previous_callbacks = None
+
+    def on_recorded_data_available(self, device, packet):
+        export = self._exports.get(device.bluetoothAddress())
+        if export is None:
+            return
+        export.last_packet = time.monotonic()
+        export.received += 1
+        if export.received <= export.skip:
+            return
+        export.writer.append(packet.sampleTimeFine(), packet.orientationQuaternion(),
+                             packet.freeAcceleration())
+
+    def on_recorded_data_done(self, device):
+        export = self._exports.get(device.bluetoothAddress())
+        if export is not None:
+            export.done.set()
+
+    def _reconnect(self, device):
+        """
+        Rouvre le port d'un capteur après une perte de liaison.
+        """
+        port_info = device.portInfo()
+        manager = self.xdpc_handler.manager()
+        if not manager.openPort(port_info):
+            return None
+        return manager.device(port_info.deviceId())
+
+    def _export_recording(self, device, index, path):
+        """
+        Exporte un enregistrement, avec reprise si la liaison est perdue.
+        Renvoie le nombre de lignes écrites pendant cet appel.
+        """
+        address = device.bluetoothAddress()
+        writer = ChunkedCsvWriter(path, self.chunk_size)
+        rows_before = writer.rows
+
+        for attempt in range(self.max_resumes + 1):
+            export = _DeviceExport(writer)
+            self._exports[address] = export
+            if device.startExportRecording(index):
+                while not export.done.wait(0.5):
+                    if time.monotonic() - export.last_packet > self.stall_timeout:
+                        break
+            if export.done.is_set():
+                writer.close(done=True)
+                return writer.rows - rows_before
+
+            # Liaison perdue : on arrête l'export et on détache le callback de ce capteur
+            # avant d'écrire ce qui est déjà reçu, pour ne pas écrire pendant un append
+            device.stopExportRecording()
+            self._exports.pop(address, None)
+            writer.flush()
+            if attempt == self.max_resumes:
+                break
+            if self.verbose:
+                print(
+                    f"⚠️ Export interrompu pour {address} ({writer.rows} lignes sur disque). Reprise ({attempt + 1}/{self.max_resumes})...")
+            reconnected = self._reconnect(device)
+            if reconnected is not None:
+                device = self._reconnected[address] = reconnected
+            device.selectExportData(self._export_data())
+
+        writer.close(done=False)
+        raise RuntimeError(f"export de {address} abandonné après {self.max_resumes} reprises "
+                           f"({writer.rows} lignes sur disque)")
+
+    @staticmethod
+    def _export_data():
+        data = movelladot_pc_sdk.XsIntArray()
+        data.push_back(movelladot_pc_sdk.RecordingData_Timestamp)
+        data.push_back(movelladot_pc_sdk.RecordingData_Quaternion)
+        data.push_back(movelladot_pc_sdk.RecordingData_FreeAcceleration)
+        return data
+
+    def export_device(self, device, recordings="last"):
+        """
+        Worker d'un capteur : exporte le dernier (ou tous les) enregistrement(s).
+        """
+        address = device.bluetoothAddress()
+        count = device.recordingCount()
+        if count <= 0:
+            return address, 0, 0.0
+
+        if not device.selectExportData(self._export_data()):
+            raise RuntimeError(f"sélection des données refusée : {device.lastResultText()}")
+
+        indices = range(1, count + 1) if recordings == "all" else [count]
+        rows = 0
+        t0 = time.perf_counter()
+        for index in indices:
+            name = f"{device.deviceTagName()}_{address.replace(':', '')}_rec{index}.csv"
+            path = os.path.join(self.output_dir, name)
+            if read_progress(path)["done"]:
+                continue  # Déjà exporté lors d'une session précédente
+            device = self._reconnected.get(address, device)
+            rows += self._export_recording(device, index, path)
+        elapsed = time.perf_counter() - t0
+        self.throughput[address] = (rows, elapsed)
+        return address, rows, elapsed
+
+    def run(self, recordings="last"):
+        """
+        Lance un worker par capteur et affiche le débit de chacun.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.attach()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(self.devices)),
+                                    thread_name_prefix="dot-export") as pool:
+                futures = {pool.submit(self.export_device, device, recordings): device
+                           for device in self.devices}
+                for future, device in futures.items():
+                    try:
+                        address, rows, elapsed = future.result()
+                        if self.verbose:
+                            rate = rows / elapsed if elapsed > 0 else 0.0
+                            print(
+                                f"✅ Export {address} : {rows} lignes en {elapsed:.1f} s ({rate:.0f} lignes/s)")
+                    except Exception as e:
+                        print(f"❌ Échec de l'export pour {device.bluetoothAddress()} : {e}")
+        finally:
+            self.detach()
+            self._replace_reconnected()
+        return self.throughput
+
+    def _replace_reconnected(self):
+        """
+        Remplace, dans la liste de capteurs de l'appelant, ceux rouverts pendant l'export.
+        """
+        for i, device in enumerate(self.devices):
+            reconnected = self._reconnected.get(device.bluetoothAddress())
+            if reconnected is None:
+                continue
+            self.devices[i] = reconnected
+            if isinstance(self._source, list):
+                for j, known in enumerate(self._source):
+                    if known is device:
+                        self._source[j] = reconnected
+
+
+def export_recordings(xdpc_handler, devices, output_dir, recordings="last", verbose=True):
+    """
+    Exporte les enregistrements embarqués de tous les capteurs dans output_dir.
+    """
+    if verbose:
+        print(f"💾 Export des enregistrements de {len(devices)} capteur(s) vers {output_dir}...")
+    return RecordingExporter(xdpc_handler, devices, output_dir, verbose=verbose).run(recordings)
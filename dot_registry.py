@@ -0,0 +1,163 @@
+import json
+import os
+import time
+
+""" Registre persistant des capteurs Movella DOT :
+- Fichier JSON local : adresses Bluetooth connues, nom (tag) et dernière connexion
+- Profils nommés (liste ordonnée d'adresses) pour se connecter sans saisie ; un capteur
+  hors service est retiré avec forget(), un profil est réinitialisé avec reset_profile()
+- Scan ciblé : arrêt dès que tous les capteurs attendus ont été vus
+- Scan libre de durée choisie (le scan du SDK a une durée fixe)
+"""
+
+REGISTRY_FILE = "sensors.json"
+
+
+def normalize_address(address):
+    return address.strip().upper()
+
+
+class SensorRegistry:
+    """
+    Capteurs connus et profils, enregistrés dans un petit fichier JSON.
+    """
+
+    def __init__(self, path=REGISTRY_FILE):
+        self.path = path
+        self.sensors = {}   # adresse -> {"tag": ..., "last_seen": ...}
+        self.profiles = {}  # nom -> [adresses]
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.sensors = data.get("sensors", {})
+            self.profiles = data.get("profiles", {})
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"sensors": self.sensors, "profiles": self.profiles}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def add(self, address, tag=None):
+        entry = self.sensors.setdefault(normalize_address(address), {})
+        if tag:
+            entry["tag"] = tag
+        entry["last_seen"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def tag(self, address):
+        return self.sensors.get(normalize_address(address), {}).get("tag")
+
+    def profile(self, name):
+        """
+        Adresses du profil, ou None si le profil n'existe pas (ou s'il est vide).
+        """
+        return self.profiles.get(name) or None
+
+    def save_profile(self, name, addresses):
+        self.profiles[name] = [normalize_address(address) for address in addresses]
+        self.save()
+
+    def reset_profile(self, name):
+        """
+        Supprime le profil : la session suivante repasse par la sélection au clavier.
+        Renvoie True si le profil existait.
+        """
+        existed = self.profiles.pop(name, None) is not None
+        self.save()
+        return existed
+
+    def forget(self, address, profile=None):
+        """
+        Retire un capteur du profil nommé, ou de tous les profils et du registre si profile est None.
+        Renvoie True si le capteur était enregistré.
+        """
+        address = normalize_address(address)
+        names = list(self.profiles) if profile is None else [profile]
+        found = False
+        for name in names:
+            addresses = self.profiles.get(name, [])
+            if address in addresses:
+                addresses.remove(address)
+                found = True
+        if profile is None:
+            found = self.sensors.pop(address, None) is not None or found
+        self.save()
+        return found
+
+    def remember(self, devices, profile=None):
+        """
+        Enregistre les capteurs connectés (adresse et tag), et le profil s'il est nommé.
+        Un profil existant n'est jamais réduit : les capteurs absents de cette session y restent,
+        les nouveaux sont ajoutés à la fin.
+        """
+        addresses = []
+        for device in devices:
+            address = device.bluetoothAddress()
+            self.add(address, device.deviceTagName())
+            addresses.append(normalize_address(address))
+        if profile is not None and addresses:
+            known = self.profiles.get(profile, [])
+            self.save_profile(profile, known + [address for address in addresses if address not in known])
+        else:
+            self.save()
+
+
+def targeted_scan(xdpc_handler, expected_addresses, timeout=60.0, poll_interval=0.1, verbose=True):
+    """
+    Scanne jusqu'à ce que tous les capteurs attendus soient détectés (ou jusqu'au délai).
+    Renvoie (port_infos des capteurs attendus dans l'ordre du profil, adresses manquantes).
+    """
+    expected = [normalize_address(address) for address in expected_addresses]
+    manager = xdpc_handler.manager()
+    found = {}
+
+    t0 = time.perf_counter()
+    manager.enableDeviceDetection()
+    try:
+        while time.perf_counter() - t0 < timeout:
+            for port_info in xdpc_handler.detectedDots():
+                address = normalize_address(port_info.bluetoothAddress())
+                if address in expected and address not in found:
+                    found[address] = port_info
+                    if verbose:
+                        print(f"📶 Capteur attendu détecté : {address} ({len(found)}/{len(expected)})")
+            if len(found) == len(expected):
+                break
+            time.sleep(poll_interval)
+    finally:
+        manager.disableDeviceDetection()
+
+    missing = [address for address in expected if address not in found]
+    if verbose:
+        elapsed = time.perf_counter() - t0
+        if missing:
+            print(f"⚠️ Scan ciblé terminé en {elapsed:.1f} s, capteur(s) absent(s) : {', '.join(missing)}")
+        else:
+            print(f"✅ Tous les capteurs attendus détectés en {elapsed:.1f} s.")
+    return [found[address] for address in expected if address in found], missing
+
+
+def timed_scan(xdpc_handler, duration=20.0, verbose=True):
+    """
+    Scanne pendant duration secondes. Renvoie les port_infos détectés.
+    """
+    manager = xdpc_handler.manager()
+    manager.enableDeviceDetection()
+    try:
+        time.sleep(duration)
+    finally:
+        manager.disableDeviceDetection()
+    detected = xdpc_handler.detectedDots()
+    if verbose:
+        print(f"📶 Scan terminé : {len(detected)} capteur(s) détecté(s) en {duration:g} s.")
+    return detected
+
+
+def select_by_addresses(detected_dots, addresses):
+    """
+    Capteurs détectés correspondant aux adresses demandées, dans l'ordre des adresses.
+    """
+    by_address = {normalize_address(port_info.bluetoothAddress()): port_info
+                  for port_info in detected_dots}
+    return [by_address[normalize_address(address)] for address in addresses
+            if normalize_address(address) in by_address]
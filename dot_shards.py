@@ -0,0 +1,381 @@
+import multiprocessing
+import os
+import time
+
+import instrumentation
+from dot_commands import FanOutResult
+
+""" Acquisition répartie des capteurs Movella DOT sur plusieurs processus :
+- Un processus (shard) par adaptateur Bluetooth, avec son propre XdpcHandler et ses capteurs
+- Échantillons écrits par chaque shard dans des tampons circulaires en mémoire partagée créés
+  par le coordinateur : aucun bloc d'échantillons n'est sérialisé
+- Synchronisation lancée en parallèle dans tous les shards (une synchronisation par adaptateur)
+- Commandes start/stop armées dans chaque shard puis libérées ensemble, avec mesure de
+  l'écart entre shards
+Le SDK est importé dans les shards après l'initialisation (variables d'environnement de
+l'adaptateur, simulateurs) : ce module ne l'importe pas au chargement.
+"""
+
+
+class ShardFanOutResult(FanOutResult):
+    """
+    Résultat d'une commande envoyée à tous les shards.
+    shards : index -> (libération du shard en ns après fire_ns, premier acquittement ns, écart interne ns)
+    """
+
+    def __init__(self, command, fire_ns, records, shards):
+        super().__init__(command, fire_ns, records)
+        self.shards = shards
+
+    @property
+    def shard_skew_ns(self):
+        """Écart entre les premiers acquittements des différents shards."""
+        firsts = [first for _, first, _ in self.shards.values() if first is not None]
+        return max(firsts) - min(firsts) if firsts else 0
+
+    def report(self):
+        super().report()
+        for index, (release_ns, first_ns, skew_ns) in sorted(self.shards.items()):
+            print(f"  Shard {index} : libéré en {release_ns / 1e6:.2f} ms, écart interne {skew_ns / 1e6:.1f} ms")
+        print(f"⏱️ Écart entre shards : {self.shard_skew_ns / 1e6:.1f} ms")
+
+
+class _ShardWorker:
+    """
+    État d'un shard (côté processus enfant) : SDK, capteurs, pool de commandes et streaming.
+    """
+
+    def __init__(self, index, addresses, go, cancel, verbose):
+        from xdpchandler import XdpcHandler
+
+        self.index = index
+        self.addresses = list(addresses)
+        self.go = go
+        self.cancel = cancel
+        self.verbose = verbose
+        self.handler = XdpcHandler()
+        if not self.handler.initialize():
+            raise RuntimeError("échec de l'initialisation du SDK")
+        self.devices = []
+        self.connect_times = {}
+        self.fan_out = None
+        self.streamer = None
+        self.buffers = {}
+
+    def connect(self, scan_timeout=60.0):
+        from dot_connect import connect_devices
+        from dot_registry import targeted_scan
+
+        if self.addresses:
+            port_infos, _ = targeted_scan(self.handler, self.addresses, timeout=scan_timeout,
+                                          verbose=self.verbose)
+        else:
+            self.handler.scanForDots()
+            port_infos = self.handler.detectedDots()
+        self.devices, self.connect_times = connect_devices(self.handler, port_infos,
+                                                           verbose=self.verbose)
+        return [device.bluetoothAddress() for device in self.devices]
+
+    def sync(self, max_attempts=10):
+        from dot_commands import DeviceFanOut
+        from sync_supervisor import SyncSupervisor
+
+        t0 = time.perf_counter()
+        ok, root = True, None
+        if len(self.devices) > 1:
+            supervisor = SyncSupervisor(self.handler, self.devices, self.connect_times,
+                                        max_attempts=max_attempts, verbose=self.verbose)
+            ok = supervisor.run()
+            self.devices, root = supervisor.devices, supervisor.root
+        if self.fan_out is not None:
+            self.fan_out.shutdown()
+        self.fan_out = DeviceFanOut(self.devices, arm_timeout=None)
+        return {"ok": ok, "root": root, "elapsed_s": time.perf_counter() - t0,
+                "devices": [device.bluetoothAddress() for device in self.devices]}
+
+    def prepare_stream(self, names, capacity, output_rate=60):
+        """
+        S'attache aux tampons partagés du coordinateur et règle la fréquence de sortie.
+        """
+        from dot_stream import DotStreamer, SharedDotRingBuffer
+
+        self.buffers = {address: SharedDotRingBuffer(capacity, name=name)
+                        for address, name in names.items()}
+        self.streamer = DotStreamer(self.devices, buffers=self.buffers)
+        self.streamer.attach(self.handler)
+        refused = [device.bluetoothAddress() for device in self.devices
+                   if not device.setOutputRate(output_rate)]
+        return {"refused": refused}
+
+    def release_stream(self):
+        if self.streamer is not None:
+            self.streamer.detach()
+            self.streamer = None
+        for buffer in self.buffers.values():
+            buffer.close()
+        self.buffers = {}
+        return {"sent": sum(getattr(device, "sent_packets", 0) for device in self.devices)}
+
+    def command(self, connection, command, args=(), timeout=10.0):
+        """
+        Arme la commande, signale au coordinateur qu'elle est prête, attend la libération commune.
+        Libéré avec l'événement cancel levé (un autre shard n'a pas pu armer), le shard désarme
+        la commande sans l'envoyer.
+        """
+        if command == "startMeasurement" and not args and self.streamer is not None:
+            args = (self.streamer.payload_mode,)
+        armed = self.fan_out.arm(command, *args)
+        connection.send(("armed", None))
+        if not self.go.wait(timeout):
+            armed.cancel()
+            raise RuntimeError(f"{command} non libéré après {timeout:.0f} s")
+        if self.cancel.is_set():
+            armed.cancel()
+            raise RuntimeError(f"{command} annulé par le coordinateur")
+        armed.fire()
+        result = armed.result()
+        return {"fire_ns": armed.fire_ns, "records": result.records}
+
+    def shutdown(self):
+        self.release_stream()
+        if self.fan_out is not None:
+            self.fan_out.shutdown()
+        self.handler.manager().stopSync()
+        self.handler.cleanup()
+        return None
+
+
+def _shard_main(index, addresses, env, connection, go, cancel, initializer, initargs, verbose):
+    """
+    Point d'entrée d'un shard : environnement de l'adaptateur, initialisation, puis boucle de requêtes.
+    """
+    os.environ.update(env or {})
+    if initializer is not None:
+        initializer(*initargs)
+    try:
+        worker = _ShardWorker(index, addresses, go, cancel, verbose)
+    except Exception as e:
+        connection.send(("error", str(e)))
+        return
+    connection.send(("ready", None))
+
+    while True:
+        op, kwargs = connection.recv()
+        try:
+            if op == "command":
+                reply = worker.command(connection, **kwargs)
+            else:
+                reply = getattr(worker, op)(**kwargs)
+            connection.send(("ok", reply))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+        if op == "shutdown":
+            break
+    connection.close()
+
+
+class ShardedAcquisition:
+    """
+    Coordinateur de l'acquisition répartie.
+    shards : une liste d'adresses par adaptateur, ou des dictionnaires
+             {"addresses": [...], "env": {...}} (variables d'environnement du processus,
+             par exemple pour choisir l'adaptateur Bluetooth)
+    initializer, initargs : fonction appelée dans chaque shard avant l'import du SDK
+                            (initializer(index, *initargs))
+    """
+
+    def __init__(self, shards, capacity=60 * 60 * 10, initializer=None, initargs=(),
+                 timeout=30.0, verbose=True):
+        self.shards = [shard if isinstance(shard, dict) else {"addresses": list(shard)}
+                       for shard in shards]
+        self.capacity = capacity
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.timeout = timeout
+        self.verbose = verbose
+        self.addresses = {}  # index du shard -> adresses connectées
+        self.buffers = {}    # adresse -> SharedDotRingBuffer (lecture par le coordinateur)
+        self._context = multiprocessing.get_context("spawn")
+        self._go = self._context.Event()
+        self._cancel = self._context.Event()  # Levé avec _go : les shards armés désarment
+        self._processes = []
+        self._connections = []
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def start(self):
+        """
+        Lance un processus par shard et attend l'initialisation de leur SDK.
+        """
+        for index, shard in enumerate(self.shards):
+            parent, child = self._context.Pipe()
+            initargs = (index,) + self.initargs if self.initializer is not None else ()
+            process = self._context.Process(
+                target=_shard_main, name=f"dot-shard-{index}", daemon=True,
+                args=(index, shard.get("addresses", []), shard.get("env"), child, self._go, self._cancel,
+                      self.initializer, initargs, False))
+            process.start()
+            child.close()
+            self._processes.append(process)
+            self._connections.append(parent)
+        self._collect("ready")
+        self._log(f"🟢 {len(self._processes)} shard(s) démarré(s).")
+        return self
+
+    def _receive(self, index, expected):
+        connection = self._connections[index]
+        if not connection.poll(self.timeout):
+            raise RuntimeError(f"Shard {index} : pas de réponse après {self.timeout:.0f} s")
+        try:
+            status, reply = connection.recv()
+        except EOFError:
+            raise RuntimeError(f"Shard {index} : processus terminé") from None
+        if status == "error":
+            raise RuntimeError(f"Shard {index} : {reply}")
+        if status != expected:
+            raise RuntimeError(f"Shard {index} : réponse inattendue {status}")
+        return reply
+
+    def _collect(self, expected="ok"):
+        return [self._receive(index, expected) for index in range(len(self._connections))]
+
+    def _collect_all(self, expected="ok", indices=None):
+        """
+        Comme _collect, mais lit la réponse de chaque shard même si un autre a échoué
+        (le protocole reste aligné). Renvoie (index -> réponse, index -> erreur).
+        """
+        replies, errors = {}, {}
+        for index in range(len(self._connections)) if indices is None else indices:
+            try:
+                replies[index] = self._receive(index, expected)
+            except RuntimeError as e:
+                errors[index] = e
+        return replies, errors
+
+    @staticmethod
+    def _raise_errors(errors):
+        if errors:
+            raise RuntimeError("; ".join(str(errors[index]) for index in sorted(errors)))
+
+    def _request(self, op, **kwargs):
+        """
+        Envoie la même requête à tous les shards (exécutée en parallèle) et renvoie leurs réponses.
+        """
+        for connection in self._connections:
+            connection.send((op, kwargs))
+        return self._collect()
+
+    def connect(self, scan_timeout=60.0):
+        t0 = time.perf_counter()
+        replies = self._request("connect", scan_timeout=scan_timeout)
+        self.addresses = dict(enumerate(replies))
+        total = sum(len(addresses) for addresses in replies)
+        self._log(f"🟢 {total} capteur(s) connecté(s) sur {len(replies)} shard(s) "
+                  f"en {time.perf_counter() - t0:.2f} s.")
+        return self.addresses
+
+    def synchronize(self, max_attempts=10):
+        """
+        Synchronise les capteurs de chaque shard (en parallèle). Renvoie True si tous ont réussi.
+        """
+        replies = self._request("sync", max_attempts=max_attempts)
+        for index, reply in enumerate(replies):
+            self.addresses[index] = reply["devices"]
+            status = "✅" if reply["ok"] else "❌"
+            self._log(f"{status} Shard {index} : {len(reply['devices'])} capteur(s), "
+                      f"maître {reply['root']}, {reply['elapsed_s']:.2f} s")
+        return all(reply["ok"] for reply in replies)
+
+    def broadcast(self, command, *args, timeout=10.0):
+        """
+        Arme la commande dans tous les shards, puis les libère ensemble (événement partagé).
+        Si un shard ne peut pas armer, les autres sont libérés avec l'annulation (la commande
+        n'est envoyée à aucun capteur) et toutes les réponses sont lues avant de lever l'erreur.
+        """
+        for connection in self._connections:
+            connection.send(("command", {"command": command, "args": args, "timeout": timeout}))
+        armed, errors = self._collect_all("armed")
+        if errors:
+            self._cancel.set()
+            self._go.set()
+            try:
+                self._collect_all("ok", armed)  # Réponses d'annulation des shards armés
+            finally:
+                self._go.clear()
+                self._cancel.clear()
+            self._raise_errors(errors)
+
+        fire_ns = time.perf_counter_ns()
+        self._go.set()
+        try:
+            replies, errors = self._collect_all()
+        finally:
+            self._go.clear()  # Tous les shards ont été libérés
+        self._raise_errors(errors)
+
+        records, shards = {}, {}
+        for index, reply in sorted(replies.items()):
+            shard_result = FanOutResult(command, reply["fire_ns"], reply["records"])
+            records.update(reply["records"])
+            shards[index] = (reply["fire_ns"] - fire_ns, shard_result.first_ack_ns,
+                             shard_result.skew_ns)
+        result = ShardFanOutResult(command, fire_ns, records, shards)
+        instrumentation.record_fan_out(result)
+        instrumentation.record(f"dot.{command}.shard_skew", result.shard_skew_ns)
+        return result
+
+    def start_streaming(self, output_rate=60):
+        """
+        Crée les tampons partagés, les confie aux shards et démarre la mesure sur tous les capteurs.
+        """
+        from dot_stream import SharedDotRingBuffer
+
+        names = []
+        for index in range(len(self._connections)):
+            shard_names = {}
+            for address in self.addresses.get(index, []):
+                buffer = SharedDotRingBuffer(self.capacity, create=True)
+                self.buffers[address] = buffer
+                shard_names[address] = buffer.name
+            names.append(shard_names)
+        for connection, shard_names in zip(self._connections, names):
+            connection.send(("prepare_stream", {"names": shard_names, "capacity": self.capacity,
+                                                "output_rate": output_rate}))
+        for reply in self._collect():
+            for address in reply["refused"]:
+                self._log(f"⚠️ Fréquence {output_rate} Hz refusée par {address}")
+
+        result = self.broadcast("startMeasurement")
+        if self.verbose:
+            result.report()
+        return result
+
+    def stop_streaming(self):
+        """
+        Arrête la mesure. Les tampons restent lisibles par le coordinateur jusqu'à close().
+        """
+        result = self.broadcast("stopMeasurement")
+        if self.verbose:
+            result.report()
+        self._request("release_stream")
+        return result
+
+    def close(self):
+        """
+        Arrête les shards (désynchronisation, fermeture du SDK) et supprime les tampons partagés.
+        """
+        try:
+            if self._connections:
+                self._request("shutdown")
+        finally:
+            for process in self._processes:
+                process.join(self.timeout)
+                if process.is_alive():
+                    process.terminate()
+            for connection in self._connections:
+                connection.close()
+            for buffer in self.buffers.values():
+                buffer.close(unlink=True)
+            self._processes, self._connections, self.buffers = [], [], {}
@@ -0,0 +1,221 @@
+import gc
+from multiprocessing import shared_memory
+
+import numpy as np
+import movelladot_pc_sdk
+
+from dot_commands import get_fan_out
+
+""" Streaming temps réel des capteurs Movella DOT :
+- Réception des paquets via le callback onLiveDataAvailable de XdpcHandler
+- Stockage dans un tampon circulaire NumPy préalloué par capteur (quaternion, accélération libre, sampleTimeFine)
+- Lecture sans copie par les consommateurs (vues NumPy sur le tampon)
+- Variante en mémoire partagée pour l'acquisition répartie sur plusieurs processus
+"""
+
+_SHARED_HEADER = 64  # Compteur d'échantillons (int64), aligné sur une ligne de cache
+
+
+class DotRingBuffer:
+    """
+    Tampon circulaire préalloué pour un capteur.
+    Un seul producteur (callback du SDK), un ou plusieurs consommateurs avec leur propre curseur.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.quaternion = np.zeros((capacity, 4), dtype=np.float32)  # w, x, y, z
+        self.free_acceleration = np.zeros((capacity, 3), dtype=np.float32)
+        self.sample_time_fine = np.zeros(capacity, dtype=np.uint32)  # µs, reboucle à 2^32
+        self.packet_counter = np.zeros(capacity, dtype=np.uint32)
+        self.count = 0  # Nombre total d'échantillons écrits depuis le début
+
+    def push(self, qw, qx, qy, qz, ax, ay, az, sample_time_fine, packet_counter):
+        """
+        Écrit un échantillon en place (aucune allocation de tableau).
+        """
+        i = self.count % self.capacity
+        quaternion = self.quaternion
+        quaternion[i, 0] = qw
+        quaternion[i, 1] = qx
+        quaternion[i, 2] = qy
+        quaternion[i, 3] = qz
+        acceleration = self.free_acceleration
+        acceleration[i, 0] = ax
+        acceleration[i, 1] = ay
+        acceleration[i, 2] = az
+        self.sample_time_fine[i] = sample_time_fine
+        self.packet_counter[i] = packet_counter
+        # Publication de l'échantillon une fois toutes les colonnes écrites
+        self.count += 1
+
+    def segments(self, start, stop=None):
+        """
+        Renvoie les tranches du tampon couvrant les échantillons absolus [start, stop).
+        Les échantillons déjà écrasés sont ignorés.
+        """
+        stop = self.count if stop is None else min(stop, self.count)
+        start = max(start, stop - self.capacity, 0)
+        if stop <= start:
+            return []
+        i0 = start % self.capacity
+        i1 = i0 + (stop - start)
+        if i1 <= self.capacity:
+            return [slice(i0, i1)]
+        return [slice(i0, self.capacity), slice(0, i1 - self.capacity)]
+
+    def views(self, segment):
+        """
+        Vues NumPy (sans copie) des colonnes pour une tranche renvoyée par segments().
+        """
+        return {
+            "quaternion": self.quaternion[segment],
+            "free_acceleration": self.free_acceleration[segment],
+            "sample_time_fine": self.sample_time_fine[segment],
+            "packet_counter": self.packet_counter[segment],
+        }
+
+    def read_since(self, cursor):
+        """
+        Renvoie (liste de vues, nouveau curseur, nombre d'échantillons perdus)
+        pour un consommateur qui a déjà lu jusqu'à l'échantillon absolu cursor.
+        """
+        stop = self.count
+        lost = max(0, stop - self.capacity - cursor)
+        blocks = [self.views(segment) for segment in self.segments(cursor, stop)]
+        return blocks, stop, lost
+
+    def latest(self, n):
+        """
+        Vues des n derniers échantillons (une ou deux tranches).
+        """
+        return [self.views(segment) for segment in self.segments(self.count - n)]
+
+
+def _shared_layout(capacity):
+    """
+    Position des colonnes dans le segment de mémoire partagée. Renvoie (colonnes, taille totale).
+    """
+    columns = (("quaternion", np.float32, (capacity, 4)),
+               ("free_acceleration", np.float32, (capacity, 3)),
+               ("sample_time_fine", np.uint32, (capacity,)),
+               ("packet_counter", np.uint32, (capacity,)))
+    layout = []
+    offset = _SHARED_HEADER
+    for name, dtype, shape in columns:
+        layout.append((name, dtype, shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, offset
+
+
+class SharedDotRingBuffer(DotRingBuffer):
+    """
+    Tampon circulaire dont les colonnes et le compteur sont dans un segment de mémoire partagée.
+    Le processus propriétaire le crée (create=True) et le supprime (unlink) ; le processus
+    d'acquisition s'y attache par son nom et y écrit avec push(). Aucune copie ni sérialisation.
+    """
+
+    def __init__(self, capacity, name=None, create=False):
+        layout, size = _shared_layout(capacity)
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        self._header = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        for column, dtype, shape, offset in layout:
+            setattr(self, column, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+        if create:
+            self._header[0] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        return int(self._header[0])
+
+    @count.setter
+    def count(self, value):
+        # Écrit en dernier par push() : les colonnes de l'échantillon sont déjà en place
+        self._header[0] = value
+
+    def close(self, unlink=False):
+        """
+        Libère les vues NumPy puis le segment (unlink=True pour le processus propriétaire).
+        """
+        self._header = self.quaternion = self.free_acceleration = None
+        self.sample_time_fine = self.packet_counter = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class DotStreamer:
+    """
+    Streaming temps réel de plusieurs capteurs vers leurs tampons circulaires.
+    """
+
+    def __init__(self, devices, capacity=60 * 60 * 10,
+                 payload_mode=movelladot_pc_sdk.XsPayloadMode_ExtendedQuaternion, buffers=None):
+        """
+        buffers : tampons fournis par l'appelant (adresse -> tampon), par exemple en mémoire partagée
+        """
+        self.devices = list(devices)
+        self.payload_mode = payload_mode
+        self.buffers = buffers if buffers is not None else {
+            device.bluetoothAddress(): DotRingBuffer(capacity) for device in self.devices}
+        self._xdpc_handler = None
+        self._previous_callback = None
+
+    def attach(self, xdpc_handler):
+        """
+        Remplace le callback onLiveDataAvailable de XdpcHandler par l'écriture dans les tampons.
+        """
+        self._xdpc_handler = xdpc_handler
+        self._previous_callback = xdpc_handler.onLiveDataAvailable
+        xdpc_handler.onLiveDataAvailable = self.on_live_data_available
+
+    def detach(self):
+        if self._xdpc_handler is not None:
+            self._xdpc_handler.onLiveDataAvailable = self._previous_callback
+            self._xdpc_handler = None
+
+    def on_live_data_available(self, device, packet):
+        """
+        Callback du SDK (thread du SDK) : copie les champs du paquet dans le tampon du capteur.
+        """
+        buffer = self.buffers.get(device.bluetoothAddress())
+        if buffer is None or not packet.containsOrientation():
+            return
+        q = packet.orientationQuaternion()
+        a = packet.freeAcceleration()
+        buffer.push(q[0], q[1], q[2], q[3], a[0], a[1], a[2],
+                    packet.sampleTimeFine(), packet.packetCounter())
+
+    def start(self, output_rate=60, freeze_gc=True, verbose=True):
+        """
+        Configure la fréquence de sortie et démarre la mesure sur tous les capteurs.
+        """
+        for device in self.devices:
+            if not device.setOutputRate(output_rate) and verbose:
+                print(
+                    f"⚠️ Fréquence {output_rate} Hz refusée par {device.bluetoothAddress()} : {device.lastResultText()}")
+
+        if freeze_gc:
+            # Les objets créés pendant l'initialisation ne sont plus parcourus par le GC
+            gc.collect()
+            gc.freeze()
+
+        result = get_fan_out(self.devices).run("startMeasurement", self.payload_mode)
+        if verbose:
+            result.report()
+        return result
+
+    def stop(self, verbose=True):
+        """
+        Arrête la mesure sur tous les capteurs.
+        """
+        result = get_fan_out(self.devices).run("stopMeasurement")
+        if verbose:
+            result.report()
+        gc.unfreeze()
+        return result
@@ -0,0 +1,251 @@
+import json
+import os
+import re
+
+import numpy as np
+
+from session_file import DOT_DTYPE, SESSION_VERSION, dot_stream_name, qtm_dtype
+
+""" Lecture des essais enregistrés en mode embarqué, après export :
+- Un CSV par capteur écrit par dot_export (<tag>_<adresse>_rec<n>.csv, export « between » :
+  un dossier par essai, un enregistrement par capteur)
+- Exports TSV de QTM placés dans le même dossier : trajectoires 3D (<essai>.tsv)
+  et corps rigides 6D (<essai>_6D.tsv), reconnus par leur en-tête DATA_INCLUDED
+- Même interface que SessionReader (metadata, streams, dot(), qtm())
+- Avec cache_dir, chaque export texte est converti une seule fois en .npy (même dtype que la
+  session) puis projeté en mémoire (np.load(mmap_mode="r")) ; sans cache, données chargées en mémoire
+Les CSV DOT n'ont pas de compteur de paquets : il est remplacé par le numéro de ligne.
+Les temps QTM sont ceux de la colonne Time de l'export (s depuis le début de la mesure).
+"""
+
+DOT_EXPORT_PATTERN = re.compile(r"^(?P<tag>.*)_(?P<address>[0-9A-Fa-f]{12})_rec(?P<index>\d+)\.csv$")
+
+
+def _format_address(compact):
+    return ":".join(compact[i:i + 2] for i in range(0, 12, 2)).upper()
+
+
+def dot_export_files(path):
+    """
+    CSV DOT exportés d'un dossier : adresse -> (tag, numéro d'enregistrement, nom du fichier).
+    """
+    found = {}
+    for name in sorted(os.listdir(path)):
+        match = DOT_EXPORT_PATTERN.match(name)
+        if match is None:
+            continue
+        address = _format_address(match["address"])
+        if address in found:
+            raise ValueError(f"plusieurs enregistrements de {address} dans {path} "
+                             "(un dossier par essai attendu)")
+        found[address] = (match["tag"], int(match["index"]), name)
+    return found
+
+
+def qtm_export_files(path):
+    """
+    Exports TSV de QTM d'un dossier : {"3D": nom, "6D": nom} (types présents seulement).
+    """
+    found = {}
+    for name in sorted(os.listdir(path)):
+        if not name.lower().endswith(".tsv"):
+            continue
+        header, _, _ = read_qtm_tsv_header(os.path.join(path, name))
+        kind = header.get("DATA_INCLUDED", ["3D"])[0]
+        if kind in ("3D", "6D"):
+            if kind in found:
+                raise ValueError(f"plusieurs exports QTM {kind} dans {path}")
+            found[kind] = name
+    return found
+
+
+def exported_trial_files(path):
+    """
+    Fichiers d'un essai exporté (CSV DOT et exports QTM), triés, sans lire les données.
+    """
+    names = [name for _, _, name in dot_export_files(path).values()]
+    return sorted(names + list(qtm_export_files(path).values()))
+
+
+def read_qtm_tsv_header(path):
+    """
+    En-tête d'un export TSV de QTM. Renvoie (mots-clés -> valeurs, noms de colonnes ou None,
+    nombre de lignes avant les données).
+    """
+    header = {}
+    columns = None
+    skip = 0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if not line.strip():
+                skip += 1
+                continue
+            if fields[0] == "Frame":
+                columns = fields
+                skip += 1
+                break
+            if not re.match(r"^[A-Z][A-Z0-9_]*$", fields[0]):
+                break  # Première ligne de données (export sans noms de colonnes)
+            header[fields[0]] = fields[1:]
+            skip += 1
+    return header, columns, skip
+
+
+def read_qtm_tsv(path):
+    """
+    Export TSV de QTM. Renvoie (en-tête, numéros de trame, temps en s, données (n, colonnes)).
+    Sans colonnes Frame et Time, les trames sont numérotées et datées d'après FREQUENCY.
+    """
+    header, columns, skip = read_qtm_tsv_header(path)
+    data = np.atleast_2d(np.genfromtxt(path, delimiter="\t", skip_header=skip, dtype=np.float64))
+    if columns is not None:
+        data = data[:, :len(columns)]
+    elif data.shape[1] and np.isnan(data[:, -1]).all():
+        data = data[:, :-1]  # Tabulation en fin de ligne
+    if columns is not None and len(columns) > 1 and columns[1] == "Time":
+        frames, times, data = data[:, 0].astype(np.int64), data[:, 1], data[:, 2:]
+    else:
+        frequency = float(header["FREQUENCY"][0])
+        frames = np.arange(1, len(data) + 1, dtype=np.int64)
+        times = (frames - 1) / frequency
+    return header, frames, times, data
+
+
+class ExportedTrialReader:
+    """
+    Essai exporté vu comme une session (mêmes méthodes que SessionReader).
+    cache_dir : dossier des conversions .npy, propre au contenu de l'essai (None : pas de cache)
+    """
+
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._cache = {}
+        streams = {}
+        devices = {}
+        for address, (tag, index, name) in dot_export_files(path).items():
+            progress = os.path.join(path, name + ".progress")  # Fichier de reprise de dot_export
+            if os.path.exists(progress):
+                with open(progress, encoding="utf-8") as f:
+                    if not json.load(f).get("done"):
+                        raise ValueError(f"export incomplet : {name}")
+            streams[dot_stream_name(address)] = {"file": name, "kind": "dot", "address": address,
+                                                 "tag": tag, "recording": index}
+            devices[address] = tag
+
+        self.qtm_files = qtm_export_files(path)
+        metadata = {"version": SESSION_VERSION, "source": "export", "devices": devices}
+        if self.qtm_files:
+            self._read_qtm_headers()
+            streams["qtm"] = {"file": self.qtm_files.get("6D") or self.qtm_files["3D"], "kind": "qtm",
+                              "marker_labels": self._marker_labels,
+                              "body_names": self._body_names, "frequency": self._frequency}
+            metadata["qtm_capture"] = {"frequency": self._frequency, "marker_labels": self._marker_labels,
+                                       "body_names": self._body_names}
+        metadata["streams"] = streams
+        self.metadata = metadata
+        if self.qtm_files:
+            streams["qtm"]["rows"] = len(self.qtm())
+
+    @property
+    def streams(self):
+        return self.metadata["streams"]
+
+    def _read_qtm_headers(self):
+        self._marker_labels, self._body_names, self._frequency = [], [], None
+        if "3D" in self.qtm_files:
+            header, _, _ = read_qtm_tsv_header(os.path.join(self.path, self.qtm_files["3D"]))
+            self._marker_labels = header.get("MARKER_NAMES", [])
+            self._frequency = float(header["FREQUENCY"][0])
+        if "6D" in self.qtm_files:
+            header, _, _ = read_qtm_tsv_header(os.path.join(self.path, self.qtm_files["6D"]))
+            self._body_names = header.get("BODY_NAMES", [])
+            self._frequency = self._frequency or float(header["FREQUENCY"][0])
+
+    def _load(self, info, parse):
+        """
+        Données d'un flux : conversion mise en cache (.npy projeté en mémoire) ou lecture directe.
+        """
+        if self.cache_dir is None:
+            return parse(info)
+        cached = os.path.join(self.cache_dir, info["file"] + ".npy")
+        if not os.path.exists(cached):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = cached + ".tmp.npy"
+            np.save(tmp, parse(info))
+            os.replace(tmp, cached)  # Pas de conversion partielle visible
+        return np.load(cached, mmap_mode="r")
+
+    def _read_qtm(self, info=None):
+        markers = bodies = None
+        if "3D" in self.qtm_files:
+            _, frames, times, data = read_qtm_tsv(os.path.join(self.path, self.qtm_files["3D"]))
+            markers = (frames, times, data[:, :3 * len(self._marker_labels)])
+        if "6D" in self.qtm_files:
+            _, frames, times, data = read_qtm_tsv(os.path.join(self.path, self.qtm_files["6D"]))
+            bodies = (frames, times, data, self._body_columns(self.qtm_files["6D"], data.shape[1]))
+
+        n = min(len(source[0]) for source in (markers, bodies) if source is not None)
+        n_markers, n_bodies = len(self._marker_labels), len(self._body_names)
+        qtm = np.zeros(n, dtype=qtm_dtype(n_markers, n_bodies))
+        frames, times = (bodies or markers)[:2]
+        qtm["frame_number"] = frames[:n]
+        qtm["timestamp"] = np.rint(times[:n] * 1e6).astype(np.int64)
+        if markers is not None:
+            xyz = markers[2][:n].reshape(n, n_markers, 3)
+            # Trajectoire absente : exportée à 0, 0, 0
+            qtm["markers"] = np.where((xyz == 0).all(axis=-1, keepdims=True), np.nan, xyz)
+        else:
+            qtm["markers"] = np.nan
+        if bodies is not None:
+            data, (position, rotation) = bodies[2][:n], bodies[3]
+            qtm["body_position"] = data[:, position].reshape(n, n_bodies, 3)
+            qtm["body_rotation"] = data[:, rotation].reshape(n, n_bodies, 9)
+        else:
+            qtm["body_position"] = qtm["body_rotation"] = np.nan
+        return qtm
+
+    def _body_columns(self, name, n_columns):
+        """
+        Colonnes de position (X, Y, Z) et de rotation (Rot[0] à Rot[8]) de chaque corps
+        rigide d'un export 6D : un bloc de colonnes par corps, dans l'ordre de BODY_NAMES.
+        """
+        _, columns, _ = read_qtm_tsv_header(os.path.join(self.path, name))
+        n_bodies = len(self._body_names)
+        width = n_columns // n_bodies if n_bodies else 0
+        names = columns[2:] if columns is not None else [""] * n_columns
+        position, rotation = [], []
+        for b in range(n_bodies):
+            block = list(range(b * width, (b + 1) * width))
+            rot = [c for c in block if "Rot[" in names[c]] or block[-9:]
+            position += block[:3]
+            rotation += rot[:9]
+        return np.array(position, dtype=np.int64), np.array(rotation, dtype=np.int64)
+
+    def _read_dot(self, info):
+        table = np.loadtxt(os.path.join(self.path, info["file"]), delimiter=",", skiprows=1,
+                           ndmin=2, dtype=np.float64)
+        data = np.zeros(len(table), dtype=DOT_DTYPE)
+        data["sample_time_fine"] = table[:, 0].astype(np.uint32)
+        data["packet_counter"] = np.arange(len(table)) & 0xFFFF
+        data["quaternion"] = table[:, 1:5]
+        data["free_acceleration"] = table[:, 5:8]
+        return data
+
+    def stream(self, name):
+        if name not in self._cache:
+            info = self.streams[name]
+            parse = self._read_qtm if name == "qtm" else self._read_dot
+            self._cache[name] = self._load(info, parse)
+            info["rows"] = len(self._cache[name])
+        return self._cache[name]
+
+    def dot(self, address):
+        return self.stream(dot_stream_name(address))
+
+    def dot_addresses(self):
+        return [info["address"] for info in self.streams.values() if info.get("kind") == "dot"]
+
+    def qtm(self):
+        return self.stream("qtm")
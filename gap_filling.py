@@ -0,0 +1,219 @@
+import numpy as np
+
+from clock_alignment import STF_WRAP
+from health_monitor import PACKET_COUNTER_WRAP
+from resampling import slerp
+from session_file import DOT_DTYPE
+
+""" Détection et comblement des trous du streaming DOT (paquets BLE perdus) :
+- Trous détectés par capteur à partir de sampleTimeFine et des compteurs de paquets
+- Sortie dense (un échantillon par période) avec un état par échantillon : mesuré, comblé, manquant
+- Trous courts comblés par interpolation vectorisée (linéaire, slerp pour les quaternions)
+- Latence ajoutée bornée : les échantillons mesurés sont émis immédiatement, un trou encore
+  ouvert après lookahead_s est émis comme manquant
+- Statistiques des trous par capteur (métadonnées de la session)
+"""
+
+MEASURED, FILLED, MISSING = 0, 1, 2
+
+GAP_DTYPE = np.dtype(DOT_DTYPE.descr + [("status", "u1")])
+
+
+def dense_stream_name(address):
+    return "dense_" + address.replace(":", "")
+
+
+class _DeviceGaps:
+    """
+    État d'un capteur : dernier échantillon mesuré émis (ancre) et statistiques.
+    """
+
+    def __init__(self):
+        self.cursor = 0
+        self.last_raw = None     # Dernier sampleTimeFine brut lu
+        self.last_t = None       # Même instant, déroulé (µs)
+        self.anchor = None       # (position, t µs, compteur, quaternion, accélération)
+        self.next_pos = 0        # Première position dense non émise
+        self.received = 0
+        self.filled = 0
+        self.missing = 0
+        self.gaps = 0
+        self.longest_gap = 0
+        self.late = 0            # Échantillons arrivés après l'émission de leur position
+        self.counter_mismatch = 0  # Compteur de paquets incohérent avec sampleTimeFine
+
+    def statistics(self):
+        total = self.received + self.filled + self.missing
+        return {
+            "received": self.received,
+            "gaps": self.gaps,
+            "filled": self.filled,
+            "missing": self.missing,
+            "longest_gap": self.longest_gap,
+            "late": self.late,
+            "counter_mismatch": self.counter_mismatch,
+            "missing_ratio": (self.filled + self.missing) / total if total else 0.0,
+        }
+
+
+class GapFiller:
+    """
+    Étape de streaming : lit les tampons DOT et produit des blocs denses GAP_DTYPE par capteur.
+
+    output_rate : fréquence de sortie des capteurs (Hz)
+    max_gap_s : trous comblés jusqu'à cette durée (au plus lookahead_s)
+    lookahead_s : délai maximal d'émission d'une position sans échantillon mesuré
+    """
+
+    def __init__(self, addresses, output_rate=60, max_gap_s=0.1, lookahead_s=0.2):
+        self.addresses = list(addresses)
+        self.period_us = 1e6 / output_rate
+        self.lookahead = max(1, int(round(lookahead_s * output_rate)))
+        self.max_fill = min(int(round(max_gap_s * output_rate)), self.lookahead)
+        self.devices = {address: _DeviceGaps() for address in self.addresses}
+        self._reference_raw = None  # Premier sampleTimeFine, commun à tous les capteurs
+
+    def _unwrap(self, state, raw):
+        """
+        sampleTimeFine brut -> µs déroulés, continus d'un bloc à l'autre et communs aux capteurs.
+        """
+        raw = raw.astype(np.int64)
+        if self._reference_raw is None:
+            self._reference_raw = int(raw[0])
+        if state.last_raw is None:
+            state.last_raw = int(raw[0])
+            # Écart signé à la référence : le premier échantillon d'un capteur peut la précéder
+            offset = (int(raw[0]) - self._reference_raw + STF_WRAP // 2) % STF_WRAP - STF_WRAP // 2
+            state.last_t = self._reference_raw + offset
+        steps = np.diff(np.concatenate([[state.last_raw], raw])) % STF_WRAP
+        t = state.last_t + np.cumsum(steps)
+        state.last_raw, state.last_t = int(raw[-1]), int(t[-1])
+        return t
+
+    def _dense(self, state, t, counter, quaternion, acceleration, now_us):
+        """
+        Positions denses de la première position non émise jusqu'à la limite d'émission
+        (dernier échantillon mesuré, ou maintenant - lookahead pour un trou encore ouvert).
+        """
+        period = self.period_us
+        if state.anchor is None:
+            if not len(t):
+                return np.zeros(0, dtype=GAP_DTYPE)
+            # Premier échantillon : ancre à la position 0, émise avec les suivants
+            state.anchor = (0, t[0], counter[0], quaternion[0], acceleration[0])
+            state.next_pos = 0
+            t, counter, quaternion, acceleration = t[1:], counter[1:], quaternion[1:], acceleration[1:]
+
+        a_pos, a_t, a_counter, a_q, a_a = state.anchor
+        positions = np.zeros(0, dtype=np.int64)
+        if len(t):
+            # Pas entre échantillons successifs : compteur de paquets s'il est cohérent avec le temps
+            time_steps = np.rint(np.diff(np.concatenate([[a_t], t])) / period).astype(np.int64)
+            counter_steps = np.diff(np.concatenate([[a_counter], counter])) % PACKET_COUNTER_WRAP
+            agree = np.abs(counter_steps - time_steps) <= 1
+            state.counter_mismatch += int((~agree).sum())
+            steps = np.where(agree, counter_steps, time_steps)
+            positions = a_pos + np.cumsum(np.maximum(steps, 0))
+            # Doublons et échantillons dont la position a déjà été émise (manquante)
+            keep = (steps > 0) & (positions >= state.next_pos)
+            state.late += int((~keep).sum())
+            positions, t, counter = positions[keep], t[keep], counter[keep]
+            quaternion, acceleration = quaternion[keep], acceleration[keep]
+
+        real_pos = np.concatenate([[a_pos], positions])
+        real_t = np.concatenate([[a_t], t])
+        real_counter = np.concatenate([[a_counter], counter])
+        real_q = np.concatenate([a_q[None], quaternion]).astype(np.float64)
+        real_a = np.concatenate([a_a[None], acceleration]).astype(np.float64)
+
+        now_pos = a_pos + int(np.floor((now_us - a_t) / period))
+        limit = max(int(real_pos[-1]), now_pos - self.lookahead)
+        slots = np.arange(state.next_pos, limit + 1)
+        if not len(slots):
+            return np.zeros(0, dtype=GAP_DTYPE)
+
+        # Échantillon mesuré précédent (j) et suivant (k) de chaque position
+        j = np.searchsorted(real_pos, slots, side="right") - 1
+        k = np.minimum(j + 1, len(real_pos) - 1)
+        is_real = real_pos[j] == slots
+        closed = j + 1 < len(real_pos)
+        span = np.where(closed, real_pos[k] - real_pos[j], 1)
+        fill = ~is_real & closed & (span - 1 <= self.max_fill)
+        missing = ~is_real & ~fill
+        w = np.where(fill, (slots - real_pos[j]) / span, 0.0)
+
+        out = np.zeros(len(slots), dtype=GAP_DTYPE)
+        t_out = np.where(fill, real_t[j] + w * (real_t[k] - real_t[j]),
+                         real_t[j] + (slots - real_pos[j]) * period)
+        out["sample_time_fine"] = np.rint(t_out).astype(np.int64) % STF_WRAP
+        out["packet_counter"] = (real_counter[j] + (slots - real_pos[j])) % PACKET_COUNTER_WRAP
+        out["quaternion"] = np.where(missing[:, None], np.nan, slerp(real_q[j], real_q[k], w))
+        acceleration_out = real_a[j] + w[:, None] * (real_a[k] - real_a[j])
+        out["free_acceleration"] = np.where(missing[:, None], np.nan, acceleration_out)
+        out["status"] = np.where(is_real, MEASURED, np.where(fill, FILLED, MISSING))
+
+        state.received += int(is_real.sum())
+        state.filled += int(fill.sum())
+        state.missing += int(missing.sum())
+        state.gaps += int((~is_real & (slots == real_pos[j] + 1)).sum())
+        if (~is_real & closed).any():
+            state.longest_gap = max(state.longest_gap, int(span[~is_real & closed].max()) - 1)
+
+        last = len(real_pos) - 1
+        state.anchor = (int(real_pos[last]), real_t[last], real_counter[last], real_q[last], real_a[last])
+        state.next_pos = limit + 1
+        return out
+
+    def update(self, dot_streamer, final=False):
+        """
+        Traite les nouveaux échantillons des tampons. Renvoie adresse -> bloc dense GAP_DTYPE.
+        final=True émet aussi les trous encore ouverts (fin de capture).
+        """
+        new = {}
+        for address in self.addresses:
+            state = self.devices[address]
+            blocks, cursor, _ = dot_streamer.buffers[address].read_since(state.cursor)
+            state.cursor = cursor
+            if not blocks:
+                new[address] = None
+                continue
+            raw = np.concatenate([block["sample_time_fine"] for block in blocks])
+            new[address] = (self._unwrap(state, raw),
+                            np.concatenate([block["packet_counter"] for block in blocks]).astype(np.int64),
+                            np.concatenate([block["quaternion"] for block in blocks]),
+                            np.concatenate([block["free_acceleration"] for block in blocks]))
+
+        known = [state.last_t for state in self.devices.values() if state.last_t is not None]
+        if not known:
+            return {}
+        # Horloge commune (capteurs synchronisés) : instant le plus récent reçu tous capteurs confondus
+        now_us = max(known) + (self.lookahead * self.period_us if final else 0)
+
+        out = {}
+        for address in self.addresses:
+            state = self.devices[address]
+            samples = new[address] or (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                                        np.zeros((0, 4)), np.zeros((0, 3)))
+            block = self._dense(state, *samples, now_us)
+            if len(block):
+                out[address] = block
+        return out
+
+    def statistics(self):
+        return {address: state.statistics() for address, state in self.devices.items()}
+
+    def report(self):
+        for address, stats in self.statistics().items():
+            print(f"🩹 {address} : {stats['gaps']} trou(s), {stats['filled']} échantillon(s) comblé(s), "
+                  f"{stats['missing']} manquant(s), plus long {stats['longest_gap']}")
+
+
+def write_dense(writer, gap_filler, dot_streamer, final=False):
+    """
+    Ajoute les nouveaux blocs denses aux flux dense_<adresse> d'un fichier de session.
+    final=True : fin de capture, statistiques des trous écrites dans les métadonnées.
+    """
+    for address, block in gap_filler.update(dot_streamer, final=final).items():
+        writer.append(dense_stream_name(address), block)
+    if final:
+        writer.set_metadata(gaps=gap_filler.statistics())
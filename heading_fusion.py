@@ -0,0 +1,266 @@
+import numpy as np
+
+from clock_alignment import STF_WRAP, command_marker_prior
+from resampling import pad_streams, rotation_matrix_to_quaternion, slerp
+
+""" Fusion temps réel IMU / mocap : correction du cap des capteurs Movella DOT par les corps rigides QTM :
+- Association capteur -> corps rigide configurable (body_map) et orientation de montage optionnelle
+- Corps rigides interpolés (slerp) aux instants des échantillons DOT, par recherche groupée
+- Filtre complémentaire sur le cap, calculé pour tous les capteurs et tous les échantillons d'un bloc
+  à la fois (récurrence du premier ordre résolue par produits cumulés)
+- Corps rigide masqué (marqueurs occultés) : le cap est conservé et l'IMU continue seule
+Convention : axe vertical Z pour QTM et pour le repère global DOT, quaternions w, x, y, z.
+"""
+
+FUSION_DTYPE = np.dtype([
+    ("sample_time_fine", "<u4"),
+    ("t_qtm", "<f8"),               # Instant de l'échantillon sur l'horloge QTM (s)
+    ("quaternion", "<f4", (4,)),    # Orientation du segment (repère QTM), NaN avant le premier recalage
+    ("heading", "<f4"),             # Correction de cap appliquée (rad)
+    ("corrected", "?"),             # Corps rigide visible pour cet échantillon
+])
+
+_CHUNK = 64  # Longueur maximale d'un produit cumulé (pas de sous-dépassement)
+
+
+def fusion_stream_name(address):
+    return "fused_" + address.replace(":", "")
+
+
+def quaternion_multiply(a, b):
+    """
+    Produit de Hamilton vectorisé (..., 4).
+    """
+    aw, ax, ay, az = np.moveaxis(a, -1, 0)
+    bw, bx, by, bz = np.moveaxis(b, -1, 0)
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], axis=-1)
+
+
+def quaternion_conjugate(q):
+    return q * np.array([1.0, -1.0, -1.0, -1.0])
+
+
+def heading_quaternion(angle):
+    """
+    Rotation d'angle angle (rad) autour de l'axe vertical, (..., 4).
+    """
+    half = 0.5 * np.asarray(angle, dtype=np.float64)
+    zero = np.zeros_like(half)
+    return np.stack([np.cos(half), zero, zero, np.sin(half)], axis=-1)
+
+
+def twist_angle(q):
+    """
+    Angle de la composante de rotation autour de l'axe vertical (décomposition swing-twist).
+    """
+    return 2.0 * np.arctan2(q[..., 3], q[..., 0])
+
+
+def _wrap(angle):
+    return (angle + np.pi) % (2.0 * np.pi) - np.pi
+
+
+def complementary_heading(measured, gain, initial):
+    """
+    Filtre complémentaire h_k = (1 - g_k) h_k-1 + g_k m_k pour toutes les lignes (D, N) à la fois.
+    Un gain nul conserve le cap (mesure absente). Renvoie les caps (D, N).
+    """
+    a = 1.0 - gain
+    headings = np.empty_like(measured)
+    h = np.asarray(initial, dtype=np.float64).copy()
+    for start in range(0, measured.shape[1], _CHUNK):
+        stop = min(start + _CHUNK, measured.shape[1])
+        # h_k = P_k (h_0 + somme_j g_j m_j / P_j), avec P_k = produit des a_j pour j <= k
+        p = np.cumprod(a[:, start:stop], axis=1)
+        terms = np.where(gain[:, start:stop] > 0, gain[:, start:stop] * measured[:, start:stop], 0.0)
+        headings[:, start:stop] = p * (h[:, None] + np.cumsum(terms / p, axis=1))
+        h = headings[:, stop - 1]
+    return headings
+
+
+class HeadingFusion:
+    """
+    Correction de cap en ligne pour les capteurs associés à un corps rigide QTM.
+
+    body_map : adresse Bluetooth -> nom du corps rigide (même format que pour l'alignement d'horloge)
+    body_names : noms des corps rigides dans l'ordre du flux QTM
+    mounts : adresse -> quaternion capteur dans le repère du corps rigide (identité par défaut)
+    time_constant : constante de temps (s) du recalage du cap
+    offset_s : t_qtm = t_dot + offset_s ; None pour l'estimer à partir des repères de démarrage
+    start_markers : {"dot_ack_ns": ..., "qtm_ack_ns": ...} du chemin de démarrage
+    """
+
+    def __init__(self, body_map, body_names, mounts=None, time_constant=2.0, offset_s=None,
+                 start_markers=None, max_gap_s=0.05, qtm_window_s=1.0):
+        self.addresses = [address for address, body in body_map.items() if body in body_names]
+        self.body_index = np.array([body_names.index(body_map[a]) for a in self.addresses], dtype=np.int64)
+        mounts = mounts or {}
+        self.mounts = np.array([mounts.get(a, (1.0, 0.0, 0.0, 0.0)) for a in self.addresses],
+                               dtype=np.float64)[:, None, :]
+        self.time_constant = time_constant
+        self.offset_s = offset_s
+        self.start_markers = start_markers
+        self.max_gap_s = max_gap_s
+        self.qtm_window_s = qtm_window_s
+
+        n = len(self.addresses)
+        self.heading = np.full(n, np.nan)  # NaN tant que le corps rigide n'a jamais été vu
+        self.corrected = np.zeros(n, dtype=np.int64)  # Échantillons recalés par capteur
+        self.imu_only = np.zeros(n, dtype=np.int64)   # Échantillons sans corps rigide visible
+        self._cursors = np.zeros(n, dtype=np.int64)
+        self._last_stf = np.full(n, np.nan)
+        self._last_t = np.zeros(n)
+        self._reference_stf = None
+        self._t_first = None
+
+    def _dot_times(self, stf, lengths):
+        """
+        Temps DOT déroulés (s), continus d'un bloc à l'autre et communs aux capteurs
+        (origine : premier sampleTimeFine reçu, tous capteurs confondus). stf : (D, N) complété par NaN.
+        """
+        new = np.isnan(self._last_stf) & (lengths > 0)
+        if new.any():
+            if self._reference_stf is None:
+                self._reference_stf = float(stf[new, 0][0])
+            # Écart signé à la référence : un capteur démarré plus tôt la précède
+            offset = (stf[new, 0] - self._reference_stf + STF_WRAP // 2) % STF_WRAP - STF_WRAP // 2
+            self._last_t[new] = offset / 1e6
+        previous = np.where(np.isnan(self._last_stf), stf[:, 0], self._last_stf)
+        steps = np.diff(np.concatenate([previous[:, None], stf], axis=1), axis=1)
+        steps[steps < 0] += STF_WRAP
+        t = self._last_t[:, None] + np.cumsum(np.nan_to_num(steps), axis=1) / 1e6
+        has = lengths > 0
+        last = np.maximum(lengths - 1, 0)
+        rows = np.arange(len(lengths))
+        self._last_stf[has] = stf[rows, last][has]
+        self._last_t[has] = t[rows, last][has]
+        return t
+
+    def _offset(self, t_dot_first, qtm_t0):
+        if self.offset_s is None:
+            if self.start_markers and self.start_markers.get("dot_ack_ns") and self.start_markers.get("qtm_ack_ns"):
+                self.offset_s = command_marker_prior(self.start_markers["dot_ack_ns"],
+                                                     self.start_markers["qtm_ack_ns"], t_dot_first, qtm_t0)
+            else:
+                self.offset_s = qtm_t0 - t_dot_first  # Démarrages supposés simultanés
+        return self.offset_s
+
+    def _reference(self, t_qtm, mask, qtm_frames):
+        """
+        Orientation de référence du capteur (corps rigide interpolé puis montage) et validité, (D, N).
+        """
+        frames = qtm_frames.frames()
+        times = frames["timestamp"] / 1e6
+        d, n = t_qtm.shape
+        if len(times) < 2:
+            return np.full((d, n, 4), np.nan), np.zeros((d, n), dtype=bool)
+
+        start = max(0, int(np.searchsorted(times, np.nanmin(t_qtm) - self.qtm_window_s)) - 1)
+        times = times[start:]
+        bodies = rotation_matrix_to_quaternion(frames["body_rotation"][start:, self.body_index])  # (M, D, 4)
+
+        index = np.searchsorted(times, np.nan_to_num(t_qtm, nan=-np.inf), side="right")
+        i0 = np.clip(index - 1, 0, len(times) - 2)
+        i1 = i0 + 1
+        dt = times[i1] - times[i0]
+        w = np.clip((t_qtm - times[i0]) / np.where(dt > 0, dt, 1.0), 0.0, 1.0)
+        rows = np.arange(d)[:, None]
+        q0 = bodies[i0, rows]
+        q1 = bodies[i1, rows]
+        valid = (mask & (index > 0) & (index < len(times)) & (dt > 0) & (dt <= self.max_gap_s)
+                 & np.isfinite(q0).all(axis=-1) & np.isfinite(q1).all(axis=-1))
+        q0 = np.where(valid[..., None], q0, 1.0)
+        q1 = np.where(valid[..., None], q1, 1.0)
+        reference = quaternion_multiply(slerp(q0, q1, w), self.mounts)
+        return reference, valid
+
+    def update(self, dot_streamer, qtm_frames):
+        """
+        Traite les échantillons DOT arrivés depuis le dernier appel.
+        Renvoie adresse -> enregistrements FUSION_DTYPE (capteurs sans nouvel échantillon omis).
+        """
+        stf_rows, q_rows = [], []
+        for d, address in enumerate(self.addresses):
+            blocks, cursor, _ = dot_streamer.buffers[address].read_since(int(self._cursors[d]))
+            self._cursors[d] = cursor
+            stf_rows.append(np.concatenate([b["sample_time_fine"] for b in blocks]) if blocks else np.zeros(0))
+            q_rows.append(np.concatenate([b["quaternion"] for b in blocks]) if blocks else np.zeros((0, 4)))
+        if not any(len(row) for row in stf_rows):
+            return {}
+
+        stf, lengths = pad_streams(stf_rows)
+        q_imu, _ = pad_streams(q_rows)
+        q_imu = q_imu / np.linalg.norm(q_imu, axis=-1, keepdims=True)
+        mask = np.arange(stf.shape[1])[None, :] < lengths[:, None]
+        started = ~np.isnan(self._last_stf)
+        previous_t = self._last_t.copy()
+        t_dot = self._dot_times(stf, lengths)
+        if self._t_first is None:
+            self._t_first = float(np.nanmin(np.where(mask, t_dot, np.nan)))
+
+        # Instants QTM et orientation de référence (corps rigide visible ou non)
+        if qtm_frames is not None and qtm_frames.count > 0:
+            offset = self._offset(self._t_first, qtm_frames.frames()["timestamp"][0] / 1e6)
+            t_qtm = np.where(mask, t_dot + offset, np.nan)
+            reference, valid = self._reference(t_qtm, mask, qtm_frames)
+        else:
+            t_qtm = np.full(stf.shape, np.nan)
+            reference, valid = None, np.zeros(stf.shape, dtype=bool)
+
+        # Écart de cap mesuré : rotation verticale qui amène l'IMU sur la référence
+        measured = np.zeros(stf.shape)
+        if reference is not None:
+            measured = twist_angle(quaternion_multiply(reference, quaternion_conjugate(q_imu)))
+        measured = np.where(valid, measured, 0.0)
+
+        # Premier recalage : le cap prend directement la première mesure
+        initial = self.heading.copy()
+        locking = np.isnan(initial) & valid.any(axis=1)
+        first = np.argmax(valid, axis=1)
+        initial[locking] = measured[locking, first[locking]]
+        reference_heading = np.nan_to_num(initial)
+        measured = np.where(valid, reference_heading[:, None] + _wrap(measured - reference_heading[:, None]), 0.0)
+
+        previous_t = np.where(started, previous_t, t_dot[:, 0])
+        dt = np.diff(np.concatenate([previous_t[:, None], t_dot], axis=1), axis=1)
+        gain = np.where(valid, 1.0 - np.exp(-np.maximum(dt, 0.0) / self.time_constant), 0.0)
+        headings = complementary_heading(measured, np.minimum(gain, 0.99), reference_heading)
+        unlocked = np.isnan(initial)[:, None] | (locking[:, None] & (np.arange(stf.shape[1])[None, :] < first[:, None]))
+        headings[unlocked] = np.nan
+
+        fused = quaternion_multiply(heading_quaternion(np.nan_to_num(headings)), q_imu)
+        segment = quaternion_multiply(fused, quaternion_conjugate(self.mounts))
+        segment[unlocked] = np.nan
+
+        last = np.maximum(lengths - 1, 0)
+        rows = np.arange(len(lengths))
+        has = lengths > 0
+        self.heading[has] = np.where(np.isnan(headings[rows, last]), self.heading, headings[rows, last])[has]
+        self.corrected += (valid & mask).sum(axis=1)
+        self.imu_only += (~valid & mask).sum(axis=1)
+
+        out = {}
+        for d, address in enumerate(self.addresses):
+            n = lengths[d]
+            if not n:
+                continue
+            records = np.zeros(n, dtype=FUSION_DTYPE)
+            records["sample_time_fine"] = stf[d, :n]
+            records["t_qtm"] = t_qtm[d, :n]
+            records["quaternion"] = segment[d, :n]
+            records["heading"] = headings[d, :n]
+            records["corrected"] = valid[d, :n]
+            out[address] = records
+        return out
+
+    def report(self):
+        for d, address in enumerate(self.addresses):
+            total = self.corrected[d] + self.imu_only[d]
+            share = 100.0 * self.imu_only[d] / total if total else 0.0
+            heading = "-" if np.isnan(self.heading[d]) else f"{np.degrees(self.heading[d]):.1f}°"
+            print(f"🧭 {address} : cap {heading}, {share:.1f} % des échantillons sans corps rigide visible")
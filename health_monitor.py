@@ -0,0 +1,255 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+""" Surveillance de l'état des capteurs Movella DOT pendant la session :
+- Batterie et liaison interrogées à basse fréquence, pour tous les capteurs en parallèle
+  (une interrogation groupée), jamais pendant une commande de démarrage ou d'arrêt
+- Mises à jour de batterie poussées par le SDK (onBatteryUpdated) prises en compte sans requête
+- Paquets perdus par capteur, d'après les compteurs de paquets écrits par le callback de streaming
+- Vérification avant chaque essai, avec avertissements
+Le SDK n'expose pas le RSSI des capteurs connectés : la liaison est évaluée par le temps
+d'aller-retour et les échecs de l'interrogation.
+"""
+
+PACKET_COUNTER_WRAP = 2 ** 16  # packetCounter() du SDK : compteur 16 bits
+
+
+class DeviceHealth:
+    """
+    Dernier état connu d'un capteur.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.battery = None       # %
+        self.charging = None
+        self.rtt_ms = None        # Aller-retour de la dernière interrogation
+        self.failures = 0         # Interrogations consécutives sans réponse
+        self.received = 0         # Paquets reçus en streaming
+        self.lost = 0             # Paquets manquants (trous dans les compteurs)
+        self.last_poll = None     # time.time() de la dernière réponse
+
+    @property
+    def loss_ratio(self):
+        total = self.received + self.lost
+        return self.lost / total if total else 0.0
+
+    def to_dict(self):
+        return {"battery": self.battery, "charging": self.charging, "rtt_ms": self.rtt_ms,
+                "failures": self.failures, "received": self.received, "lost": self.lost}
+
+
+class HealthMonitor:
+    """
+    Moniteur à démarrer dans la boucle asyncio de la session (run()).
+    lock : à prendre pendant les commandes critiques (démarrage, arrêt) pour ne pas les concurrencer.
+    """
+
+    def __init__(self, devices, poll_interval=30.0, loss_interval=1.0, probe_timeout=2.0,
+                 low_battery=20, max_rtt_ms=250.0, max_loss=0.02, verbose=True):
+        self.devices = list(devices)
+        self.poll_interval = poll_interval
+        self.loss_interval = loss_interval
+        self.probe_timeout = probe_timeout
+        self.low_battery = low_battery
+        self.max_rtt_ms = max_rtt_ms
+        self.max_loss = max_loss
+        self.verbose = verbose
+        self.health = {device.bluetoothAddress(): DeviceHealth(device.bluetoothAddress())
+                       for device in self.devices}
+        self.lock = asyncio.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(self.devices)),
+                                        thread_name_prefix="dot-health")
+        self._streamer = None
+        self._cursors = {}
+        self._last_counter = {}
+        self._warned = set()
+        self._stop = None
+        self._busy = {}  # adresse -> interrogation toujours en cours après le délai
+        self._xdpc_handler = None
+        self._previous_callback = None
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def attach(self, xdpc_handler):
+        """
+        Reçoit les mises à jour de batterie poussées par le SDK (callback onBatteryUpdated).
+        """
+        self._xdpc_handler = xdpc_handler
+        self._previous_callback = xdpc_handler.onBatteryUpdated
+        xdpc_handler.onBatteryUpdated = self.on_battery_updated
+        return self
+
+    def detach(self):
+        if self._xdpc_handler is not None:
+            self._xdpc_handler.onBatteryUpdated = self._previous_callback
+            self._xdpc_handler = None
+
+    def on_battery_updated(self, device, battery_level, charging_status):
+        health = self.health.get(device.bluetoothAddress())
+        if health is not None:
+            health.battery = battery_level
+            health.charging = bool(charging_status)
+        if self._previous_callback is not None:
+            self._previous_callback(device, battery_level, charging_status)
+
+    def set_devices(self, devices):
+        """
+        Suit une nouvelle liste de capteurs (après une resynchronisation qui en a retiré).
+        """
+        self.devices = list(devices)
+        self.health = {device.bluetoothAddress(): self.health.get(device.bluetoothAddress(),
+                                                                 DeviceHealth(device.bluetoothAddress()))
+                       for device in self.devices}
+
+    # --- Paquets perdus -------------------------------------------------------
+
+    def track(self, dot_streamer):
+        """
+        Compte les paquets reçus et perdus dans les tampons d'un nouveau streaming.
+        """
+        self._streamer = dot_streamer
+        self._cursors = {address: 0 for address in dot_streamer.buffers}
+        self._last_counter = {}
+
+    def update_packet_loss(self):
+        """
+        Lit les compteurs de paquets arrivés depuis le dernier appel (vues, sans copie des tampons).
+        """
+        if self._streamer is None:
+            return
+        for address, buffer in self._streamer.buffers.items():
+            health = self.health.get(address)
+            if health is None:
+                continue
+            blocks, cursor, _ = buffer.read_since(self._cursors.get(address, 0))
+            self._cursors[address] = cursor
+            if not blocks:
+                continue
+            counters = np.concatenate([block["packet_counter"] for block in blocks]).astype(np.int64)
+            previous = self._last_counter.get(address)
+            if previous is not None:
+                counters = np.concatenate([[previous], counters])
+            steps = np.diff(counters) % PACKET_COUNTER_WRAP
+            health.lost += int(np.maximum(steps - 1, 0).sum())
+            health.received += len(counters) - (previous is not None)
+            self._last_counter[address] = int(counters[-1])
+
+    # --- Interrogation --------------------------------------------------------
+
+    @staticmethod
+    def _probe(device):
+        t0 = time.perf_counter_ns()
+        battery = device.batteryLevel()
+        rtt_ns = time.perf_counter_ns() - t0
+        charging = device.isCharging() if battery is not False else None
+        return device.bluetoothAddress(), battery, charging, rtt_ns
+
+    async def poll(self):
+        """
+        Interroge batterie et liaison de tous les capteurs en parallèle (hors commandes critiques).
+        Un capteur dont l'interrogation précédente est toujours bloquée n'est pas réinterrogé.
+        """
+        loop = asyncio.get_running_loop()
+        self._busy = {address: future for address, future in self._busy.items() if not future.done()}
+        async with self.lock:
+            futures = {}
+            for device in self.devices:
+                address = device.bluetoothAddress()
+                if address not in self._busy:
+                    futures[address] = loop.run_in_executor(self._pool, self._probe, device)
+            done, pending = set(), set()
+            if futures:
+                done, pending = await asyncio.wait(futures.values(), timeout=self.probe_timeout)
+            if pending:
+                # Un thread d'interrogation ne s'annule pas : on lui laisse un délai supplémentaire
+                # pour ne pas concurrencer une commande, sans bloquer démarrage et arrêt indéfiniment
+                _, pending = await asyncio.wait(pending, timeout=2 * self.probe_timeout)
+        for address, future in futures.items():
+            if future in pending:
+                self._busy[address] = future
+        for device in self.devices:
+            health = self.health[device.bluetoothAddress()]
+            future = futures.get(device.bluetoothAddress())
+            if future not in done:
+                health.failures += 1  # Pas de réponse dans le délai (réponse tardive ignorée)
+                continue
+            _, battery, charging, rtt_ns = future.result()
+            health.rtt_ms = rtt_ns / 1e6
+            if battery is False:
+                health.failures += 1
+                continue
+            health.battery, health.charging = battery, charging
+            health.failures = 0
+            health.last_poll = time.time()
+        return self.health
+
+    def check(self):
+        """
+        Avertissements pour l'état courant (liste de (adresse, type, message)).
+        """
+        warnings = []
+        for address, health in self.health.items():
+            if health.failures:
+                warnings.append((address, "no_response", f"sans réponse ({health.failures} interrogation(s))"))
+            elif health.rtt_ms is not None and health.rtt_ms > self.max_rtt_ms:
+                warnings.append((address, "slow_link", f"liaison lente ({health.rtt_ms:.0f} ms aller-retour)"))
+            if health.battery is not None and health.battery < self.low_battery and not health.charging:
+                warnings.append((address, "low_battery", f"batterie faible ({health.battery} %)"))
+            if health.loss_ratio > self.max_loss:
+                warnings.append((address, "packet_loss", f"{100 * health.loss_ratio:.1f} % de paquets perdus"))
+        return warnings
+
+    async def preflight(self):
+        """
+        Interrogation immédiate avant un essai. Affiche et renvoie les avertissements.
+        """
+        await self.poll()
+        warnings = self.check()
+        for address, _, message in warnings:
+            self._log(f"⚠️ Capteur {address} : {message}")
+        if not warnings:
+            self._log(f"🩺 {len(self.health)} capteur(s) prêts.")
+        return warnings
+
+    async def run(self):
+        """
+        Boucle de surveillance : compteurs de paquets à chaque tour, interrogation tous les poll_interval.
+        Un avertissement est affiché une fois, puis de nouveau seulement s'il disparaît et revient.
+        """
+        self._stop = asyncio.Event()
+        last_poll = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.loss_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            self.update_packet_loss()
+            if time.perf_counter() - last_poll >= self.poll_interval:
+                await self.poll()
+                last_poll = time.perf_counter()
+            current = set()
+            for address, kind, message in self.check():
+                current.add((address, kind))
+                if (address, kind) not in self._warned:
+                    self._log(f"⚠️ Capteur {address} : {message}")
+            self._warned = current
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+        self.detach()
+        self._pool.shutdown(wait=False)
+
+    def report(self):
+        for address, health in self.health.items():
+            battery = "-" if health.battery is None else f"{health.battery} %"
+            rtt = "-" if health.rtt_ms is None else f"{health.rtt_ms:.0f} ms"
+            print(f"🩺 {address} : batterie {battery}, aller-retour {rtt}, "
+                  f"paquets reçus {health.received}, perdus {health.lost} ({100 * health.loss_ratio:.1f} %)")
@@ -0,0 +1,191 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+""" Mesure des latences sur le chemin critique :
+- Intervalles en nanosecondes (horloge monotone perf_counter_ns) autour de chaque étape
+  (scan, openPort, startSync, take_control, start/stop QTM, acquittements, événements QTM)
+- Histogrammes de taille fixe (seaux logarithmiques de 1 µs à 100 s)
+- Coût quasi nul lorsque la mesure est désactivée (intervalle vide partagé, aucun horodatage)
+- Export p50/p95/p99 en JSON en fin de session pour suivre les régressions d'un essai à l'autre
+"""
+
+BUCKETS_PER_DECADE = 20
+MIN_NS = 1_000
+MAX_NS = 100_000_000_000
+_BOUNDS = [int(MIN_NS * 10 ** (k / BUCKETS_PER_DECADE))
+           for k in range(int(round(math.log10(MAX_NS / MIN_NS) * BUCKETS_PER_DECADE)) + 1)]
+
+enabled = False
+_histograms = {}
+_marks = {}
+_registry_lock = threading.Lock()
+
+
+class Histogram:
+    """
+    Histogramme de durées à seaux logarithmiques fixes (erreur relative < 6 % sur les percentiles).
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+        self._lock = threading.Lock()
+
+    def record(self, duration_ns):
+        index = bisect.bisect_left(_BOUNDS, duration_ns)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ns += duration_ns
+            if self.min_ns is None or duration_ns < self.min_ns:
+                self.min_ns = duration_ns
+            if self.max_ns is None or duration_ns > self.max_ns:
+                self.max_ns = duration_ns
+
+    def percentile(self, p):
+        """
+        Percentile p (0-100) en ns : milieu géométrique du seau, borné par le min et le max observés.
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        low = _BOUNDS[index - 1] if index > 0 else self.min_ns
+        high = _BOUNDS[index] if index < len(_BOUNDS) else self.max_ns
+        value = math.sqrt(max(low, 1) * max(high, 1))
+        return min(max(value, self.min_ns), self.max_ns)
+
+    def summary(self):
+        """
+        Résumé en millisecondes.
+        """
+        def ms(ns):
+            return None if ns is None else ns / 1e6
+
+        return {
+            "count": self.count,
+            "mean_ms": ms(self.total_ns / self.count) if self.count else None,
+            "min_ms": ms(self.min_ns),
+            "p50_ms": ms(self.percentile(50)),
+            "p95_ms": ms(self.percentile(95)),
+            "p99_ms": ms(self.percentile(99)),
+            "max_ms": ms(self.max_ns),
+        }
+
+
+def histogram(name):
+    h = _histograms.get(name)
+    if h is None:
+        with _registry_lock:
+            h = _histograms.setdefault(name, Histogram())
+    return h
+
+
+class _Span:
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        histogram(self.name).record(time.perf_counter_ns() - self.t0)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(value=True):
+    global enabled
+    enabled = value
+
+
+def span(name):
+    """
+    Intervalle mesuré : with span("qtm.start"): ...
+    """
+    return _Span(name) if enabled else _NULL_SPAN
+
+
+def record(name, duration_ns):
+    if enabled:
+        histogram(name).record(duration_ns)
+
+
+def mark(name):
+    """
+    Mémorise un instant de référence (ex. envoi d'une commande) pour since().
+    """
+    if enabled:
+        _marks[name] = time.perf_counter_ns()
+
+
+def since(mark_name, name):
+    """
+    Enregistre le temps écoulé depuis le dernier mark(mark_name), par exemple la réception
+    d'un événement QTM après l'envoi de la commande start.
+    """
+    if enabled:
+        t0 = _marks.get(mark_name)
+        if t0 is not None:
+            histogram(name).record(time.perf_counter_ns() - t0)
+
+
+def record_fan_out(result):
+    """
+    Enregistre le délai d'acquittement de chaque capteur et l'écart entre capteurs d'un FanOutResult.
+    """
+    if not enabled or result.fire_ns is None:
+        return
+    ack_histogram = histogram(f"dot.{result.command}.ack")
+    for ack in result.acks.values():
+        ack_histogram.record(ack - result.fire_ns)
+    if result.acks:
+        histogram(f"dot.{result.command}.skew").record(result.skew_ns)
+
+
+def summary():
+    return {name: h.summary() for name, h in sorted(_histograms.items())}
+
+
+def reset():
+    with _registry_lock:
+        _histograms.clear()
+        _marks.clear()
+
+
+def dump(path, verbose=True, **metadata):
+    """
+    Écrit les percentiles de toutes les étapes mesurées dans un fichier JSON.
+    """
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "metadata": metadata,
+              "spans": summary()}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    if verbose:
+        print(f"⏱️ Latences enregistrées dans {path} ({len(report['spans'])} étape(s))")
+    return report
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import json
+import socket
+import struct
+import time
+
+import numpy as np
+
+import instrumentation
+from session_file import DOT_DTYPE
+
+""" Diffusion en direct des trames fusionnées DOT + QTM aux outils d'affichage et d'analyse :
+- Serveur TCP local dans la boucle de la session, une trame binaire compacte par période
+- Trame encodée une seule fois pour tous les abonnés : dernier échantillon de chaque capteur
+  DOT et dernière trame QTM (marqueurs, position et rotation des corps rigides)
+- Contrôle de flux côté serveur : l'abonné acquitte chaque trame lue (un octet), au plus
+  window trames non acquittées sont en route vers lui
+- Un emplacement par abonné : une trame qui attend un acquittement est remplacée par la
+  suivante (la plus récente gagne), jamais de file qui grossit avec un abonné lent, que le
+  retard soit dans asyncio, dans les tampons du noyau ou chez l'abonné
+- Retard mesuré par abonné (encodage -> acquittement), abonné bloqué déconnecté après send_timeout
+Format : chaque message est précédé de MESSAGE (longueur, type).
+  SCHEMA : JSON (adresses, marqueurs, corps, format des trames), envoyé à la connexion
+           et quand la disposition change (sans acquittement)
+  FRAME  : FRAME_HEADER, n_dot enregistrements DOT_DTYPE, puis marqueurs (n, 3),
+           positions (n, 3) et rotations (n, 9) des corps en float32
+  Abonné -> serveur : un octet (valeur quelconque) par trame FRAME lue, qui demande la suivante
+"""
+
+MESSAGE = struct.Struct("<IB")  # Longueur de la charge utile, type
+SCHEMA, FRAME = 0, 1
+# Numéro de trame, time.time_ns() à l'encodage, timestamp QTM (µs, -1 sans QTM),
+# numéro de trame QTM, nombre de capteurs, de marqueurs et de corps rigides
+FRAME_HEADER = struct.Struct("<IqqqHHH")
+
+
+def _message(kind, payload):
+    return MESSAGE.pack(len(payload), kind) + payload
+
+
+class _Subscriber:
+    """
+    Abonné : dernière trame non envoyée (emplacement unique), trames en attente
+    d'acquittement et statistiques.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.schema = None       # Schéma à envoyer avant la prochaine trame
+        self.frame = None        # (perf_counter_ns à l'encodage, message)
+        self.in_flight = collections.deque()  # perf_counter_ns à l'encodage des trames non acquittées
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.acked = 0
+        self.coalesced = 0       # Trames remplacées avant d'avoir été envoyées
+        self.bytes = 0
+        self.lag = instrumentation.Histogram()  # Encodage -> acquittement par l'abonné
+
+    def acknowledge(self, n, now_ns):
+        for _ in range(min(n, len(self.in_flight))):
+            self.lag.record(now_ns - self.in_flight.popleft())
+            self.acked += 1
+        self.ready.set()
+
+
+class FramePublisher:
+    """
+    Serveur de diffusion. source() renvoie (dot_streamer, qtm_frames, qtm_settings) courants
+    (None possibles), ce qui suit les changements d'essai sans redémarrer le serveur.
+
+    window : trames envoyées sans acquittement au plus, par abonné
+    send_timeout : délai (s) d'écriture ou d'acquittement au-delà duquel l'abonné est déconnecté
+    """
+
+    def __init__(self, source, host="127.0.0.1", port=5556, rate=60.0, window=1, send_timeout=5.0,
+                 write_buffer=16 * 1024, verbose=True):
+        self.source = source
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.window = window
+        self.send_timeout = send_timeout
+        self.write_buffer = write_buffer
+        self.verbose = verbose
+        self.subscribers = set()
+        self.history = []  # Statistiques des abonnés déconnectés
+        self.frames = 0
+        self._server = None
+        self._task = None
+        self._handlers = set()  # Tâches des connexions en cours
+        self._schema = None
+        self._layout = None
+        self._last_counts = None
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._log(f"📢 Diffusion des trames sur {self.host}:{self.port} ({self.rate:g} Hz)")
+        return self
+
+    async def stop(self, timeout=2.0):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+            # Abonnés coupés avant d'attendre le serveur : wait_closed() attend aussi les connexions
+            for subscriber in list(self.subscribers):
+                subscriber.writer.transport.abort()
+            try:
+                await asyncio.wait_for(asyncio.gather(self._server.wait_closed(), *self._handlers,
+                                                      return_exceptions=True), timeout)
+            except asyncio.TimeoutError:
+                self._log("⚠️ Fermeture du serveur de diffusion incomplète.")
+
+    # --- Abonnés --------------------------------------------------------------
+
+    async def _handle_client(self, reader, writer):
+        # Tampons d'envoi bornés (asyncio et noyau) : le schéma et les trames en route tiennent
+        # dans la socket, l'acquittement borne le reste
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.write_buffer)
+        subscriber = _Subscriber(writer)
+        subscriber.schema = self._schema
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        self.subscribers.add(subscriber)
+        self._log(f"📢 Abonné connecté : {subscriber.peer}")
+        sender = asyncio.get_running_loop().create_task(self._send_loop(subscriber))
+        try:
+            # Un octet par trame lue : acquittement et demande de la suivante
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                subscriber.acknowledge(len(data), time.perf_counter_ns())
+        except ConnectionError:
+            pass
+        finally:
+            # Connexion fermée d'abord : la boucle d'envoi s'arrête même si wait_for absorbe l'annulation
+            writer.close()
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            self.subscribers.discard(subscriber)
+            self._handlers.discard(handler)
+            self.history.append(self._statistics(subscriber))
+            self._log(f"📢 Abonné déconnecté : {subscriber.peer}")
+
+    async def _send_loop(self, subscriber):
+        writer = subscriber.writer
+        while not writer.is_closing():
+            await subscriber.ready.wait()
+            subscriber.ready.clear()
+            schema, subscriber.schema = subscriber.schema, None
+            if schema is not None:
+                writer.write(schema)
+                subscriber.bytes += len(schema)
+            # Sans acquittement disponible, la trame reste dans l'emplacement (et y sera remplacée)
+            if subscriber.frame is not None and len(subscriber.in_flight) < self.window:
+                (encoded_ns, message), subscriber.frame = subscriber.frame, None
+                subscriber.in_flight.append(encoded_ns)
+                writer.write(message)
+                subscriber.sent += 1
+                subscriber.bytes += len(message)
+            try:
+                await asyncio.wait_for(writer.drain(), self.send_timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                self._log(f"⚠️ Abonné {subscriber.peer} bloqué ou perdu : déconnexion.")
+                writer.transport.abort()
+                return
+
+    def publish(self, message, encoded_ns):
+        """
+        Dépose la trame dans l'emplacement de chaque abonné (remplace celle non encore envoyée).
+        Un abonné qui n'acquitte plus depuis send_timeout est déconnecté.
+        """
+        timeout_ns = int(self.send_timeout * 1e9)
+        for subscriber in list(self.subscribers):
+            if subscriber.in_flight and encoded_ns - subscriber.in_flight[0] > timeout_ns:
+                self._log(f"⚠️ Abonné {subscriber.peer} sans acquittement : déconnexion.")
+                self.subscribers.discard(subscriber)
+                subscriber.writer.transport.abort()
+                continue
+            if subscriber.frame is not None:
+                subscriber.coalesced += 1
+            subscriber.frame = (encoded_ns, message)
+            subscriber.ready.set()
+
+    # --- Encodage -------------------------------------------------------------
+
+    def _update_schema(self, addresses, settings, n_markers, n_bodies):
+        layout = (tuple(addresses), n_markers, n_bodies)
+        if layout == self._layout:
+            return
+        self._layout = layout
+        settings = settings or {}
+        schema = {
+            "version": 1,
+            "rate": self.rate,
+            "dot_addresses": list(addresses),
+            "dot_dtype": DOT_DTYPE.descr,
+            "marker_labels": list(settings.get("marker_labels", []))[:n_markers],
+            "body_names": list(settings.get("body_names", []))[:n_bodies],
+            "frame_header": FRAME_HEADER.format,
+        }
+        self._schema = _message(SCHEMA, json.dumps(schema).encode("utf-8"))
+        for subscriber in self.subscribers:
+            subscriber.schema = self._schema
+            subscriber.ready.set()
+
+    def encode(self, dot_streamer, qtm_frames, qtm_settings):
+        """
+        Trame fusionnée courante, ou None si rien de nouveau depuis la précédente.
+        """
+        buffers = dot_streamer.buffers if dot_streamer is not None else {}
+        n_qtm = qtm_frames.count if qtm_frames is not None else 0
+        counts = (tuple(buffer.count for buffer in buffers.values()), n_qtm)
+        if counts == self._last_counts:
+            return None
+        self._last_counts = counts
+
+        n_markers = qtm_frames.n_markers if qtm_frames is not None else 0
+        n_bodies = qtm_frames.n_bodies if qtm_frames is not None else 0
+        self._update_schema(buffers, qtm_settings, n_markers, n_bodies)
+
+        dot = np.zeros(len(buffers), dtype=DOT_DTYPE)
+        for k, buffer in enumerate(buffers.values()):
+            if buffer.count:
+                i = (buffer.count - 1) % buffer.capacity
+                dot[k] = (buffer.sample_time_fine[i], buffer.packet_counter[i],
+                          buffer.quaternion[i], buffer.free_acceleration[i])
+            else:
+                dot["quaternion"][k] = np.nan
+
+        parts = [None, dot.tobytes()]
+        timestamp, frame_number = -1, -1
+        if n_qtm:
+            i = n_qtm - 1
+            timestamp, frame_number = int(qtm_frames.timestamp[i]), int(qtm_frames.frame_number[i])
+            parts += [qtm_frames.markers[i].tobytes(), qtm_frames.body_position[i].tobytes(),
+                      qtm_frames.body_rotation[i].tobytes()]
+        else:
+            parts.append(np.full(n_markers * 3 + n_bodies * 12, np.nan, dtype=np.float32).tobytes())
+        self.frames += 1
+        parts[0] = FRAME_HEADER.pack(self.frames & 0xFFFFFFFF, time.time_ns(), timestamp, frame_number,
+                                     len(buffers), n_markers, n_bodies)
+        return _message(FRAME, b"".join(parts))
+
+    async def _run(self):
+        period = 1.0 / self.rate
+        next_t = time.perf_counter()
+        while True:
+            next_t += period
+            await asyncio.sleep(max(0.0, next_t - time.perf_counter()))
+            if not self.subscribers:
+                continue
+            dot_streamer, qtm_frames, qtm_settings = self.source()
+            t0 = time.perf_counter_ns()
+            message = self.encode(dot_streamer, qtm_frames, qtm_settings)
+            if message is not None:
+                instrumentation.record("publish.encode", time.perf_counter_ns() - t0)
+                self.publish(message, t0)
+
+    # --- Bilan ----------------------------------------------------------------
+
+    @staticmethod
+    def _statistics(subscriber):
+        return {"peer": str(subscriber.peer), "sent": subscriber.sent, "acked": subscriber.acked,
+                "coalesced": subscriber.coalesced, "bytes": subscriber.bytes, "lag": subscriber.lag.summary()}
+
+    def statistics(self):
+        return self.history + [self._statistics(subscriber) for subscriber in self.subscribers]
+
+    def report(self):
+        print(f"📢 {self.frames} trame(s) diffusée(s).")
+        for stats in self.statistics():
+            lag = stats["lag"]
+            p50 = "-" if lag["p50_ms"] is None else f"{lag['p50_ms']:.2f} ms"
+            p99 = "-" if lag["p99_ms"] is None else f"{lag['p99_ms']:.2f} ms"
+            print(f"  {stats['peer']} : {stats['sent']} envoyée(s), {stats['acked']} acquittée(s), "
+                  f"{stats['coalesced']} fusionnée(s), retard p50 {p50}, p99 {p99}")
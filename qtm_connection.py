@@ -0,0 +1,173 @@
+import asyncio
+import random
+import time
+
+import qtm_rt
+
+import instrumentation
+
+""" Connexion QTM supervisée, partagée par tous les essais d'une session :
+- Connexion et prise de contrôle en tâche de fond, disponibilité attendue par wait_ready()
+- Détection de la perte de connexion par le callback on_disconnect de qtm_rt et par un keepalive
+- Reconnexion avec attente exponentielle, puis nouvelle prise de contrôle
+- Adresse et port configurables
+"""
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 22223
+
+
+class QtmConnectionManager:
+    """
+    Maintient une connexion QTM prête à l'emploi. À démarrer dans la boucle de session.
+    password : mot de passe de prise de contrôle, None pour ne pas prendre le contrôle.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, password=None, version="1.25",
+                 on_event=None, timeout=5.0, keepalive=5.0, base_delay=0.5, max_delay=10.0,
+                 verbose=True):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.version = version
+        self.on_event = on_event
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verbose = verbose
+        self.connection = None
+        self.connects = 0     # Nombre de connexions réussies (1 + reconnexions)
+        self.disconnects = 0
+        self._ready = None
+        self._lost = None
+        self._task = None
+        self._closing = False
+        self._generation = 0  # Les callbacks d'une connexion remplacée sont ignorés
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def start(self):
+        """
+        Lance la supervision en tâche de fond (à appeler depuis la boucle asyncio).
+        """
+        self._ready = asyncio.Event()
+        self._lost = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.get_running_loop().create_task(self._supervise())
+        return self
+
+    def is_ready(self):
+        return self._ready is not None and self._ready.is_set()
+
+    async def wait_ready(self, timeout=None):
+        """
+        Attend que la connexion (et la prise de contrôle) soit établie et la renvoie.
+        """
+        await asyncio.wait_for(self._ready.wait(), timeout)
+        return self.connection
+
+    def _on_event(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _on_disconnect(self, generation, reason):
+        """
+        Callback qtm_rt : connexion perdue (la reconnexion est faite par la tâche de supervision).
+        """
+        if self._closing or generation != self._generation:
+            return
+        self._ready.clear()
+        self._lost.set()
+
+    async def _connect_once(self):
+        self._generation += 1
+        generation = self._generation
+        with instrumentation.span("qtm.connect"):
+            connection = await qtm_rt.connect(
+                self.host, self.port, version=self.version, on_event=self._on_event,
+                on_disconnect=lambda reason: self._on_disconnect(generation, reason),
+                timeout=self.timeout)
+        if connection is None:
+            return None
+        if self.password is not None:
+            try:
+                with instrumentation.span("qtm.take_control"):
+                    await connection.take_control(self.password)
+            except qtm_rt.QRTCommandException as e:
+                self._log(f"🔴 Échec de la prise de contrôle de QTM : {e}")
+                _close(connection)
+                return None
+        return connection
+
+    async def _watch(self, connection):
+        """
+        Keepalive : une commande légère à intervalle fixe, jusqu'à la perte de la connexion.
+        """
+        while not self._lost.is_set():
+            try:
+                await asyncio.wait_for(self._lost.wait(), self.keepalive)
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await asyncio.wait_for(connection.qtm_version(), self.timeout)
+            except (asyncio.TimeoutError, qtm_rt.QRTCommandException) as e:
+                self._log(f"⚠️ QTM ne répond plus au keepalive ({e!r}).")
+                break
+
+    async def _supervise(self):
+        attempt = 0
+        while not self._closing:
+            self._lost.clear()
+            t0 = time.perf_counter()
+            try:
+                connection = await self._connect_once()
+            except Exception as e:
+                self._log(f"❌ Erreur lors de la connexion à QTM : {e}")
+                connection = None
+
+            if connection is None:
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                self._log(f"🔴 QTM indisponible sur {self.host}:{self.port}, "
+                          f"nouvelle tentative dans {delay:.1f} s...")
+                await asyncio.sleep(delay)
+                continue
+
+            attempt = 0
+            self.connection = connection
+            self.connects += 1
+            self._ready.set()
+            verb = "établie" if self.connects == 1 else "rétablie"
+            self._log(f"✅ Connexion à QTM {verb} en {time.perf_counter() - t0:.2f} s.")
+
+            await self._watch(connection)
+            if self._closing:
+                break
+            self._ready.clear()
+            self.disconnects += 1
+            self._log("⚠️ Connexion à QTM perdue, reconnexion...")
+            _close(connection)
+
+    async def stop(self):
+        """
+        Arrête la supervision et ferme la connexion.
+        """
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.connection is not None:
+            _close(self.connection)
+        self._ready.clear()
+
+
+def _close(connection):
+    if connection.has_transport():
+        connection.disconnect()
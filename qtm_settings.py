@@ -0,0 +1,177 @@
+import xml.etree.ElementTree as ET
+
+import qtm_rt
+
+import instrumentation
+
+""" Paramètres QTM typés, mis en cache et envoyés par différence :
+- Lecture par get_parameters, une fois par connexion et par section
+- Valeurs typées validées puis converties en XML construit par ElementTree (toujours bien formé)
+- Envoi limité aux paramètres modifiés, aucun envoi si rien n'a changé
+- Réponse de QTM vérifiée : un refus lève une exception au lieu de passer inaperçu
+"""
+
+SUCCESS = "Setting parameters succeeded"
+
+# Section XML -> (section get_parameters, {paramètre: type})
+PARAMETERS = {
+    "General": ("general", {
+        "Frequency": int,
+        "Capture_Time": float,
+        "Start_On_External_Trigger": bool,
+        "Start_On_Trigger_NO": bool,
+        "Start_On_Trigger_NC": bool,
+        "Start_On_Trigger_Software": bool,
+    }),
+    "The_3D": ("3d", {
+        "AxisUpwards": str,
+        "CalibrationTime": str,
+    }),
+}
+
+_AXES = ("+X", "-X", "+Y", "-Y", "+Z", "-Z")
+
+
+def _parse(kind, text):
+    if text is None:
+        return None
+    text = text.strip()
+    if kind is bool:
+        return text.lower() == "true"
+    if kind is str:
+        return text
+    return kind(float(text)) if kind is int else kind(text)
+
+
+def _format(kind, value):
+    if kind is bool:
+        return "True" if value else "False"
+    if kind is float:
+        return f"{value:.6f}".rstrip("0").rstrip(".")
+    return str(value)
+
+
+def validate(section, key, value):
+    """
+    Vérifie et convertit une valeur. Lève ValueError pour un paramètre inconnu ou une valeur invalide.
+    """
+    if section not in PARAMETERS or key not in PARAMETERS[section][1]:
+        raise ValueError(f"Paramètre QTM inconnu : {section}/{key}")
+    kind = PARAMETERS[section][1][key]
+    if kind is bool:
+        if not isinstance(value, bool):
+            raise ValueError(f"{section}/{key} attend un booléen, reçu {value!r}")
+        return value
+    try:
+        value = kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{section}/{key} attend {kind.__name__}, reçu {value!r}") from None
+    if key in ("Frequency", "Capture_Time") and value <= 0:
+        raise ValueError(f"{section}/{key} doit être positif, reçu {value!r}")
+    if key == "AxisUpwards" and value not in _AXES:
+        raise ValueError(f"{section}/{key} doit valoir l'un de {', '.join(_AXES)}")
+    return value
+
+
+def build_settings_xml(values):
+    """
+    XML de paramètres QTM pour {section: {paramètre: valeur}} (valeurs déjà validées).
+    """
+    root = ET.Element("QTM_Settings")
+    for section, parameters in values.items():
+        element = ET.SubElement(root, section)
+        for key, value in parameters.items():
+            ET.SubElement(element, key).text = _format(PARAMETERS[section][1][key], value)
+    return ET.tostring(root, encoding="unicode")
+
+
+class QtmSettings:
+    """
+    Cache des paramètres QTM. Le cache est lié à une connexion : après une reconnexion,
+    les sections utilisées sont relues (QTM a pu être modifié entre-temps).
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.values = {}     # section -> {paramètre: valeur typée}
+        self.sends = 0       # Nombre d'envois XML effectués
+        self.skipped = 0     # Nombre d'appels à apply() sans changement
+        self._connection = None
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def invalidate(self):
+        self.values = {}
+        self._connection = None
+
+    async def read(self, connection, sections=("General",)):
+        """
+        Lit (une fois par connexion) les sections demandées et renvoie le cache.
+        """
+        if connection is not self._connection:
+            self.invalidate()
+            self._connection = connection
+        missing = [section for section in sections if section not in self.values]
+        if not missing:
+            return self.values
+
+        with instrumentation.span("qtm.get_parameters"):
+            xml = await connection.get_parameters([PARAMETERS[s][0] for s in missing])
+        if isinstance(xml, bytes):
+            xml = xml.decode("utf-8", errors="replace")
+        root = ET.fromstring(xml)
+        for section in missing:
+            element = root.find(f".//{section}")
+            kinds = PARAMETERS[section][1]
+            self.values[section] = {} if element is None else {
+                key: _parse(kind, element.findtext(key)) for key, kind in kinds.items()
+                if element.find(key) is not None}
+        return self.values
+
+    def get(self, section, key, default=None):
+        return self.values.get(section, {}).get(key, default)
+
+    def diff(self, values):
+        """
+        Paramètres validés de values ({section: {paramètre: valeur}}) différents du cache.
+        """
+        changes = {}
+        for section, parameters in values.items():
+            for key, value in parameters.items():
+                value = validate(section, key, value)
+                current = self.values.get(section, {}).get(key)
+                if isinstance(value, float) and current is not None:
+                    same = abs(current - value) < 1e-6
+                else:
+                    same = current == value
+                if not same:
+                    changes.setdefault(section, {})[key] = value
+        return changes
+
+    async def apply(self, connection, values):
+        """
+        Envoie à QTM uniquement les paramètres modifiés. Renvoie les changements envoyés ({} si aucun).
+        Lève ValueError (valeur invalide) ou qtm_rt.QRTCommandException (refus de QTM).
+        """
+        await self.read(connection, tuple(values))
+        changes = self.diff(values)
+        if not changes:
+            self.skipped += 1
+            return changes
+
+        xml = build_settings_xml(changes)
+        self._log(f"📡 Envoi des paramètres QTM modifiés : {changes}")
+        with instrumentation.span("qtm.send_xml"):
+            response = await connection.send_xml(xml)
+        if isinstance(response, bytes):
+            response = response.decode("utf-8", errors="replace")
+        if response != SUCCESS:
+            # L'état de QTM est incertain : relecture complète au prochain appel
+            self.invalidate()
+            raise qtm_rt.QRTCommandException(f"Paramètres refusés par QTM : {response}")
+        self.sends += 1
+        for section, parameters in changes.items():
+            self.values.setdefault(section, {}).update(parameters)
+        return changes
@@ -0,0 +1,157 @@
+import math
+import struct
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from qtm_rt.packet import QRTComponentType
+
+""" Streaming temps réel des trames QTM :
+- Abonnement aux composantes 3D, 6DOF et timecode via stream_frames
+- Décodage direct des paquets dans des tableaux NumPy colonnes, dimensionnés
+  à l'avance à partir de la fréquence et de la durée de capture
+- Compteur de trames perdues (trous dans les numéros de trame)
+"""
+
+_COMPONENT_HEADER = 8  # marker_count/body_count (4 octets) + drop_rate + out_of_sync_rate
+_TIMECODE_HEADER = 4   # timecode_count
+_COUNT = struct.Struct("<i")
+
+
+class QtmFrameBuffer:
+    """
+    Tampon colonnes préalloué pour les trames QTM.
+    """
+
+    def __init__(self, capacity, n_markers, n_bodies):
+        self.capacity = capacity
+        self.n_markers = n_markers
+        self.n_bodies = n_bodies
+        self.timestamp = np.zeros(capacity, dtype=np.int64)  # µs (horloge QTM)
+        self.frame_number = np.zeros(capacity, dtype=np.int64)
+        self.receive_ns = np.zeros(capacity, dtype=np.int64)  # perf_counter_ns à la réception
+        self.markers = np.full((capacity, n_markers, 3), np.nan, dtype=np.float32)
+        self.body_position = np.full((capacity, n_bodies, 3), np.nan, dtype=np.float32)
+        # Matrice de rotation 3x3 telle qu'envoyée par QTM (ordre colonne)
+        self.body_rotation = np.full((capacity, n_bodies, 9), np.nan, dtype=np.float32)
+        self.timecode = np.zeros(capacity, dtype=np.uint64)
+        self.count = 0
+        self.dropped = 0   # Trames manquantes d'après les numéros de trame
+        self.overflow = 0  # Trames reçues après remplissage du tampon
+        self._last_frame = None
+
+    def on_packet(self, packet):
+        """
+        Callback qtm_rt : décode les composantes du paquet directement dans les colonnes.
+        """
+        receive_ns = time.perf_counter_ns()
+
+        frame = packet.framenumber
+        if self._last_frame is not None and frame > self._last_frame + 1:
+            self.dropped += frame - self._last_frame - 1
+        self._last_frame = frame
+
+        i = self.count
+        if i >= self.capacity:
+            self.overflow += 1
+            return
+
+        self.timestamp[i] = packet.timestamp
+        self.frame_number[i] = frame
+        self.receive_ns[i] = receive_ns
+
+        data = packet.data
+        components = packet.components
+
+        position = components.get(QRTComponentType.Component3d)
+        if position is not None:
+            n = min(_COUNT.unpack_from(data, position)[0], self.n_markers)
+            if n:
+                self.markers[i, :n] = np.frombuffer(
+                    data, dtype="<f4", count=n * 3,
+                    offset=position + _COMPONENT_HEADER).reshape(n, 3)
+
+        position = components.get(QRTComponentType.Component6d)
+        if position is not None:
+            n = min(_COUNT.unpack_from(data, position)[0], self.n_bodies)
+            if n:
+                # Par corps : position (3 floats) puis rotation (9 floats)
+                bodies = np.frombuffer(
+                    data, dtype="<f4", count=n * 12,
+                    offset=position + _COMPONENT_HEADER).reshape(n, 12)
+                self.body_position[i, :n] = bodies[:, :3]
+                self.body_rotation[i, :n] = bodies[:, 3:]
+
+        position = components.get(QRTComponentType.ComponentTimecode)
+        if position is not None and _COUNT.unpack_from(data, position)[0] > 0:
+            # Premier timecode : type (int32), hi (uint32), lo (uint32)
+            hi, lo = struct.unpack_from("<II", data, position + _TIMECODE_HEADER + 4)
+            self.timecode[i] = (hi << 32) | lo
+
+        self.count = i + 1
+
+    def frames(self):
+        """
+        Vues (sans copie) des trames reçues.
+        """
+        n = self.count
+        return {
+            "timestamp": self.timestamp[:n],
+            "frame_number": self.frame_number[:n],
+            "receive_ns": self.receive_ns[:n],
+            "markers": self.markers[:n],
+            "body_position": self.body_position[:n],
+            "body_rotation": self.body_rotation[:n],
+            "timecode": self.timecode[:n],
+        }
+
+
+def parse_stream_settings(xml):
+    """
+    Extrait la fréquence, les noms des marqueurs et des corps rigides du XML de get_parameters.
+    """
+    if isinstance(xml, bytes):
+        xml = xml.decode("utf-8", errors="replace")
+    root = ET.fromstring(xml)
+
+    frequency = root.findtext(".//General/Frequency")
+    marker_labels = [label.findtext("Name") for label in root.findall(".//The_3D/Label")]
+    body_names = [body.findtext("Name") for body in root.findall(".//The_6D/Body")]
+
+    return {
+        "frequency": float(frequency) if frequency else None,
+        "marker_labels": marker_labels,
+        "body_names": body_names,
+    }
+
+
+async def start_frame_stream(connection, duration, components=("3d", "6d", "timecode"),
+                             margin=1.2, verbose=True):
+    """
+    Lit les paramètres de capture, prépare le tampon et s'abonne aux trames QTM.
+    Renvoie (tampon, paramètres).
+    """
+    settings = parse_stream_settings(
+        await connection.get_parameters(["general", "3d", "6d"]))
+    frequency = settings["frequency"] or 120.0
+    capacity = int(math.ceil(frequency * duration * margin)) + 1
+
+    buffer = QtmFrameBuffer(capacity, len(settings["marker_labels"]),
+                            len(settings["body_names"]))
+    if verbose:
+        print(
+            f"📡 Abonnement aux trames QTM ({frequency:.0f} Hz, {buffer.n_markers} marqueurs, "
+            f"{buffer.n_bodies} corps, {capacity} trames max)...")
+
+    await connection.stream_frames(components=list(components), on_packet=buffer.on_packet)
+    return buffer, settings
+
+
+async def stop_frame_stream(connection, buffer=None, verbose=True):
+    """
+    Arrête l'abonnement aux trames et affiche le bilan.
+    """
+    await connection.stream_frames_stop()
+    if verbose and buffer is not None:
+        print(
+            f"📊 Trames QTM reçues : {buffer.count}, perdues : {buffer.dropped}, hors tampon : {buffer.overflow}")
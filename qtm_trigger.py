@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import qtm_rt
+
+import instrumentation
+from dot_commands import DeviceFanOut
+
+""" Démarrage et arrêt des capteurs Movella DOT sur les événements QTM :
+- EventCaptureStarted / EventRTfromFileStarted démarrent l'enregistrement des DOTs,
+  EventCaptureStopped / EventRTfromFileStopped l'arrêtent (fin de capture pilotée par QTM)
+- Commande de démarrage armée à l'avance : le callback d'événement libère directement les workers
+- Latence événement QTM -> premier acquittement DOT mesurée à chaque capture
+"""
+
+START_EVENTS = (qtm_rt.QRTEvent.EventCaptureStarted, qtm_rt.QRTEvent.EventRTfromFileStarted)
+STOP_EVENTS = (qtm_rt.QRTEvent.EventCaptureStopped, qtm_rt.QRTEvent.EventRTfromFileStopped)
+
+
+class QtmEventTrigger:
+    """
+    Déclencheur piloté par les événements QTM. on_event() doit être appelé depuis la boucle
+    asyncio de la connexion QTM (callback on_event de qtm_rt).
+    """
+
+    def __init__(self, devices, start_command="startRecording", stop_command="stopRecording",
+                 start_args=(), verbose=True):
+        # Pas de délai d'armement : la commande attend l'événement QTM aussi longtemps que nécessaire
+        self.fan_out = DeviceFanOut(devices, arm_timeout=None)
+        self.start_command = start_command
+        self.stop_command = stop_command
+        self.start_args = tuple(start_args)
+        self.verbose = verbose
+        self.recording = False
+        self.start_result = None
+        self.stop_result = None
+        self.latencies_ns = []  # Événement QTM -> premier acquittement DOT, par capture
+        self._armed = None
+        self._start_task = None
+        self._started = asyncio.Event()
+        self._stopped = asyncio.Event()
+
+    def arm(self):
+        """
+        Prépare la commande de démarrage (workers en attente sur la barrière).
+        """
+        if self._armed is None:
+            self._armed = self.fan_out.arm(self.start_command, *self.start_args)
+        return self
+
+    def disarm(self):
+        if self._armed is not None:
+            self._armed.cancel()
+            self._armed = None
+
+    def on_event(self, event):
+        """
+        Callback synchrone : le démarrage est envoyé avant tout affichage ou création de tâche.
+        """
+        receive_ns = time.perf_counter_ns()
+        if event in START_EVENTS and not self.recording and self._armed is not None:
+            armed, self._armed = self._armed, None
+            armed.fire()
+            self.recording = True
+            self._started.clear()
+            self._stopped.clear()
+            self._start_task = asyncio.get_running_loop().create_task(
+                self._complete_start(armed, receive_ns))
+        elif event in STOP_EVENTS and self.recording:
+            self.recording = False
+            asyncio.get_running_loop().create_task(self._stop(receive_ns))
+
+    async def _complete_start(self, armed, receive_ns):
+        result = await armed.result_async()
+        self.start_result = result
+        if result.acks:
+            latency_ns = result.first_ack_ns - receive_ns
+            self.latencies_ns.append(latency_ns)
+            instrumentation.record("qtm.event_to_dot_ack", latency_ns)
+        if self.verbose:
+            result.report()
+            if result.acks:
+                print(f"⏱️ Événement QTM -> premier acquittement DOT : {latency_ns / 1e6:.1f} ms")
+        self._started.set()
+
+    async def _stop(self, receive_ns):
+        if self._start_task is not None:
+            await self._start_task  # Le démarrage doit être terminé avant l'arrêt
+        result = await self.fan_out.run_async(self.stop_command)
+        self.stop_result = result
+        if result.acks:
+            instrumentation.record("qtm.event_to_dot_stop_ack", result.first_ack_ns - receive_ns)
+        if self.verbose:
+            result.report()
+        self.arm()  # Prêt pour la capture suivante
+        self._stopped.set()
+
+    def expect_start(self):
+        """
+        À appeler avant de démarrer QTM : wait_started() attendra alors la nouvelle capture
+        et non le résultat de la précédente.
+        """
+        self._started.clear()
+        self.start_result = None
+
+    async def wait_started(self, timeout=None):
+        await asyncio.wait_for(self._started.wait(), timeout)
+        return self.start_result
+
+    async def wait_stopped(self, timeout=None):
+        await asyncio.wait_for(self._stopped.wait(), timeout)
+        return self.stop_result
+
+    def print_latency_report(self):
+        if not self.latencies_ns:
+            return
+        ms = sorted(latency / 1e6 for latency in self.latencies_ns)
+        print(f"⏱️ Événement QTM -> premier acquittement DOT sur {len(ms)} capture(s) : "
+              f"médiane {ms[len(ms) // 2]:.1f} ms, max {ms[-1]:.1f} ms")
+
+    def shutdown(self):
+        self.disarm()
+        self.fan_out.shutdown()
@@ -0,0 +1,281 @@
+import abc
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import Xsens_to_Qualisys as flow
+import instrumentation
+from clock_alignment import AlignmentResult, align_streams, unwrap_sample_time_fine
+from dot_stream import DotRingBuffer
+from qtm_stream import QtmFrameBuffer
+from session_file import SessionReader
+
+""" Rejeu d'une session enregistrée dans la chaîne temps réel, plus vite que le temps réel :
+- Échantillons DOT lus dans la session par projection en mémoire et poussés dans des tampons
+  circulaires au rythme de leur sampleTimeFine, divisé par la vitesse de rejeu
+- Trames QTM rejouées depuis la session (même horloge de rejeu), ou par QTM lui-même
+  (start(rtfromfile=True) sur la mesure chargée)
+- Même chaîne que le streaming : écriture de session, comblement des trous, correction de cap,
+  alignement d'horloge, mesures de latence (instrumentation)
+Permet de profiler et de tester la chaîne temps réel sans capteurs ni caméras.
+"""
+
+
+class ReplayClock:
+    """
+    Horloge de rejeu : temps enregistré (s, horloge DOT) correspondant à l'instant présent.
+    """
+
+    def __init__(self, t_first, speed=1.0):
+        self.t_first = t_first
+        self.speed = speed
+        self.t0_ns = None
+
+    def start(self):
+        self.t0_ns = time.perf_counter_ns()
+
+    def now(self):
+        return self.t_first + (time.perf_counter_ns() - self.t0_ns) / 1e9 * self.speed
+
+
+class _Replayer(abc.ABC):
+    """
+    Boucle de rejeu dans un thread : à chaque pas, publie tout ce dont l'heure est passée.
+    Une exception du thread est conservée (error) et relancée par wait().
+    """
+
+    def __init__(self, clock, tick_s=0.002):
+        self.clock = clock
+        self.tick_s = tick_s
+        self.done = threading.Event()
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @abc.abstractmethod
+    def _step(self, now):
+        """Publie les données jusqu'à now. Renvoie True quand tout a été rejoué."""
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if self._step(self.clock.now()):
+                    break
+                time.sleep(self.tick_s)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wait(self, timeout=None):
+        finished = self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return finished
+
+
+class DotReplayer(_Replayer):
+    """
+    Remplace DotStreamer : mêmes tampons (buffers), remplis depuis la session au lieu du SDK.
+    Les sampleTimeFine et compteurs de paquets enregistrés sont conservés.
+    """
+
+    def __init__(self, reader, clock=None, speed=1.0, addresses=None, tick_s=0.002):
+        addresses = list(addresses or reader.dot_addresses())
+        self.data = {address: reader.dot(address) for address in addresses}
+        self.times = {address: unwrap_sample_time_fine(data["sample_time_fine"])
+                      for address, data in self.data.items() if len(data)}
+        firsts = [t[0] for t in self.times.values()]
+        lasts = [t[-1] for t in self.times.values()]
+        self.t_first = min(firsts) if firsts else 0.0
+        self.duration = max(lasts) - self.t_first if lasts else 0.0
+        super().__init__(clock or ReplayClock(self.t_first, speed), tick_s)
+        self.buffers = {address: DotRingBuffer(max(1, len(data))) for address, data in self.data.items()}
+        self._cursors = {address: 0 for address in self.data}
+
+    def _step(self, now):
+        finished = True
+        for address, t in self.times.items():
+            cursor = self._cursors[address]
+            stop = int(np.searchsorted(t, now, side="right"))
+            if stop > cursor:
+                # Une ligne à la fois, comme le callback du SDK
+                rows = np.asarray(self.data[address][cursor:stop])
+                push = self.buffers[address].push
+                for q, a, stf, counter in zip(rows["quaternion"].tolist(),
+                                              rows["free_acceleration"].tolist(),
+                                              rows["sample_time_fine"].tolist(),
+                                              rows["packet_counter"].tolist()):
+                    push(q[0], q[1], q[2], q[3], a[0], a[1], a[2], stf, counter)
+                self._cursors[address] = stop
+            finished = finished and stop == len(t)
+        return finished
+
+
+class QtmReplayer(_Replayer):
+    """
+    Trames QTM de la session rejouées dans un QtmFrameBuffer, sur l'horloge de rejeu DOT.
+    Le temps QTM est ramené au temps DOT par l'alignement de la session, sinon par les
+    premiers échantillons des deux flux.
+    """
+
+    def __init__(self, reader, clock, tick_s=0.002):
+        super().__init__(clock, tick_s)
+        self.data = reader.qtm()
+        info = reader.streams["qtm"]
+        self.settings = {"frequency": info.get("frequency"), "marker_labels": info["marker_labels"],
+                         "body_names": info["body_names"]}
+        self.frames = QtmFrameBuffer(max(1, len(self.data)), len(info["marker_labels"]),
+                                     len(info["body_names"]))
+        t_qtm = self.data["timestamp"] / 1e6
+        alignment = reader.metadata.get("alignment", {})
+        if alignment:
+            result = AlignmentResult.from_dict(next(iter(alignment.values())))
+            self.times = result.t_ref_s + (t_qtm - result.offset_s - result.t_ref_s) / (1.0 + result.drift)
+        else:
+            self.times = t_qtm - (t_qtm[0] - clock.t_first if len(t_qtm) else 0.0)
+        self._cursor = 0
+
+    def _step(self, now):
+        start = self._cursor
+        stop = int(np.searchsorted(self.times, now, side="right"))
+        if stop > start:
+            frames, data = self.frames, self.data
+            frames.timestamp[start:stop] = data["timestamp"][start:stop]
+            frames.frame_number[start:stop] = data["frame_number"][start:stop]
+            frames.receive_ns[start:stop] = time.perf_counter_ns()
+            frames.timecode[start:stop] = data["timecode"][start:stop]
+            frames.markers[start:stop] = data["markers"][start:stop]
+            frames.body_position[start:stop] = data["body_position"][start:stop]
+            frames.body_rotation[start:stop] = data["body_rotation"][start:stop]
+            frames.count = stop  # Publication une fois les colonnes écrites
+            self._cursor = stop
+        return stop == len(self.times)
+
+
+async def replay(path, speed=1.0, output_dir="replays", qtm_source="session", qtm_file=None,
+                 body_map=None, qtm_host=flow.DEFAULT_HOST, qtm_port=flow.DEFAULT_PORT,
+                 qtm_password="Kiks", timings=True):
+    """
+    Rejoue la session path dans la chaîne temps réel et écrit une nouvelle session dans output_dir.
+    qtm_source : "session" (trames QTM de la session, à la même vitesse) ou "rtfromfile"
+                 (QTM rejoue qtm_file, ou la mesure déjà chargée, avec start(rtfromfile=True))
+    body_map : adresse Bluetooth -> corps rigide QTM (correction de cap et alignement d'horloge)
+    Renvoie le chemin de la session écrite.
+    """
+    instrumentation.enable(timings)
+    reader = SessionReader(path)
+    output_rate = reader.metadata.get("dot_output_rate", 60)
+    devices = reader.metadata.get("devices") or {address: address for address in reader.dot_addresses()}
+    dot = DotReplayer(reader, speed=speed)
+    flow.dot_streamer = dot
+    flow.start_markers.clear()
+    qtm = None
+
+    if qtm_source == "rtfromfile":
+        if speed != 1.0:
+            print(f"⚠️ QTM rejoue la mesure à sa propre vitesse : IMUs rejoués à x{speed:g}.")
+        await flow.connect_to_qtm(qtm_host, qtm_port, password=qtm_password)
+        if qtm_file:
+            connection = await flow.get_qtm_connection()
+            await connection.load(qtm_file)
+        await flow.start_streaming(duration=dot.duration / speed + 10, rtfromfile=True)
+        dot.clock.start()
+        flow.start_markers["dot_ack_ns"] = dot.clock.t0_ns
+    else:
+        if "qtm" in reader.streams:
+            qtm = QtmReplayer(reader, dot.clock)
+            flow.qtm_frames, flow.qtm_settings = qtm.frames, qtm.settings
+            if len(qtm.times):
+                # Repères de démarrage en temps enregistré : premier échantillon de chaque flux
+                flow.start_markers["dot_ack_ns"] = int(dot.t_first * 1e9)
+                flow.start_markers["qtm_ack_ns"] = int(qtm.times[0] * 1e9)
+        else:
+            flow.qtm_frames, flow.qtm_settings = None, reader.metadata.get("qtm_capture")
+        dot.clock.start()
+
+    name = f"replay_{os.path.basename(os.path.normpath(path))}_x{speed:g}"
+    flow.open_session(output_dir, output_rate, name=name, devices=devices)
+    if body_map and flow.qtm_frames is not None:
+        flow.start_fusion(body_map)
+    print(f"⏩ Rejeu de {path} ({dot.duration:.1f} s enregistrées) à x{speed:g}...")
+
+    t0 = time.perf_counter()
+    dot.start()
+    if qtm is not None:
+        qtm.start()
+    drain_stop = asyncio.Event()
+    drain = asyncio.create_task(flow.drain_session(drain_stop))
+    loop = asyncio.get_running_loop()
+    failed = True
+    try:
+        # La première erreur d'un rejeu est relancée sans attendre la fin de l'autre
+        await asyncio.gather(*(loop.run_in_executor(None, replayer.wait)
+                               for replayer in (dot, qtm) if replayer is not None))
+        failed = False
+    finally:
+        # Erreur d'un rejeu : l'autre est arrêté, la session partielle est écrite puis fermée
+        dot.stop()
+        if qtm is not None:
+            qtm.stop()
+        if qtm_source == "rtfromfile":
+            await flow.stop_streaming()
+        drain_stop.set()
+        await drain
+        if failed:
+            flow.session_writer.close()
+    elapsed = time.perf_counter() - t0
+
+    flow._drain_once(final=True)
+    flow.gap_filler.report()
+    if flow.heading_fusion is not None:
+        flow.heading_fusion.report()
+    if body_map and flow.qtm_frames is not None and flow.start_markers.get("dot_ack_ns"):
+        alignment = align_streams(dot, flow.qtm_frames, body_map, flow.qtm_settings["body_names"],
+                                  flow.start_markers)
+        flow.session_writer.set_metadata(
+            alignment={address: result.to_dict() for address, result in alignment.items()})
+    flow.session_writer.set_metadata(replay={
+        "source": os.path.abspath(path), "qtm_source": qtm_source, "speed": speed,
+        "elapsed_s": elapsed, "achieved_speed": dot.duration / elapsed if elapsed else None})
+    flow.session_writer.close()
+    print(f"✅ Rejeu terminé en {elapsed:.2f} s (x{dot.duration / elapsed:.1f} le temps réel).")
+
+    if qtm_source == "rtfromfile":
+        await flow.qtm_manager.stop()
+    if timings:
+        instrumentation.dump(os.path.join(output_dir, time.strftime("timings_replay_%Y%m%d_%H%M%S.json")),
+                             replay=True, speed=speed, n_devices=len(dot.buffers))
+    return flow.session_writer.path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rejeu d'une session dans la chaîne temps réel")
+    parser.add_argument("session", help="Dossier de la session à rejouer")
+    parser.add_argument("--speed", type=float, default=1.0, help="Vitesse de rejeu (x temps réel)")
+    parser.add_argument("--output", default="replays", help="Dossier des sessions rejouées")
+    parser.add_argument("--qtm", choices=("session", "rtfromfile"), default="session",
+                        help="Source des trames QTM")
+    parser.add_argument("--qtm-file", default=None, help="Mesure QTM à charger (--qtm rtfromfile)")
+    parser.add_argument("--body-map", default=None, help="Fichier JSON adresse -> corps rigide QTM")
+    args = parser.parse_args()
+    body_map = None
+    if args.body_map:
+        with open(args.body_map, encoding="utf-8") as f:
+            body_map = json.load(f)
+    asyncio.run(replay(args.session, args.speed, args.output, args.qtm, args.qtm_file, body_map))
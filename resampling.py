@@ -0,0 +1,271 @@
+import numpy as np
+
+from clock_alignment import AlignmentResult, unwrap_sample_time_fine
+
+""" Rééchantillonnage de tous les flux (DOT et QTM) sur une base de temps commune :
+- Interpolation linéaire des vecteurs et slerp des quaternions
+- Calcul vectorisé sur tous les capteurs et tous les échantillons (recherche groupée des voisins)
+- Les échantillons marqués invalides sont ignorés ; les trous plus longs que max_gap_s restent invalides
+- Version incrémentale pour les blocs du streaming
+"""
+
+_NS = 1e9
+
+
+def pad_streams(arrays, fill=np.nan):
+    """
+    Empile des tableaux de longueurs différentes (premier axe) en un tableau (D, N, ...) complété par fill.
+    Renvoie (tableau, longueurs).
+    """
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    shape = (len(arrays), int(lengths.max(initial=0))) + np.shape(arrays[0])[1:]
+    padded = np.full(shape, fill, dtype=np.result_type(arrays[0], np.float64))
+    for d, a in enumerate(arrays):
+        padded[d, :len(a)] = a
+    return padded, lengths
+
+
+def common_timebase(t_src, rate):
+    """
+    Grille uniforme (s) couvrant l'intervalle commun à tous les flux (D, N).
+    """
+    t = np.asarray(t_src, dtype=np.float64)
+    start = np.nanmax(np.nanmin(t, axis=1))
+    stop = np.nanmin(np.nanmax(t, axis=1))
+    n = int(np.floor((stop - start) * rate + 1e-9)) + 1
+    return start + np.arange(max(n, 0)) / rate
+
+
+def _compact(t_src, valid):
+    """
+    Repousse les échantillons invalides en fin de ligne (tri stable vectorisé).
+    Renvoie (ordre, temps compactés avec NaN à la fin, nombre d'échantillons valides par ligne).
+    """
+    order = np.argsort(~valid, axis=1, kind="stable")
+    t = np.take_along_axis(t_src, order, axis=1)
+    n_valid = valid.sum(axis=1)
+    t[np.arange(t.shape[1])[None, :] >= n_valid[:, None]] = np.nan
+    return order, t, n_valid
+
+
+def _neighbours(t_src, n_valid, t_target):
+    """
+    Indices (D, T) de l'échantillon source précédent chaque instant cible, pour toutes les lignes
+    en un seul searchsorted : chaque ligne est décalée d'une portée entière en nanosecondes.
+    """
+    d, n = t_src.shape
+    lo = min(np.nanmin(t_src), t_target.min()) if np.isfinite(t_src).any() else t_target.min()
+    src = np.round((np.nan_to_num(t_src, nan=np.inf) - lo) * _NS)
+    tgt = np.round((t_target - lo) * _NS)
+    span = max(np.nanmax(np.where(np.isfinite(src), src, 0)), tgt.max()) + 2
+    src = np.where(np.isfinite(src), src, span - 1).astype(np.int64)
+    offsets = (np.arange(d, dtype=np.int64) * int(span))[:, None]
+    flat = (src + offsets).ravel()
+    index = np.searchsorted(flat, (tgt.astype(np.int64)[None, :] + offsets).ravel(), side="right")
+    index = index.reshape(d, -1) - (np.arange(d) * n)[:, None]
+    # Segment [i0, i0 + 1] encadrant l'instant cible
+    i0 = np.clip(index - 1, 0, np.maximum(n_valid - 2, 0)[:, None])
+    return i0
+
+
+def slerp(q0, q1, w):
+    """
+    Interpolation sphérique vectorisée entre quaternions (..., 4) avec poids w (...).
+    """
+    dot = np.sum(q0 * q1, axis=-1)
+    q1 = np.where((dot < 0)[..., None], -q1, q1)
+    dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    small = sin_theta < 1e-6
+    safe = np.where(small, 1.0, sin_theta)
+    a = np.where(small, 1.0 - w, np.sin((1.0 - w) * theta) / safe)
+    b = np.where(small, w, np.sin(w * theta) / safe)
+    q = a[..., None] * q0 + b[..., None] * q1
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def rotation_matrix_to_quaternion(rotation):
+    """
+    Matrices de rotation QTM (..., 9, ordre colonne) -> quaternions (..., 4) w, x, y, z.
+    """
+    r = np.asarray(rotation, dtype=np.float64).reshape(np.shape(rotation)[:-1] + (3, 3))
+    r = np.swapaxes(r, -1, -2)  # Ordre colonne -> R[ligne, colonne]
+    m00, m11, m22 = r[..., 0, 0], r[..., 1, 1], r[..., 2, 2]
+    q = np.stack([
+        np.sqrt(np.maximum(0.0, 1.0 + m00 + m11 + m22)) / 2.0,
+        np.sqrt(np.maximum(0.0, 1.0 + m00 - m11 - m22)) / 2.0,
+        np.sqrt(np.maximum(0.0, 1.0 - m00 + m11 - m22)) / 2.0,
+        np.sqrt(np.maximum(0.0, 1.0 - m00 - m11 + m22)) / 2.0,
+    ], axis=-1)
+    q[..., 1] = np.copysign(q[..., 1], r[..., 2, 1] - r[..., 1, 2])
+    q[..., 2] = np.copysign(q[..., 2], r[..., 0, 2] - r[..., 2, 0])
+    q[..., 3] = np.copysign(q[..., 3], r[..., 1, 0] - r[..., 0, 1])
+    return q
+
+
+def resample(t_src, t_target, vectors=None, quaternions=None, valid=None, max_gap_s=0.1):
+    """
+    Rééchantillonne D flux sur t_target (T,).
+
+    t_src : temps (D, N) en secondes, NaN pour le remplissage
+    vectors : (D, N, K) interpolés linéairement ; quaternions : (D, N, 4) interpolés par slerp
+    valid : masque (D, N) des échantillons utilisables (par défaut : temps fini)
+    max_gap_s : au-delà, un trou n'est pas comblé et les instants concernés sont invalides
+    Renvoie un dict avec "vectors", "quaternions" (D, T, ...) et "valid" (D, T).
+    """
+    t_src = np.asarray(t_src, dtype=np.float64)
+    t_target = np.asarray(t_target, dtype=np.float64)
+    finite = np.isfinite(t_src)
+    valid = finite if valid is None else (np.asarray(valid, dtype=bool) & finite)
+
+    order, t, n_valid = _compact(t_src, valid)
+    i0 = _neighbours(t, n_valid, t_target)
+    i1 = np.minimum(i0 + 1, t.shape[1] - 1)
+    t0 = np.take_along_axis(t, i0, axis=1)
+    t1 = np.take_along_axis(t, i1, axis=1)
+    dt = t1 - t0
+    w = np.where(dt > 0, (t_target[None, :] - t0) / np.where(dt > 0, dt, 1.0), 0.0)
+
+    ok = (n_valid[:, None] >= 2) & (w >= 0.0) & (w <= 1.0) & np.isfinite(dt)
+    if max_gap_s is not None:
+        ok &= dt <= max_gap_s
+    w = np.clip(w, 0.0, 1.0)
+
+    out = {"t": t_target, "valid": ok}
+    # Indices dans les tableaux d'origine (avant compactage)
+    j0 = np.take_along_axis(order, i0, axis=1)
+    j1 = np.take_along_axis(order, i1, axis=1)
+
+    if vectors is not None:
+        v = np.asarray(vectors, dtype=np.float64)
+        v0 = np.take_along_axis(v, j0[..., None], axis=1)
+        v1 = np.take_along_axis(v, j1[..., None], axis=1)
+        result = v0 + w[..., None] * (v1 - v0)
+        result[~ok] = np.nan
+        out["vectors"] = result
+
+    if quaternions is not None:
+        q = np.asarray(quaternions, dtype=np.float64)
+        q0 = np.take_along_axis(q, j0[..., None], axis=1)
+        q1 = np.take_along_axis(q, j1[..., None], axis=1)
+        result = slerp(q0, q1, w)
+        result[~ok] = np.nan
+        out["quaternions"] = result
+
+    return out
+
+
+class StreamingResampler:
+    """
+    Rééchantillonnage incrémental des blocs du streaming sur une grille commune.
+    Chaque flux garde ses derniers échantillons pour interpoler à la jonction des blocs.
+    """
+
+    def __init__(self, n_streams, rate, n_vector=3, max_gap_s=0.1, t_start=None):
+        self.rate = rate
+        self.max_gap_s = max_gap_s
+        self.n_vector = n_vector
+        self.next_t = t_start
+        self._t = [np.zeros(0) for _ in range(n_streams)]
+        self._v = [np.zeros((0, n_vector)) for _ in range(n_streams)]
+        self._q = [np.zeros((0, 4)) for _ in range(n_streams)]
+        self._valid = [np.zeros(0, dtype=bool) for _ in range(n_streams)]
+
+    def push(self, stream, t, vectors, quaternions, valid=None):
+        """
+        Ajoute un bloc (temps en secondes) pour un flux.
+        """
+        valid = np.ones(len(t), dtype=bool) if valid is None else valid
+        self._t[stream] = np.concatenate([self._t[stream], t])
+        self._v[stream] = np.concatenate([self._v[stream], vectors])
+        self._q[stream] = np.concatenate([self._q[stream], quaternions])
+        self._valid[stream] = np.concatenate([self._valid[stream], valid])
+
+    def emit(self):
+        """
+        Rééchantillonne jusqu'au dernier instant couvert par tous les flux.
+        Renvoie le même dict que resample(), ou None si aucun instant n'est prêt.
+        """
+        if any(len(t) < 2 for t in self._t):
+            return None
+        if self.next_t is None:
+            self.next_t = max(t[0] for t in self._t)
+        stop = min(t[-1] for t in self._t)
+        n = int(np.floor((stop - self.next_t) * self.rate + 1e-9)) + 1
+        if n <= 0:
+            return None
+        t_target = self.next_t + np.arange(n) / self.rate
+
+        t_src, _ = pad_streams(self._t)
+        out = resample(t_src, t_target,
+                       vectors=pad_streams(self._v)[0],
+                       quaternions=pad_streams(self._q)[0],
+                       valid=pad_streams(self._valid, fill=False)[0].astype(bool),
+                       max_gap_s=self.max_gap_s)
+
+        self.next_t = t_target[-1] + 1.0 / self.rate
+        # On garde les échantillons postérieurs au dernier instant émis, plus celui qui le précède
+        for s, t in enumerate(self._t):
+            keep = max(0, int(np.searchsorted(t, t_target[-1], side="right")) - 1)
+            self._t[s] = t[keep:]
+            self._v[s] = self._v[s][keep:]
+            self._q[s] = self._q[s][keep:]
+            self._valid[s] = self._valid[s][keep:]
+        return out
+
+
+def resample_session(reader, rate=100.0, max_gap_s=0.1):
+    """
+    Met tous les capteurs DOT et le flux QTM d'une session sur une grille commune (temps QTM, s).
+    Les temps DOT sont convertis en temps QTM avec l'alignement de la session s'il existe.
+    """
+    alignment = reader.metadata.get("alignment", {})
+    addresses = reader.dot_addresses()
+    times, accelerations, quaternions = [], [], []
+    for address in addresses:
+        data = reader.dot(address)
+        t = unwrap_sample_time_fine(data["sample_time_fine"]) if len(data) else np.zeros(0)
+        if address in alignment:
+            t = AlignmentResult.from_dict(alignment[address]).dot_to_qtm_time(t)
+        times.append(t)
+        accelerations.append(np.asarray(data["free_acceleration"]))
+        quaternions.append(np.asarray(data["quaternion"]))
+
+    streams = {}
+    qtm = reader.qtm() if "qtm" in reader.streams else None
+    t_list = list(times)
+    if qtm is not None and len(qtm):
+        t_list.append(qtm["timestamp"] / 1e6)
+    t_all, _ = pad_streams(t_list)
+    t_target = common_timebase(t_all, rate)
+
+    if addresses:
+        t_dot, _ = pad_streams(times)
+        dot = resample(t_dot, t_target, vectors=pad_streams(accelerations)[0],
+                       quaternions=pad_streams(quaternions)[0], max_gap_s=max_gap_s)
+        streams["dot"] = {"addresses": addresses, "free_acceleration": dot["vectors"],
+                          "quaternion": dot["quaternions"], "valid": dot["valid"]}
+
+    if qtm is not None and len(qtm):
+        t_qtm = (qtm["timestamp"] / 1e6)[None, :]
+        n = len(qtm)
+        positions = np.concatenate([np.asarray(qtm["markers"]).reshape(n, -1),
+                                    np.asarray(qtm["body_position"]).reshape(n, -1)], axis=1)
+        n_bodies = qtm["body_rotation"].shape[1]
+        body_q = rotation_matrix_to_quaternion(qtm["body_rotation"])  # (n, B, 4)
+        # Chaque corps rigide est un flux de quaternions partageant les temps QTM
+        body_q = np.swapaxes(body_q, 0, 1)
+        out_q = resample(np.repeat(t_qtm, n_bodies, axis=0), t_target, quaternions=body_q,
+                         valid=np.isfinite(body_q).all(axis=-1), max_gap_s=max_gap_s)
+        out_p = resample(t_qtm, t_target, vectors=positions[None], max_gap_s=max_gap_s)
+        n_markers = qtm["markers"].shape[1]
+        p = out_p["vectors"][0]
+        streams["qtm"] = {
+            "markers": p[:, :n_markers * 3].reshape(-1, n_markers, 3),
+            "body_position": p[:, n_markers * 3:].reshape(-1, n_bodies, 3),
+            "body_quaternion": np.swapaxes(out_q["quaternions"], 0, 1),
+            "valid": out_p["valid"][0],
+        }
+
+    return t_target, streams
@@ -0,0 +1,195 @@
+import json
+import os
+import time
+
+import numpy as np
+
+""" Fichier de session (IMU + mocap) en colonnes, écrit par blocs :
+- Un dossier par session : session.json (métadonnées, schémas, nombre de lignes)
+  et un fichier binaire par flux (dot_<adresse>.bin, qtm.bin) en enregistrements NumPy structurés
+- Écriture incrémentale depuis les tampons d'acquisition (mémoire constante sur les longues captures)
+- Lecture par np.memmap pour découper rapidement les longues sessions
+"""
+
+SESSION_VERSION = 1
+METADATA_FILE = "session.json"
+
+DOT_DTYPE = np.dtype([
+    ("sample_time_fine", "<u4"),
+    ("packet_counter", "<u4"),
+    ("quaternion", "<f4", (4,)),
+    ("free_acceleration", "<f4", (3,)),
+])
+
+
+def qtm_dtype(n_markers, n_bodies):
+    """
+    Schéma des trames QTM pour un nombre fixe de marqueurs et de corps rigides.
+    """
+    return np.dtype([
+        ("timestamp", "<i8"),
+        ("frame_number", "<i8"),
+        ("receive_ns", "<i8"),
+        ("timecode", "<u8"),
+        ("markers", "<f4", (n_markers, 3)),
+        ("body_position", "<f4", (n_bodies, 3)),
+        ("body_rotation", "<f4", (n_bodies, 9)),
+    ])
+
+
+def dot_stream_name(address):
+    return "dot_" + address.replace(":", "")
+
+
+class SessionWriter:
+    """
+    Écrit une session par blocs. Chaque flux a un schéma fixe déclaré à l'avance.
+    """
+
+    def __init__(self, path, metadata=None, chunk_size=4096):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.metadata = {
+            "version": SESSION_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "streams": {},
+        }
+        self.metadata.update(metadata or {})
+        self._files = {}
+        self._scratch = {}
+        self._dot_cursors = {}
+        self._qtm_cursor = 0
+
+    def add_stream(self, name, dtype, **info):
+        """
+        Déclare un flux et ouvre son fichier binaire.
+        """
+        file_name = name + ".bin"
+        self.metadata["streams"][name] = dict(
+            file=file_name, dtype=np.lib.format.dtype_to_descr(dtype), rows=0, **info)
+        self._files[name] = open(os.path.join(self.path, file_name), "wb")
+        self._scratch[name] = np.zeros(self.chunk_size, dtype=dtype)
+
+    def add_dot_device(self, address, tag=None, output_rate=None):
+        self.add_stream(dot_stream_name(address), DOT_DTYPE, kind="dot",
+                        address=address, tag=tag, output_rate=output_rate)
+
+    def add_qtm(self, marker_labels, body_names, frequency=None):
+        self.add_stream("qtm", qtm_dtype(len(marker_labels), len(body_names)), kind="qtm",
+                        marker_labels=list(marker_labels), body_names=list(body_names),
+                        frequency=frequency)
+
+    def append(self, name, records):
+        """
+        Ajoute des enregistrements structurés à la fin d'un flux.
+        """
+        self._files[name].write(np.ascontiguousarray(records).tobytes())
+        self.metadata["streams"][name]["rows"] += len(records)
+
+    def _append_columns(self, name, columns, n):
+        """
+        Copie des colonnes (vues des tampons) dans le bloc tampon du flux puis l'écrit.
+        """
+        scratch = self._scratch[name]
+        for start in range(0, n, len(scratch)):
+            stop = min(start + len(scratch), n)
+            chunk = scratch[:stop - start]
+            for field, values in columns.items():
+                chunk[field] = values[start:stop]
+            self.append(name, chunk)
+
+    def append_dot_blocks(self, address, blocks):
+        """
+        Ajoute les blocs renvoyés par DotRingBuffer.read_since().
+        """
+        name = dot_stream_name(address)
+        for block in blocks:
+            self._append_columns(name, block, len(block["sample_time_fine"]))
+
+    def append_qtm_frames(self, frames, start=0, stop=None):
+        """
+        Ajoute les trames [start, stop) d'un QtmFrameBuffer.frames().
+        """
+        stop = len(frames["timestamp"]) if stop is None else stop
+        columns = {field: frames[field][start:stop] for field in self._scratch["qtm"].dtype.names}
+        self._append_columns("qtm", columns, stop - start)
+
+    def drain(self, dot_streamer=None, qtm_frames=None):
+        """
+        Écrit ce qui est arrivé dans les tampons d'acquisition depuis le dernier appel.
+        Renvoie le nombre d'échantillons DOT perdus (tampon circulaire écrasé).
+        """
+        lost = 0
+        if dot_streamer is not None:
+            for address, buffer in dot_streamer.buffers.items():
+                blocks, cursor, n_lost = buffer.read_since(self._dot_cursors.get(address, 0))
+                self.append_dot_blocks(address, blocks)
+                self._dot_cursors[address] = cursor
+                lost += n_lost
+        if qtm_frames is not None:
+            count = qtm_frames.count
+            self.append_qtm_frames(qtm_frames.frames(), self._qtm_cursor, count)
+            self._qtm_cursor = count
+        self.flush()
+        return lost
+
+    def set_metadata(self, **values):
+        self.metadata.update(values)
+
+    def flush(self):
+        """
+        Vide les fichiers et met à jour session.json (nombre de lignes de chaque flux).
+        """
+        for f in self._files.values():
+            f.flush()
+        tmp = os.path.join(self.path, METADATA_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.metadata, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, METADATA_FILE))
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class SessionReader:
+    """
+    Lecture d'une session : chaque flux est projeté en mémoire (np.memmap), sans chargement complet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, METADATA_FILE), encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        self._cache = {}
+
+    @property
+    def streams(self):
+        return self.metadata["streams"]
+
+    def stream(self, name):
+        """
+        Renvoie le flux sous forme de tableau structuré projeté en mémoire (lecture seule).
+        """
+        if name not in self._cache:
+            info = self.streams[name]
+            dtype = np.lib.format.descr_to_dtype(info["dtype"])
+            rows = info["rows"]
+            if rows == 0:
+                self._cache[name] = np.zeros(0, dtype=dtype)
+            else:
+                self._cache[name] = np.memmap(os.path.join(self.path, info["file"]),
+                                              dtype=dtype, mode="r", shape=(rows,))
+        return self._cache[name]
+
+    def dot(self, address):
+        return self.stream(dot_stream_name(address))
+
+    def dot_addresses(self):
+        return [info["address"] for info in self.streams.values() if info.get("kind") == "dot"]
+
+    def qtm(self):
+        return self.stream("qtm")
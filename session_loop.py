@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+""" Boucle asyncio unique et persistante pour toute la session :
+- Possède la connexion QTM et lance les commandes des capteurs
+- API thread-safe (run_coroutine_threadsafe) pour y soumettre des coroutines depuis les autres threads
+"""
+
+
+class SessionLoop:
+    """
+    Boucle asyncio exécutée dans un thread dédié pendant toute la session.
+    """
+
+    def __init__(self, name="session-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._started = threading.Event()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            # Annulation des tâches restantes avant la fermeture de la boucle
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def start(self):
+        """
+        Démarre le thread de la boucle et attend qu'elle tourne.
+        """
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def is_running(self):
+        return self._thread.is_alive() and self.loop.is_running()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """
+        Soumet une coroutine depuis n'importe quel thread.
+        Renvoie un concurrent.futures.Future.
+        """
+        if self.in_loop_thread():
+            raise RuntimeError(
+                "submit() appelé depuis la boucle de session : utiliser await directement.")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro, timeout=None):
+        """
+        Soumet une coroutine et attend son résultat (bloquant).
+        """
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback, *args):
+        """
+        Programme un appel de fonction dans la boucle depuis n'importe quel thread.
+        """
+        return self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self, timeout=5.0):
+        """
+        Arrête la boucle et attend la fin du thread.
+        """
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
@@ -0,0 +1,655 @@
+import asyncio
+import math
+import random
+import struct
+import sys
+import threading
+import time
+import types
+import xml.etree.ElementTree as ET
+
+""" Simulateurs sans matériel pour les tests et les mesures de performance :
+- Faux XdpcHandler / capteurs Movella DOT (scan, openPort, startSync, enregistrement,
+  streaming, export) avec latence BLE et pertes de paquets configurables
+- Faux serveur QTM RT local (protocole little endian) suffisant pour qtm_rt.connect,
+  take_control, start, stop, get_parameters, stream_frames et les événements
+- install() enregistre les faux modules xdpchandler / movelladot_pc_sdk dans sys.modules
+"""
+
+
+class SimulationConfig:
+    """
+    Paramètres de la simulation (temps en secondes).
+    """
+
+    def __init__(self, n_sensors=4, ble_latency=0.015, ble_jitter=0.005, connect_time=0.3,
+                 connect_failure=0.0, sync_time=0.5, sync_failure=0.0, scan_time=0.2,
+                 packet_loss=0.0, output_rate=60, clock_offset_s=0.0, clock_drift=0.0,
+                 battery_level=90, unresponsive=(), sync_blockers=(), first_index=0, counter_start=0,
+                 seed=None):
+        self.n_sensors = n_sensors
+        self.ble_latency = ble_latency
+        self.ble_jitter = ble_jitter
+        self.connect_time = connect_time
+        self.connect_failure = connect_failure
+        self.sync_time = sync_time
+        self.sync_failure = sync_failure
+        self.scan_time = scan_time
+        self.packet_loss = packet_loss
+        self.output_rate = output_rate
+        self.clock_offset_s = clock_offset_s  # Horloge DOT = horloge QTM - décalage
+        self.clock_drift = clock_drift
+        self.battery_level = battery_level
+        self.unresponsive = set(unresponsive)    # Adresses qui ne répondent plus aux commandes
+        self.sync_blockers = set(sync_blockers)  # Adresses qui font échouer startSync
+        self.first_index = first_index  # Premier capteur visible (un adaptateur BLE par processus)
+        self.counter_start = counter_start  # Premier compteur de paquets (proche de 0xFFFF : retour à 0)
+        self.random = random.Random(seed)
+
+    def latency(self):
+        return max(0.0, self.ble_latency + self.random.uniform(-self.ble_jitter, self.ble_jitter))
+
+
+# Horloge commune aux simulateurs DOT et QTM (mouvement partagé par capteurs et corps rigides)
+_EPOCH = time.perf_counter()
+
+
+def sim_time():
+    return time.perf_counter() - _EPOCH
+
+
+def motion_quaternion(t, phase=0.0):
+    """
+    Orientation simulée (w, x, y, z) d'un segment à l'instant t (vecteur de rotation sinusoïdal).
+    """
+    rx = 0.8 * math.sin(1.3 * t + phase)
+    ry = 0.5 * math.sin(0.7 * t + 2.0 * phase)
+    rz = 1.2 * math.sin(0.4 * t + 0.5 * phase)
+    angle = math.sqrt(rx * rx + ry * ry + rz * rz)
+    if angle < 1e-12:
+        return 1.0, 0.0, 0.0, 0.0
+    s = math.sin(angle / 2.0) / angle
+    return math.cos(angle / 2.0), rx * s, ry * s, rz * s
+
+
+def quaternion_to_matrix(q):
+    """
+    Quaternion -> matrice de rotation à plat, ordre colonne (comme QTM).
+    """
+    w, x, y, z = q
+    return (1 - 2 * (y * y + z * z), 2 * (x * y + w * z), 2 * (x * z - w * y),
+            2 * (x * y - w * z), 1 - 2 * (x * x + z * z), 2 * (y * z + w * x),
+            2 * (x * z + w * y), 2 * (y * z - w * x), 1 - 2 * (x * x + y * y))
+
+
+# ---------------------------------------------------------------------------
+# Faux SDK Movella DOT
+# ---------------------------------------------------------------------------
+
+class FakeVector(list):
+    pass
+
+
+class FakePacket:
+    def __init__(self, quaternion, acceleration, sample_time_fine, packet_counter):
+        self._q = FakeVector(quaternion)
+        self._a = FakeVector(acceleration)
+        self._stf = sample_time_fine
+        self._counter = packet_counter
+
+    def containsOrientation(self):
+        return True
+
+    def orientationQuaternion(self):
+        return self._q
+
+    def freeAcceleration(self):
+        return self._a
+
+    def sampleTimeFine(self):
+        return self._stf
+
+    def packetCounter(self):
+        return self._counter
+
+
+class FakePortInfo:
+    def __init__(self, address, device_id):
+        self._address = address
+        self._device_id = device_id
+
+    def bluetoothAddress(self):
+        return self._address
+
+    def deviceId(self):
+        return self._device_id
+
+
+class FakeDevice:
+    """
+    Capteur Movella DOT simulé : chaque commande coûte un aller-retour BLE.
+    """
+
+    def __init__(self, handler, port_info, index):
+        self._handler = handler
+        self._config = handler.config
+        self._port_info = port_info
+        self._index = index
+        self._last_result = "XRV_OK"
+        self._output_rate = self._config.output_rate
+        self._streaming = None
+        self._recording_start = None
+        self._recordings = []  # Durées (s) des enregistrements embarqués
+        self.sent_packets = 0
+        self.connected = True
+
+    def _command(self):
+        time.sleep(self._config.latency())
+        if not self.connected:
+            self._last_result = "XRV_NOTCONNECTED"
+            return False
+        if self.bluetoothAddress() in self._config.unresponsive:
+            self._last_result = "XRV_TIMEOUT"
+            return False
+        self._last_result = "XRV_OK"
+        return True
+
+    def _sample_time_fine(self):
+        c = self._config
+        t = sim_time() * (1.0 + c.clock_drift) - c.clock_offset_s
+        return int(t * 1e6) & 0xFFFFFFFF
+
+    def bluetoothAddress(self):
+        return self._port_info.bluetoothAddress()
+
+    def deviceTagName(self):
+        return f"DOT{self._index + 1}"
+
+    def deviceId(self):
+        return self._port_info.deviceId()
+
+    def portInfo(self):
+        return self._port_info
+
+    def lastResultText(self):
+        return self._last_result
+
+    def batteryLevel(self):
+        if not self._command():
+            return False
+        return self._config.battery_level
+
+    def isCharging(self):
+        return False
+
+    def setOutputRate(self, rate):
+        if not self._command():
+            return False
+        self._output_rate = rate
+        return True
+
+    def startRecording(self):
+        if not self._command():
+            return False
+        self._recording_start = sim_time()
+        return True
+
+    def startTimedRecording(self, duration):
+        return self.startRecording()
+
+    def stopRecording(self):
+        if not self._command():
+            return False
+        if self._recording_start is not None:
+            self._recordings.append(sim_time() - self._recording_start)
+            self._recording_start = None
+        self._handler.onRecordingStopped(self)
+        return True
+
+    def recordingCount(self):
+        return len(self._recordings)
+
+    def selectExportData(self, data):
+        return self._command()
+
+    def startExportRecording(self, index):
+        if not self._command():
+            return False
+        n = int(self._recordings[index - 1] * self._output_rate)
+
+        def export():
+            for k in range(n):
+                t = k / self._output_rate
+                self._handler.onRecordedDataAvailable(
+                    self, FakePacket(motion_quaternion(t, self._index), (0.0, 0.0, 0.0),
+                                     int(t * 1e6) & 0xFFFFFFFF, k))
+            self._handler.onRecordedDataDone(self)
+
+        threading.Thread(target=export, daemon=True).start()
+        return True
+
+    def stopExportRecording(self):
+        return self._command()
+
+    def startMeasurement(self, payload_mode):
+        if not self._command():
+            return False
+        stop = threading.Event()
+        self._streaming = stop
+        threading.Thread(target=self._stream, args=(stop,), daemon=True).start()
+        return True
+
+    def stopMeasurement(self):
+        if self._streaming is not None:
+            self._streaming.set()
+            self._streaming = None
+        return self._command()
+
+    def _stream(self, stop):
+        """
+        Envoie les paquets temps réel au rythme de la fréquence de sortie (avec pertes simulées).
+        """
+        period = 1.0 / self._output_rate
+        counter = self._config.counter_start
+        next_t = time.perf_counter()
+        while not stop.is_set():
+            next_t += period
+            delay = next_t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            counter = (counter + 1) & 0xFFFF  # Compteur de paquets 16 bits du SDK
+            if self._config.packet_loss and self._config.random.random() < self._config.packet_loss:
+                continue
+            packet = FakePacket(motion_quaternion(sim_time(), self._index), (0.0, 0.0, 9.81),
+                                self._sample_time_fine(), counter)
+            self.sent_packets += 1
+            self._handler.onLiveDataAvailable(self, packet)
+
+
+class FakeConnectionManager:
+    def __init__(self, handler):
+        self._handler = handler
+        self._config = handler.config
+        self._devices = {}
+        self._last_result = "XRV_OK"
+        self._detection = False
+
+    def enableDeviceDetection(self):
+        self._detection = True
+        self._handler._start_advertising()
+        return True
+
+    def disableDeviceDetection(self):
+        self._detection = False
+        return True
+
+    def openPort(self, port_info):
+        time.sleep(self._config.connect_time * self._config.random.uniform(0.8, 1.2))
+        if self._config.random.random() < self._config.connect_failure:
+            self._last_result = "XRV_CONNECTIONFAILED"
+            return False
+        device_id = port_info.deviceId()
+        if device_id not in self._devices:
+            self._devices[device_id] = FakeDevice(self._handler, port_info, device_id)
+        self._devices[device_id].connected = True
+        self._last_result = "XRV_OK"
+        return True
+
+    def closePort(self, port_info):
+        device = self._devices.pop(port_info.deviceId(), None)
+        if device is not None:
+            device.connected = False
+
+    def device(self, device_id):
+        return self._devices.get(device_id)
+
+    def startSync(self, root_address):
+        time.sleep(self._config.sync_time)
+        blocked = any(device.bluetoothAddress() in self._config.sync_blockers | self._config.unresponsive
+                      for device in self._devices.values())
+        if blocked or self._config.random.random() < self._config.sync_failure:
+            self._last_result = "XRV_SYNC_FAILED"
+            return False
+        self._last_result = "XRV_OK"
+        return True
+
+    def stopSync(self):
+        time.sleep(self._config.ble_latency)
+        return True
+
+    def lastResultText(self):
+        return self._last_result
+
+
+class FakeXdpcHandler:
+    """
+    Remplaçant de XdpcHandler (mêmes méthodes et callbacks).
+    """
+
+    config = SimulationConfig()
+
+    def __init__(self, config=None):
+        if config is not None:
+            self.config = config
+        self._manager = None
+        self._detected = []
+        self.port_infos = [FakePortInfo(f"D4:22:CD:00:{i // 256:02X}:{i % 256:02X}", i)
+                           for i in range(self.config.first_index,
+                                          self.config.first_index + self.config.n_sensors)]
+
+    def initialize(self):
+        self._manager = FakeConnectionManager(self)
+        return True
+
+    def cleanup(self):
+        for device in list(self._manager._devices.values()):
+            device.stopMeasurement()
+
+    def manager(self):
+        return self._manager
+
+    def _start_advertising(self):
+        """
+        Publie les capteurs un par un, comme les annonces BLE.
+        """
+        def advertise():
+            for port_info in self.port_infos:
+                time.sleep(self.config.scan_time / max(1, len(self.port_infos)))
+                if not self._manager._detection:
+                    return
+                if port_info not in self._detected:
+                    self._detected.append(port_info)
+                    self.onAdvertisementFound(port_info)
+
+        threading.Thread(target=advertise, daemon=True).start()
+
+    def scanForDots(self):
+        self._manager.enableDeviceDetection()
+        time.sleep(self.config.scan_time + 0.05)
+        self._manager.disableDeviceDetection()
+
+    def detectedDots(self):
+        return list(self._detected)
+
+    def connectedDots(self):
+        return list(self._manager._devices.values())
+
+    # Callbacks du SDK (remplacés par les modules d'acquisition)
+    def onAdvertisementFound(self, port_info):
+        pass
+
+    def onLiveDataAvailable(self, device, packet):
+        pass
+
+    def onRecordedDataAvailable(self, device, packet):
+        pass
+
+    def onRecordedDataDone(self, device):
+        pass
+
+    def onRecordingStopped(self, device):
+        pass
+
+    def onBatteryUpdated(self, device, battery_level, charging_status):
+        pass
+
+    def onDeviceStateChanged(self, device, new_state, old_state):
+        pass
+
+
+def install(config=None):
+    """
+    Enregistre les faux modules xdpchandler et movelladot_pc_sdk (à appeler avant d'importer les scripts).
+    """
+    if config is not None:
+        FakeXdpcHandler.config = config
+
+    sdk = types.ModuleType("movelladot_pc_sdk")
+    sdk.XsPayloadMode_ExtendedQuaternion = 7
+    sdk.RecordingData_Timestamp = 0
+    sdk.RecordingData_Quaternion = 2
+    sdk.RecordingData_FreeAcceleration = 7
+
+    class XsIntArray(list):
+        def push_back(self, value):
+            self.append(value)
+
+    sdk.XsIntArray = XsIntArray
+    handler_module = types.ModuleType("xdpchandler")
+    handler_module.XdpcHandler = FakeXdpcHandler
+    sys.modules["movelladot_pc_sdk"] = sdk
+    sys.modules["xdpchandler"] = handler_module
+    return FakeXdpcHandler
+
+
+# ---------------------------------------------------------------------------
+# Faux serveur QTM RT
+# ---------------------------------------------------------------------------
+
+_HEADER = struct.Struct("<II")
+PACKET_ERROR, PACKET_COMMAND, PACKET_XML, PACKET_DATA, PACKET_NO_MORE_DATA = 0, 1, 2, 3, 4
+PACKET_EVENT = 6
+
+EVENT_CAPTURE_STARTED = 3
+EVENT_CAPTURE_STOPPED = 4
+EVENT_RT_FROM_FILE_STARTED = 8
+EVENT_RT_FROM_FILE_STOPPED = 9
+
+
+class FakeQtmServer:
+    """
+    Serveur QTM RT simulé (un seul projet, n corps rigides avec quatre marqueurs chacun).
+    """
+
+    def __init__(self, host="127.0.0.1", port=22223, frequency=120, n_bodies=4,
+                 password=None, event_delay=0.002):
+        self.host = host
+        self.port = port
+        self.frequency = frequency
+        self.capture_time = 20.0
+        self.n_bodies = n_bodies
+        self.password = password
+        self.event_delay = event_delay
+        self.measuring = False
+        self.rtfromfile = False
+        self.state = EVENT_CAPTURE_STOPPED
+        self.command_log = []  # (commande, perf_counter_ns)
+        self._server = None
+        self._clients = {}  # writer -> état du client (abonnement aux trames)
+        self._frame_task = None
+        self._frame_number = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._frame_task is not None:
+            self._frame_task.cancel()
+        for writer in list(self._clients):
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def drop_connections(self):
+        """
+        Coupe brutalement toutes les connexions clientes (perte de liaison simulée).
+        """
+        for writer in list(self._clients):
+            writer.transport.abort()
+
+    @staticmethod
+    def _send(writer, packet_type, payload):
+        writer.write(_HEADER.pack(_HEADER.size + len(payload), packet_type) + payload)
+
+    def _send_command(self, writer, text, packet_type=PACKET_COMMAND):
+        self._send(writer, packet_type, text.encode() + b"\0")
+
+    def _broadcast_event(self, event):
+        self.state = event
+        for writer in list(self._clients):
+            self._send(writer, PACKET_EVENT, bytes([event]))
+
+    async def _handle_client(self, reader, writer):
+        client = {"streaming": False}
+        self._clients[writer] = client
+        self._send_command(writer, "QTM RT Interface connected")
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                size, packet_type = _HEADER.unpack(header)
+                payload = await reader.readexactly(size - _HEADER.size)
+                text = payload.rstrip(b"\0").decode(errors="replace")
+                self.command_log.append((text, time.perf_counter_ns()))
+                if packet_type == PACKET_XML:
+                    ok = self._apply_settings(text)
+                    self._send_command(
+                        writer, "Setting parameters succeeded" if ok else "Setting parameters failed")
+                else:
+                    await self._on_command(writer, client, text)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+
+    async def _on_command(self, writer, client, text):
+        words = text.split()
+        command = words[0].lower() if words else ""
+
+        if command == "version":
+            self._send_command(writer, f"Version set to {words[1]}")
+        elif command == "qtmversion":
+            self._send_command(writer, "QTM Version is 2023.3 (simulated)")
+        elif command == "byteorder":
+            self._send_command(writer, "Byte order is little endian")
+        elif command == "takecontrol":
+            if self.password is None or (len(words) > 1 and words[1] == self.password):
+                self._send_command(writer, "You are now master")
+            else:
+                self._send_command(writer, "Wrong or missing password", PACKET_ERROR)
+        elif command == "releasecontrol":
+            self._send_command(writer, "You are now a regular client")
+        elif command == "new":
+            self._send_command(writer, "Creating new connection")
+        elif command == "close":
+            self._send_command(writer, "Closing connection")
+        elif command == "getstate":
+            self._send(writer, PACKET_EVENT, bytes([self.state]))
+        elif command == "getparameters":
+            self._send_command(writer, self.parameters_xml(), PACKET_XML)
+        elif command == "start":
+            self.rtfromfile = len(words) > 1 and words[1].lower() == "rtfromfile"
+            self._send_command(
+                writer, "Starting RT from file" if self.rtfromfile else "Starting measurement")
+            await asyncio.sleep(self.event_delay)
+            self.trigger_start()
+        elif command == "stop":
+            self._send_command(writer, "Stopping measurement")
+            await asyncio.sleep(self.event_delay)
+            self.trigger_stop()
+        elif command == "streamframes":
+            if len(words) > 1 and words[1].lower() == "stop":
+                client["streaming"] = False
+            else:
+                client["streaming"] = True
+                client["components"] = [w.lower() for w in words[2:]]
+                self._ensure_frame_task()
+                if not self.measuring:
+                    self._send(writer, PACKET_NO_MORE_DATA, b"")
+        elif command in ("load", "loadproject"):
+            self._send_command(writer, "Measurement loaded" if command == "load" else "Project loaded")
+        elif command == "save":
+            self._send_command(writer, "Measurement saved")
+        elif command == "trig":
+            self._send_command(writer, "Trig ok")
+        elif command == "event":
+            self._send_command(writer, "Event set")
+        else:
+            self._send_command(writer, f"Parse error: {text}", PACKET_ERROR)
+        await writer.drain()
+
+    def trigger_start(self, rtfromfile=None):
+        """
+        Démarre une capture (comme depuis l'interface QTM) et envoie l'événement correspondant.
+        """
+        if rtfromfile is not None:
+            self.rtfromfile = rtfromfile
+        self.measuring = True
+        self._frame_number = 0
+        self._broadcast_event(
+            EVENT_RT_FROM_FILE_STARTED if self.rtfromfile else EVENT_CAPTURE_STARTED)
+        self._ensure_frame_task()
+
+    def trigger_stop(self):
+        self.measuring = False
+        self._broadcast_event(
+            EVENT_RT_FROM_FILE_STOPPED if self.rtfromfile else EVENT_CAPTURE_STOPPED)
+
+    def parameters_xml(self):
+        labels = "".join(f"<Label><Name>M{b}_{k}</Name></Label>"
+                         for b in range(self.n_bodies) for k in range(4))
+        bodies = "".join(f"<Body><Name>Body{b + 1}</Name></Body>" for b in range(self.n_bodies))
+        return ("<QTM_Parameters_Ver_1.25>"
+                f"<General><Frequency>{self.frequency}</Frequency>"
+                f"<Capture_Time>{self.capture_time}</Capture_Time></General>"
+                f"<The_3D>{labels}</The_3D>"
+                f"<The_6D><Bodies>{self.n_bodies}</Bodies>{bodies}</The_6D>"
+                "</QTM_Parameters_Ver_1.25>")
+
+    def _apply_settings(self, xml):
+        try:
+            root = ET.fromstring(xml)
+        except ET.ParseError:
+            return False
+        if root.tag != "QTM_Settings":
+            return False
+        frequency = root.findtext(".//General/Frequency")
+        capture_time = root.findtext(".//General/Capture_Time")
+        if frequency:
+            self.frequency = float(frequency)
+        if capture_time:
+            self.capture_time = float(capture_time)
+        return True
+
+    def _ensure_frame_task(self):
+        if self._frame_task is None or self._frame_task.done():
+            self._frame_task = asyncio.get_running_loop().create_task(self._send_frames())
+
+    def _frame(self, t):
+        """
+        Construit un paquet de données (composantes 3D, 6D et timecode).
+        """
+        markers, bodies = [], []
+        for b in range(self.n_bodies):
+            q = motion_quaternion(t, b)
+            position = (1000.0 * b, 0.0, 1000.0)
+            for k in range(4):
+                markers.append(struct.pack("<3f", position[0] + 50 * k, position[1], position[2]))
+            bodies.append(struct.pack("<3f", *position) + struct.pack("<9f", *quaternion_to_matrix(q)))
+        components = []
+        c = struct.pack("<Ihh", len(markers), 0, 0) + b"".join(markers)
+        components.append(struct.pack("<II", len(c) + 8, 1) + c)
+        c = struct.pack("<ihh", len(bodies), 0, 0) + b"".join(bodies)
+        components.append(struct.pack("<II", len(c) + 8, 5) + c)
+        timecode = int(t * 1e6)
+        c = struct.pack("<i", 1) + struct.pack("<iII", 2, timecode >> 32, timecode & 0xFFFFFFFF)
+        components.append(struct.pack("<II", len(c) + 8, 17) + c)
+        header = struct.pack("<qII", int(t * 1e6), self._frame_number, len(components))
+        return header + b"".join(components)
+
+    async def _send_frames(self):
+        next_t = time.perf_counter()
+        while True:
+            next_t += 1.0 / self.frequency
+            await asyncio.sleep(max(0.0, next_t - time.perf_counter()))
+            if not self.measuring:
+                continue
+            self._frame_number += 1
+            payload = None
+            for writer, client in list(self._clients.items()):
+                if client["streaming"]:
+                    payload = payload or self._frame(sim_time())
+                    self._send(writer, PACKET_DATA, payload)
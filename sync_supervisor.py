@@ -0,0 +1,228 @@
+import random
+import time
+from collections import namedtuple
+
+import instrumentation
+from dot_commands import get_fan_out
+from dot_connect import connect_devices
+
+""" Supervision de la synchronisation des capteurs Movella DOT :
+- Capteur maître choisi selon la qualité de liaison (temps de connexion et aller-retour mesuré)
+- Attente exponentielle (avec gigue) entre les tentatives
+- Après un échec, sondage des capteurs : ceux qui ne répondent plus sont reconnectés ou retirés,
+  puis la synchronisation est relancée sur les capteurs restants
+- Temps de synchronisation de chaque tentative
+"""
+
+SyncAttempt = namedtuple("SyncAttempt", "root n_devices ok elapsed_s reason action")
+
+
+class SyncSupervisor:
+    """
+    Synchronise le plus grand ensemble de capteurs possible.
+    Un capteur retiré est déconnecté (closePort) : startSync porte sur tous les capteurs connectés.
+    """
+
+    def __init__(self, xdpc_handler, devices, connect_times=None, max_attempts=10,
+                 base_delay=0.5, max_delay=8.0, probe_command="batteryLevel",
+                 probe_timeout=2.0, reconnect=True, min_devices=2, verbose=True):
+        self.xdpc_handler = xdpc_handler
+        self.devices = list(devices)
+        self.connect_times = dict(connect_times or {})
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.probe_command = probe_command
+        self.probe_timeout = probe_timeout
+        self.reconnect = reconnect
+        self.min_devices = min_devices
+        self.verbose = verbose
+        self.root = None
+        self.attempts = []
+        self.dropped = []
+        self.link_quality = {}  # adresse -> score en secondes (plus petit = meilleur)
+        self._reconnected = set()  # Capteurs déjà reconnectés une fois
+        self._failed_roots = set()  # Maîtres ayant échoué depuis le dernier retrait
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def probe(self):
+        """
+        Aller-retour simultané vers tous les capteurs. Met à jour la qualité de liaison
+        et renvoie les adresses des capteurs qui n'ont pas répondu (ou trop lentement).
+        Un capteur sans acquittement après probe_timeout * 2 (ou dont la sonde précédente
+        est toujours bloquée) est compté parmi eux.
+        """
+        result = get_fan_out(self.devices).run(self.probe_command, timeout=self.probe_timeout * 2)
+        unhealthy = {device.bluetoothAddress() for device in self.devices} - set(result.acks)
+        for address, ack in result.acks.items():
+            rtt = (ack - result.fire_ns) / 1e9
+            if rtt > self.probe_timeout:
+                unhealthy.add(address)
+            self.link_quality[address] = self.connect_times.get(address, 0.0) + rtt
+        for address in unhealthy:
+            self.link_quality[address] = float("inf")
+        return unhealthy
+
+    def choose_root(self):
+        """
+        Capteur maître : meilleure liaison, en évitant les maîtres qui viennent d'échouer.
+        """
+        def score(device):
+            address = device.bluetoothAddress()
+            quality = self.link_quality.get(address, self.connect_times.get(address, 0.0))
+            return address in self._failed_roots, quality
+
+        return min(self.devices, key=score)
+
+    def _backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _reconnect(self, device):
+        manager = self.xdpc_handler.manager()
+        port_info = device.portInfo()
+        manager.closePort(port_info)
+        if manager.openPort(port_info):
+            return manager.device(port_info.deviceId())
+        return None
+
+    def _drop(self, device, reason):
+        address = device.bluetoothAddress()
+        self.xdpc_handler.manager().closePort(device.portInfo())
+        self.devices = [d for d in self.devices if d.bluetoothAddress() != address]
+        self.dropped.append((address, reason))
+        self._log(f"🚫 Capteur {address} retiré de la synchronisation ({reason}).")
+
+    def _repair(self, unhealthy):
+        """
+        Reconnecte (ou retire) les capteurs qui ne répondent plus. Renvoie l'action effectuée.
+        """
+        actions = []
+        for device in [d for d in self.devices if d.bluetoothAddress() in unhealthy]:
+            address = device.bluetoothAddress()
+            fresh = None
+            if self.reconnect and address not in self._reconnected:
+                self._reconnected.add(address)
+                fresh = self._reconnect(device)
+            if fresh is not None:
+                self.devices = [fresh if d.bluetoothAddress() == address else d for d in self.devices]
+                actions.append(f"reconnexion {address}")
+                self._log(f"🔄 Capteur {address} reconnecté.")
+            else:
+                self._drop(device, "sans réponse")
+                actions.append(f"retrait {address}")
+        return ", ".join(actions)
+
+    def _sync(self, root_address, action=None):
+        """
+        Une tentative startSync sur tous les capteurs connectés, enregistrée avec sa durée.
+        """
+        manager = self.xdpc_handler.manager()
+        n_devices = len(self.devices)
+        manager.stopSync()
+        t0 = time.perf_counter()
+        with instrumentation.span("dot.start_sync"):
+            ok = manager.startSync(root_address)
+        elapsed = time.perf_counter() - t0
+        reason = None if ok else manager.lastResultText()
+        self.attempts.append(SyncAttempt(root_address, n_devices, ok, elapsed, reason, action))
+        if ok:
+            self._log(f"✅ Synchronisation réussie en {elapsed:.2f} s ({n_devices} capteur(s)).")
+        else:
+            self._log(f"❌ Échec de la synchronisation en {elapsed:.2f} s. Raison : {reason}")
+        return ok
+
+    def _park(self, devices):
+        """
+        Déconnecte temporairement des capteurs (ils ne participent plus à startSync).
+        """
+        addresses = {d.bluetoothAddress() for d in devices}
+        for device in devices:
+            self.xdpc_handler.manager().closePort(device.portInfo())
+        self.devices = [d for d in self.devices if d.bluetoothAddress() not in addresses]
+
+    def _unpark(self, devices):
+        """
+        Reconnecte en parallèle des capteurs écartés. Ceux qui ne se reconnectent pas sont retirés.
+        """
+        reopened, _ = connect_devices(self.xdpc_handler, [d.portInfo() for d in devices],
+                                      verbose=False)
+        self.devices.extend(reopened)
+        back = {d.bluetoothAddress() for d in reopened}
+        for device in devices:
+            if device.bluetoothAddress() not in back:
+                self.dropped.append((device.bluetoothAddress(), "reconnexion impossible"))
+        return reopened
+
+    def _bisect(self, root_address):
+        """
+        Tous les capteurs répondent mais la synchronisation échoue : recherche dichotomique
+        du capteur bloquant en écartant la moitié des suspects à chaque tentative.
+        """
+        suspects = [d for d in self.devices if d.bluetoothAddress() != root_address]
+        while len(suspects) > 1 and len(self.attempts) < self.max_attempts:
+            half = suspects[:len(suspects) // 2]
+            self._park(half)
+            ok = self._sync(root_address, f"recherche : {len(half)} capteur(s) écarté(s)")
+            parked = {d.bluetoothAddress() for d in half}
+            half = self._unpark(half)
+            if ok:
+                suspects = half  # Le capteur bloquant fait partie des capteurs écartés
+            else:
+                suspects = [d for d in suspects if d.bluetoothAddress() not in parked]
+
+        if len(suspects) == 1 and len(self.devices) > self.min_devices:
+            self._drop(suspects[0], "bloque la synchronisation")
+            self._failed_roots.clear()
+            return f"retrait {suspects[0].bluetoothAddress()}"
+        return "recherche interrompue"
+
+    def run(self):
+        """
+        Tente la synchronisation jusqu'à réussite ou épuisement des tentatives.
+        Ordre des remèdes : capteurs muets reconnectés puis retirés, changement de maître,
+        puis recherche du capteur bloquant.
+        """
+        self.probe()
+        failures = 0
+
+        while len(self.attempts) < self.max_attempts:
+            if len(self.devices) < self.min_devices:
+                self._log("🔴 Pas assez de capteurs pour synchroniser.")
+                break
+
+            root_address = self.choose_root().bluetoothAddress()
+            self._log(f"🔗 Synchronisation ({len(self.attempts) + 1}/{self.max_attempts}) de "
+                      f"{len(self.devices)} capteur(s), maître {root_address}...")
+            if self._sync(root_address):
+                self.root = root_address
+                return True
+
+            failed = len(self.attempts) - 1
+            unhealthy = self.probe()
+            if unhealthy:
+                action = self._repair(unhealthy)
+            elif not self._failed_roots:
+                self._failed_roots.add(root_address)
+                action = "changement de maître"
+            else:
+                self._failed_roots.add(root_address)
+                action = self._bisect(root_address)
+            self.attempts[failed] = self.attempts[failed]._replace(action=action)
+            self._log(f"🛠️ {action}")
+            self._backoff(failures)
+            failures += 1
+
+        self._log("🔴 Échec de la synchronisation après plusieurs tentatives.")
+        return False
+
+    def report(self):
+        print("Tentatives de synchronisation :")
+        for k, a in enumerate(self.attempts):
+            status = "OK" if a.ok else f"ÉCHEC ({a.reason}) -> {a.action}"
+            print(f"  {k + 1}. maître {a.root}, {a.n_devices} capteur(s), {a.elapsed_s:.2f} s : {status}")
+        for address, reason in self.dropped:
+            print(f"  Capteur retiré : {address} ({reason})")
@@ -0,0 +1,267 @@
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+
+import Xsens_to_Qualisys as flow
+import instrumentation
+from clock_alignment import align_streams
+from dot_commands import get_fan_out
+from dot_export import export_recordings
+from dot_registry import SensorRegistry
+from gap_filling import write_dense
+from qtm_settings import QtmSettings
+
+""" Enchaînement de plusieurs essais dans une même session :
+- Configuration (fichier JSON) : nombre d'essais, durée, pause entre essais, nom des essais
+- Connexions DOT, synchronisation et contrôle QTM conservés d'un essai à l'autre
+- Finalisation de l'essai précédent (fichier de session, alignement ou export) en parallèle
+  de la préparation de l'essai suivant (sauvegarde et nouvelle mesure QTM, pause)
+- Récapitulatif des essais dans <output_dir>/trials.json
+"""
+
+
+class TrialConfig:
+    """
+    Paramètres d'une série d'essais.
+    name : modèle de nom, formaté avec index (ex. "marche_{index:02d}")
+    live : streaming temps réel (fichier de session) au lieu de l'enregistrement embarqué
+    export : "end" (tous les enregistrements embarqués à la fin), "between" (après chaque essai,
+             pendant la préparation du suivant) ou None
+    qtm_parameters : paramètres QTM appliqués avant chaque essai, ex. {"General": {"Frequency": 120}}
+                     (envoyés uniquement s'ils diffèrent des paramètres en cache)
+    """
+
+    def __init__(self, trials=1, duration=10.0, gap=5.0, name="trial_{index:03d}", live=False,
+                 output_dir="trials", output_rate=60, export="end", save_qtm=True, body_map=None,
+                 qtm_parameters=None):
+        self.trials = trials
+        self.duration = duration
+        self.gap = gap
+        self.name = name
+        self.live = live
+        self.output_dir = output_dir
+        self.output_rate = output_rate
+        self.export = export
+        self.save_qtm = save_qtm
+        self.body_map = body_map
+        self.qtm_parameters = qtm_parameters
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def trial_name(self, index):
+        return self.name.format(index=index)
+
+
+class TrialScheduler:
+    """
+    Exécute les essais d'une configuration avec les capteurs et la connexion QTM de Xsens_to_Qualisys.
+    """
+
+    def __init__(self, config, monitor=None, verbose=True):
+        """
+        monitor : HealthMonitor interrogé pendant la préparation de chaque essai (avertissements)
+        """
+        self.config = config
+        self.monitor = monitor
+        self.verbose = verbose
+        self.trials = []
+        self.qtm_settings = QtmSettings(verbose=verbose)
+        self._finalizing = None  # Finalisation en cours de l'essai précédent (hors liaison BLE)
+        self._exporting = None   # Export en cours (liaison BLE : doit finir avant le démarrage suivant)
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _write_manifest(self):
+        path = os.path.join(self.config.output_dir, "trials.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"config": vars(self.config), "trials": self.trials}, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    async def _prepare_qtm(self, previous_name):
+        """
+        Sauvegarde la mesure QTM précédente, ouvre une nouvelle mesure et applique les paramètres modifiés.
+        """
+        connection = await flow.get_qtm_connection()
+        if connection is None:
+            raise RuntimeError("QTM indisponible")
+        if previous_name is not None and self.config.save_qtm:
+            with instrumentation.span("qtm.save"):
+                await connection.save(f"{previous_name}.qtm", overwrite=True)
+        with instrumentation.span("qtm.new"):
+            await connection.new()
+        if self.config.qtm_parameters:
+            await self.qtm_settings.apply(connection, self.config.qtm_parameters)
+
+    def _finalize_session(self, writer, streamer, frames, markers, settings, gaps):
+        """
+        Dernière écriture, statistiques des trous, alignement d'horloge éventuel et fermeture
+        du fichier de session d'un essai (exécuté hors de la boucle). Renvoie les statistiques des trous.
+        """
+        try:
+            writer.drain(streamer, frames)
+            write_dense(writer, gaps, streamer, final=True)
+            statistics = gaps.statistics()
+            if self.config.body_map and frames is not None and markers.get("dot_ack_ns"):
+                alignment = align_streams(streamer, frames, self.config.body_map,
+                                          settings["body_names"], markers, verbose=False)
+                writer.set_metadata(
+                    alignment={address: result.to_dict() for address, result in alignment.items()})
+        finally:
+            writer.close()
+        return statistics
+
+    async def _finalize(self, record, *args):
+        # Le manifeste n'est modifié que dans la boucle : statistiques ajoutées après la finalisation
+        record["gaps"] = await asyncio.get_running_loop().run_in_executor(None, self._finalize_session, *args)
+        self._write_manifest()
+
+    async def _start(self, name):
+        loop = asyncio.get_running_loop()
+        if self.config.live:
+            result = await loop.run_in_executor(None, flow.start_xsens_streaming,
+                                                self.config.output_rate)
+            flow.start_markers["dot_ack_ns"] = result.first_ack_ns
+            await flow.start_streaming(duration=self.config.duration + 10)
+            flow.open_session(self.config.output_dir, self.config.output_rate, name)
+        else:
+            result = await get_fan_out(flow.connected_devices).run_async("startRecording")
+            await flow.start_streaming(frames=False)
+        return result
+
+    async def _stop(self, record, drain_stop, drain):
+        loop = asyncio.get_running_loop()
+        if self.config.live:
+            await loop.run_in_executor(None, flow.stop_xsens_streaming)
+            await flow.stop_streaming()
+            drain_stop.set()
+            await drain
+            # Références de cet essai : l'essai suivant remplace les variables globales
+            self._finalizing = loop.create_task(self._finalize(
+                record, flow.session_writer, flow.dot_streamer, flow.qtm_frames, dict(flow.start_markers),
+                flow.qtm_settings, flow.gap_filler))
+            record["session"] = flow.session_writer.path
+        else:
+            await get_fan_out(flow.connected_devices).run_async("stopRecording")
+            await flow.stop_streaming()
+            record["recordings"] = await loop.run_in_executor(None, lambda: {
+                device.bluetoothAddress(): device.recordingCount() for device in flow.connected_devices})
+            if self.config.export == "between":
+                self._exporting = loop.run_in_executor(
+                    None, export_recordings, flow.xdpc_handler, flow.connected_devices,
+                    os.path.join(self.config.output_dir, record["name"]), "last", self.verbose)
+
+    async def run(self):
+        """
+        Exécute tous les essais puis les exports différés.
+        """
+        config = self.config
+        os.makedirs(config.output_dir, exist_ok=True)
+        previous_name = None
+
+        for index in range(1, config.trials + 1):
+            name = config.trial_name(index)
+
+            # Préparation : QTM, pause et export de l'essai précédent en parallèle
+            t0 = time.perf_counter()
+            setup = [self._prepare_qtm(previous_name)]
+            if self.monitor is not None:
+                setup.append(self.monitor.preflight())
+            if previous_name is not None:
+                setup.append(asyncio.sleep(config.gap))
+            if self._exporting is not None:
+                setup.append(self._exporting)
+            results = await asyncio.gather(*setup)
+            warnings = results[1] if self.monitor is not None else []
+            self._exporting = None
+            setup_s = time.perf_counter() - t0
+
+            self._log(f"▶️ Essai {index}/{config.trials} : {name} ({config.duration:.0f} s)")
+            # Pas d'interrogation de l'état des capteurs pendant le démarrage et l'arrêt
+            guard = self.monitor.lock if self.monitor is not None else contextlib.nullcontext()
+            async with guard:
+                result = await self._start(name)
+            drain_stop = asyncio.Event()
+            drain = asyncio.create_task(flow.drain_session(drain_stop)) if config.live else None
+            t_start = time.time()
+            await asyncio.sleep(config.duration)
+
+            # Au plus une finalisation en attente : celle de l'essai précédent doit être terminée
+            if self._finalizing is not None:
+                await self._finalizing
+                self._finalizing = None
+
+            record = {
+                "index": index,
+                "name": name,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t_start)),
+                "duration_s": time.time() - t_start,
+                "setup_s": setup_s,
+                "dot_acks": len(result.acks),
+                "dot_skew_ms": result.skew_ns / 1e6,
+                "warnings": [f"{address} : {message}" for address, _, message in warnings],
+            }
+            async with guard:
+                await self._stop(record, drain_stop, drain)
+            if self.monitor is not None:
+                self.monitor.update_packet_loss()
+                record["health"] = {address: health.to_dict()
+                                    for address, health in self.monitor.health.items()}
+            self.trials.append(record)
+            self._write_manifest()
+            self._log(f"⏹️ Essai {name} terminé (préparation {setup_s:.1f} s).")
+            previous_name = name
+
+        # Fin de série : dernière sauvegarde QTM, finalisations et exports en attente
+        connection = await flow.get_qtm_connection()
+        if previous_name is not None and config.save_qtm and connection is not None:
+            await connection.save(f"{previous_name}.qtm", overwrite=True)
+        for pending in (self._finalizing, self._exporting):
+            if pending is not None:
+                await pending
+        if config.export == "end" and not config.live:
+            await asyncio.get_running_loop().run_in_executor(
+                None, export_recordings, flow.xdpc_handler, flow.connected_devices,
+                config.output_dir, "all", self.verbose)
+        self._write_manifest()
+        return self.trials
+
+
+async def main(config, profile="default", qtm_host=flow.DEFAULT_HOST, qtm_port=flow.DEFAULT_PORT,
+               qtm_password="Kiks", timings=True):
+    """
+    Connexion et synchronisation une seule fois, puis tous les essais de la configuration.
+    """
+    instrumentation.enable(timings)
+    registry = SensorRegistry()
+    expected_addresses = registry.profile(profile) if profile else None
+    flow.initialize_sdk()
+    detected_dots = flow.scan_for_dots(expected_addresses=expected_addresses)
+    flow.connect_dots(detected_dots, addresses=expected_addresses)
+    registry.remember(flow.connected_devices, profile=profile)
+    flow.synchronize_devices()
+    await flow.connect_to_qtm(qtm_host, qtm_port, password=qtm_password)
+    monitor = flow.start_health_monitor()
+
+    trials = await TrialScheduler(config, monitor=monitor).run()
+    print(f"✅ {len(trials)} essai(s) terminé(s), récapitulatif dans {config.output_dir}/trials.json")
+
+    monitor.stop()
+    await flow.qtm_manager.stop()
+    flow.xdpc_handler.manager().stopSync()
+    flow.xdpc_handler.cleanup()
+    if timings:
+        instrumentation.dump(os.path.join(config.output_dir, time.strftime("timings_%Y%m%d_%H%M%S.json")),
+                             trials=len(trials), n_devices=len(flow.connected_devices))
+
+
+if __name__ == "__main__":
+    trial_config = TrialConfig.from_file(sys.argv[1]) if len(sys.argv) > 1 else TrialConfig()
+    asyncio.run(main(trial_config))